@@ -5,11 +5,13 @@ from zilabrad.pyle.workflow import switchSession
 from zilabrad.pyle.registry import RegistryWrapper
 
 from zilabrad.instrument.zurichHelper import zurich_qa, zurich_hd, ziDAQ
+from zilabrad.instrument.zurichHelper import nativeBuffer
 from zilabrad.instrument.servers.anritsu_MG3692C import AnritsuServer
 from zilabrad.util import singleton
 from zilabrad.instrument.corrector import correct
 
 import labrad
+from collections import OrderedDict
 
 
 def update_session(user='hwh'):
@@ -42,11 +44,95 @@ def loadQubits(sample, write_access=False):
         return sample, qubits
 
 
+class WiringPlan(object):
+    """ Where the lines (dc, xy_I, xy_Q, z) of qubits are played in HD,
+    and which QA reads out the qubits, compiled from q['channels'] once
+    per experiment.
+
+    Each line has a slot (column) in the native buffer of its AWG core
+    (dev_name, awg_index), a core has two columns (the two channels),
+    see zurichHelper.nativeBuffer. The readout waveform of each QA has
+    its own buffer.
+
+    The QA of a qubit is given by ('readout', qa_name) in q['channels'],
+    default is qa_master, which triggers the HDs and the other QAs.
+    """
+
+    # the order must be 'dc,xy,z'
+    lines = ['dc', 'xy_I', 'xy_Q', 'z']
+
+    def __init__(self, qubits, qa_master='qa_1'):
+        # keep the qubits, so that their id can not be reused
+        self.qubits = list(qubits)
+        self.qa_master = qa_master
+        # name of QA for each qubit
+        self.readout_qa = []
+        # names of QA, qa_master is always the first one
+        self.qa_names = [qa_master]
+        # {(qubit index, line): ((dev_name, awg_index), column)}
+        self.slots = {}
+        # (dev_name, awg_index) in order
+        self.awg_keys = []
+        for k, q in enumerate(qubits):
+            channels = dict(q['channels'])
+            qa_name = channels.get('readout', qa_master)
+            self.readout_qa.append(qa_name)
+            if qa_name not in self.qa_names:
+                self.qa_names.append(qa_name)
+            for line in self.lines:
+                info = channels.get(line)
+                if info is None:
+                    continue
+                dev_name, channel = info
+                awg_key = (dev_name, (channel-1) // 2)
+                if awg_key not in self.awg_keys:
+                    self.awg_keys.append(awg_key)
+                self.slots[(k, line)] = (awg_key, (channel-1) % 2)
+        self.buffers = {key: nativeBuffer() for key in self.awg_keys}
+        self.readout_buffers = {name: nativeBuffer() for name in self.qa_names}
+
+    def readout_qubits(self, qubits, qa_name):
+        """ qubits (with do_readout) read out by the QA
+        """
+        return [
+            q for q, name in zip(qubits, self.readout_qa)
+            if name == qa_name and q.get('do_readout')]
+
+    def readout_order(self, qubits):
+        """ [(qa_name, channel)] for the qubits with do_readout, in
+        the order of qubits, the channel is the index in the QA.
+        """
+        order = []
+        counts = {}
+        for q, name in zip(qubits, self.readout_qa):
+            if q.get('do_readout'):
+                order.append((name, counts.get(name, 0)))
+                counts[name] = counts.get(name, 0) + 1
+        return order
+
+    def get_buffers(self, length, sizes=None):
+        """ native buffers {(dev_name, awg_index): array (size, 2)}
+        filled with zeros.
+        Args:
+            length (int): number of samples of the waves
+            sizes (dict): {(dev_name, awg_index): waveform_length} of the
+            sequencer, the buffer is not shorter, so that it need not
+            be padded in uploading.
+        """
+        if sizes is None:
+            sizes = {}
+        return {
+            key: buffer.get(max(length, sizes.get(key, 0)))
+            for key, buffer in self.buffers.items()}
+
+
 @singleton
 class qubitContext(object):
     """
     resources of the experimental devices
     """
+    # number of cached WiringPlan
+    max_wiring_plans = 8
 
     def __init__(self, cxn=None):
         """
@@ -87,6 +173,13 @@ class qubitContext(object):
         hd = self.get_server('hd', 'hd_1')
         return hd.FS
 
+    @property
+    def qa_master(self):
+        """name of QA which triggers the other devices,
+        given by 'qa_master' in the registry of devices, default 'qa_1'
+        """
+        return self.deviceInfo.get('qa_master', 'qa_1')
+
     def get_server(self, type: str, name: str or None):
         """return the object of server
         example: get_server('qa', 'qa_1')
@@ -170,35 +263,31 @@ class qubitContext(object):
             # class is a singletonMany (returns a dict of objects)
         return serversDict
 
-    def getPorts(self, qubits):
+    def wiringPlan(self, qubits):
         """
-        Get the AWG ports for zurich HD according to whether the
-        corresponding keys exist.
+        WiringPlan of the qubits, which is compiled only once for the
+        same qubit objects (in one experiment).
         Args:
             qubits, list of dictionary
         Returns:
-            ports (list)
-            for example, [('hd_1', 7), ('hd_1', 5), ('hd_1', 6), ('hd_1', 8)]
-
-        TODO:
-        1. ports dictionary should only be created once in
-        the beginning of experiment.
+            WiringPlan
         """
-        ports = []
-        for q in qubits:
-            channels = dict(q['channels'])
-            # the order must be 'dc,xy,z'! match the order in qubitServer
-            if 'dc' in q.keys():
-                # if channels have not 'dc', ports += [None]
-                ports += [channels.get('dc')]
-            if 'xy' in q.keys():
-                ports += [channels['xy_I'], channels['xy_Q']]
-            if 'z' in q.keys():
-                ports += [channels.get('z')]
-        return ports
+        if not hasattr(self, 'wiring_plans'):
+            self.wiring_plans = OrderedDict()
+        key = tuple(id(q) for q in qubits)
+        plan = self.wiring_plans.get(key)
+        if plan is None:
+            plan = WiringPlan(qubits, qa_master=self.qa_master)
+            self.wiring_plans[key] = plan
+            # the plans of old experiments
+            while len(self.wiring_plans) > self.max_wiring_plans:
+                self.wiring_plans.popitem(last=False)
+        else:
+            self.wiring_plans.move_to_end(key)
+        return plan
 
     def clearTempParas(self):
-        attr_names = ['ports']
+        attr_names = ['wiring_plans']
         for name in attr_names:
             if hasattr(self, name):
                 delattr(self, name)
@@ -209,3 +298,5 @@ class qubitContext(object):
 
         self.servers_qa = self._get_zurich_servers('ziQA_id')
         self.servers_hd = self._get_zurich_servers('ziHD_id')
+        # microwave sources may be changed by hand between experiments
+        self.servers_microwave.invalidate()
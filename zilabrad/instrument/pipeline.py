@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Pipelined execution of sweep points
+
+Each sweep point is split in two stages:
+    host stage: build envelopes, render and convert waveforms, process data
+    device stage: set sources, upload, arm and acquire
+
+While point N is in its device stage (waiting for the UHFQA), the host
+stage of point N+1 runs in a worker thread, so that the acquisition is
+the only serial stage of the sweep.
+
+The function of a sweep point (runSweeper) shares the qubit dictionaries
+with all the other points. To keep the points independent, the state of
+the qubits used by runQubits is saved whenever a point leaves the host
+stage and restored when it comes back. Every point (except the first one)
+starts from the qubit state left by the last finished point, therefore the
+function should not carry information between points through the qubits,
+which is already the case if it calls clear_waveforms in the end.
+"""
+
+import threading
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel('WARNING')
+
+_local = threading.local()
+
+
+def current_pipeline():
+    """return the SweepPipeline running in this thread, or None
+    """
+    return getattr(_local, 'pipeline', None)
+
+
+class PipelineAborted(Exception):
+    """raised in a sweep point when an earlier point has failed"""
+
+
+class SweepPipeline(object):
+    """Run the sweep points with overlapped host and device stages.
+
+    Args:
+        depth (int): number of sweep points in flight, depth=2 means that
+        one point is rendered while the other one is acquiring.
+
+    Example:
+        pipeline = SweepPipeline(depth=2)
+        for result in pipeline.map(run, iterable):
+            ...
+    """
+
+    def __init__(self, depth=2):
+        if depth < 1:
+            raise ValueError("depth should be at least 1")
+        self.depth = depth
+        # only one point runs python code on the qubits at the same time
+        self._host_lock = threading.Lock()
+        # the device stage is granted in the order of the sweep points
+        self._turn = threading.Condition()
+        self._next_index = 0
+        self._finished = set()
+        self._aborted = False
+        # qubit dictionaries (id -> qubit) seen by runQubits
+        self._qubits = {}
+        # qubit state left by the last finished point
+        self._base_state = None
+
+    # -- qubit state
+    def track(self, qubits):
+        """register the qubit dictionaries used by runQubits
+        """
+        for q in qubits:
+            self._qubits[id(q)] = q
+
+    def _save_state(self):
+        """shallow copy of the tracked qubits, list values (like q['xy'])
+        are copied since they are usually modified in place
+        """
+        def copy_value(v):
+            if isinstance(v, list):
+                return list(v)
+            return v
+
+        return [
+            (q, {k: copy_value(v) for k, v in q.items()})
+            for q in self._qubits.values()]
+
+    @staticmethod
+    def _restore_state(state):
+        if state is None:
+            return
+        for q, items in state:
+            dict.clear(q)
+            dict.update(q, items)
+
+    # -- stages
+    @contextmanager
+    def device_stage(self):
+        """leave the host stage to the other points while the devices
+        are running, used by runQubits.
+        """
+        index = _local.index
+        state = self._save_state()
+        self._host_lock.release()
+        try:
+            with self._turn:
+                while not self._aborted and self._next_index != index:
+                    self._turn.wait()
+                if self._aborted:
+                    raise PipelineAborted(
+                        "sweep point %d is aborted" % index)
+            yield
+        finally:
+            self._host_lock.acquire()
+            self._restore_state(state)
+
+    def _run_point(self, index, function, paras):
+        _local.pipeline = self
+        _local.index = index
+        self._host_lock.acquire()
+        try:
+            self._restore_state(self._base_state)
+            result = function(paras)
+            self._base_state = self._save_state()
+            return result
+        except BaseException:
+            self._aborted = True
+            raise
+        finally:
+            with self._turn:
+                self._finished.add(index)
+                while self._next_index in self._finished:
+                    self._finished.remove(self._next_index)
+                    self._next_index += 1
+                self._turn.notify_all()
+            self._host_lock.release()
+            _local.pipeline = None
+
+    def map(self, function, iterable):
+        """yield function(paras) for paras in iterable, in order.
+
+        The first point runs alone, so that the devices are set up and the
+        qubits are known before the next points are started.
+        """
+        pending = deque()
+        executor = ThreadPoolExecutor(max_workers=self.depth)
+        try:
+            for index, paras in enumerate(iterable):
+                pending.append(
+                    executor.submit(self._run_point, index, function, paras))
+                if index == 0 or len(pending) >= self.depth:
+                    yield pending.popleft().result()
+            while len(pending) > 0:
+                yield pending.popleft().result()
+        finally:
+            # stop the points in flight when the sweep is interrupted
+            with self._turn:
+                self._aborted = True
+                self._turn.notify_all()
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
@@ -4,15 +4,21 @@ Control flow for devices
 """
 
 import time
-from functools import wraps
+from functools import wraps, partial
 import logging
+import copy
+from concurrent import futures
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import gc
 
 from zilabrad.instrument import waveforms
 from zilabrad.instrument.zurichHelper import zurich_qa, zurich_hd
+from zilabrad.instrument.zurichHelper import nativeBuffer, get_data_many
+from zilabrad.instrument.pipeline import SweepPipeline, current_pipeline
 from zilabrad.instrument.QubitContext import loadQubits
-from zilabrad.instrument.QubitContext import qubitContext
+from zilabrad.instrument.QubitContext import qubitContext, WiringPlan
+from zilabrad import timing
 
 from labrad.units import Unit, Value
 
@@ -36,6 +42,19 @@ def stop_device():
     return
 
 
+def uploadCacheInfo():
+    """ hits and misses of the waveform uploads for all zurich devices,
+    a hit means that an unchanged waveform is not uploaded again
+    Returns:
+        dict, for example {'hd_1': UploadInfo(hits=10, misses=2, currsize=2)}
+    """
+    qContext = qubitContext()
+    zurich_devices = qContext.get_servers_group(type='zurich')
+    return {
+        name: server.upload_cache.info()
+        for name, server in zurich_devices.items()}
+
+
 def Unit2SI(a):
     if type(a) is not Value:
         return a
@@ -56,8 +75,8 @@ def Unit2num(a):
 
 def RunAllExperiment(
         function, iterable, dataset,
-        collect=True, raw=False, noisy=False
-        ):
+        collect=True, raw=False, noisy=False, pipeline=False,
+        compiled=False):
     """ Define an abstract loop to iterate a funtion for iterable
 
     Example:
@@ -72,11 +91,21 @@ def RunAllExperiment(
         collect: if True, collect the result into an array and return it;
         else, return an empty list
         raw: discard swept_paras if raw == True
+        pipeline: if True, the waveforms of the next sweep point are
+        rendered while the current point is acquiring, see
+        zilabrad.instrument.pipeline for the requirements on function
+        compiled: if True, all sweep points are run in one sequencer
+        program, see sequenceTable for the requirements on function
     """
+    if pipeline and compiled:
+        raise ValueError("pipeline and compiled can not be used together")
+
     def run(paras):
         # pass in all_paras to the function
         all_paras = [Unit2SI(a) for a in paras[0]]
         swept_paras = [Unit2num(a) for a in paras[1]]
+        # the envelopes are built until runQubits is called
+        timing.start_lap()
         # 'None' is just the old devices arg which is not used now
         result = function(None, all_paras)
         if raw:
@@ -87,8 +116,13 @@ def RunAllExperiment(
             return result
 
     def wrapped():
-        for paras in iterable:
-            result = run(paras)
+        if compiled:
+            results = sequenceTable().map(run, iterable)
+        elif pipeline:
+            results = SweepPipeline(depth=2).map(run, iterable)
+        else:
+            results = map(run, iterable)
+        for result in results:
             if noisy is True:
                 print(
                     str(np.round(result, 3))
@@ -106,6 +140,7 @@ def RunAllExperiment(
         return resultArray
 
 
+@timing.timed('set_microwaveSource')
 def set_microwaveSource(freqList, powerList):
     """set frequency and power for microwaveSource devices
     """
@@ -122,17 +157,26 @@ def set_microwaveSource(freqList, powerList):
     return
 
 
-def makeSequence_readout(qubits, FS=1.8e9):
+@timing.timed('makeSequence_readout')
+def makeSequence_readout(qubits, FS=1.8e9, buffer=None, size=0,
+                         readout_qubits=None):
     """
     waveServer: zilabrad.instrument.waveforms
     We assume all zurich_qa devices have the
     same sampling rate.
     FS: sampling rates
+    buffer: nativeBuffer, the waveform is rendered into it
+    size: waveform_length of the QA sequencer, minimum of samples
+    readout_qubits: the qubits read out by this QA, default is qubits
+    Returns:
+        readout waveform in the native AWG format
     """
     waveServer = waveforms.waveServer()
+    if readout_qubits is None:
+        readout_qubits = qubits
 
     wave_readout_func = [waveforms.NOTHING, waveforms.NOTHING]
-    for q in qubits:
+    for q in readout_qubits:
         if q.get('do_readout'):
             if 'r' in q.keys():
                 wave_readout_func[0] += q.r[0]
@@ -147,16 +191,31 @@ def makeSequence_readout(qubits, FS=1.8e9):
     waveServer.set_tlist(start=start, end=end, fs=FS)
     wave_readout = [waveServer.func2array(
         wave_readout_func[i], start, end) for i in [0, 1]]
-    return wave_readout
+
+    if buffer is None:
+        buffer = nativeBuffer(depth=1)
+    native = buffer.get(max(len(wave_readout[0]), size))
+    for i in [0, 1]:
+        nativeBuffer.write(native, i, wave_readout[i])
+    return nativeBuffer.native(native)
 
 
-def makeSequence_AWG(qubits, FS=2.4e9):
+@timing.timed('makeSequence_AWG')
+def makeSequence_AWG(qubits, plan, FS=2.4e9, sizes=None):
     """
     waveServer: zilabrad.instrument.waveforms
+    plan: WiringPlan of the qubits, see qubitContext.wiringPlan
     FS: sampling rates
+    sizes: {(dev_name, awg_index): waveform_length} of the sequencers,
+    see WiringPlan.get_buffers, default is no minimum length
+    Returns:
+        dict {(dev_name, awg_index): waveform in the native AWG format},
+        only the AWG cores used by the lines of the qubits, the
+        waveforms are the buffers of plan, which are reused later.
     """
-    wave_AWG = []
     waveServer = waveforms.waveServer()
+    if sizes is None:
+        sizes = {}
 
     # This version consider all of the ports of AWG
     # require the same sampling points
@@ -170,27 +229,33 @@ def makeSequence_AWG(qubits, FS=2.4e9):
 
     # this is just set parameters, not really generate a list, which is slow
     waveServer.set_tlist(start, end, fs=FS)
-
-    for q in qubits:
-        # the order must be 'dc,xy,z' ! match the order in QubitContext
-
-        # line [DC]
-        if 'dc' in q.keys():
-            if q.get('dc') is None:
-                wave_AWG += [None]
+    length = len(np.arange(start, end, 1./FS))
+    buffers = plan.get_buffers(length, sizes)
+
+    awg_used = {}
+    for k, q in enumerate(qubits):
+        # line [DC], [xy] I,Q, [z]
+        funcs = {}
+        for key in ['dc', 'xy', 'z']:
+            if key not in q:
+                continue
+            if key == 'xy':
+                funcs['xy_I'], funcs['xy_Q'] = q.xy
             else:
-                wave_AWG += [waveServer.func2array(q.dc, start, end, FS)]
-
-        # line [xy] I,Q
-        if 'xy' in q.keys():
-            wave_AWG += [waveServer.func2array((q.xy)[i], start, end, FS)
-                         for i in [0, 1]]
-
-        # line [z]
-        if 'z' in q.keys():
-            wave_AWG += [waveServer.func2array(q.z, start, end, FS)]
-
-    return wave_AWG
+                funcs[key] = q[key]
+
+        for line, func in funcs.items():
+            slot = plan.slots.get((k, line))
+            if slot is None:
+                continue
+            awg_key, column = slot
+            # 'dc' can be None, which is played as zeros
+            if func is not None:
+                nativeBuffer.write(
+                    buffers[awg_key], column,
+                    waveServer.func2array(func, start, end, FS))
+            awg_used[awg_key] = nativeBuffer.native(buffers[awg_key])
+    return awg_used
 
 
 def setup_wiring(qContext):
@@ -213,70 +278,311 @@ def setup_wiring(qContext):
             print('Unknown name (%r) with mode(%r)' % (name, mode))
 
 
-def setupDevices(qubits):
+def presizeSequencers(qubits):
+    """ reserve the length of the sequencers for the experiment of
+    qubits, so that they are compiled only once with the maximum
+    length. Call it when q_ref['awgs_pulse_len'] is set for the longest
+    sweep point (see zurich_hd.reserve_length). The reservation is
+    removed when the next experiment starts, see clearReservations.
+    """
+    qContext = qubitContext()
+    plan = qContext.wiringPlan(qubits)
+    q_ref = qubits[0]
+    awg_time = Unit2SI(q_ref['bias_start']) + Unit2SI(q_ref['bias_end']) + \
+        Unit2SI(q_ref['awgs_pulse_len']) + Unit2SI(q_ref['readout_len'])
+    awg_length = int(np.ceil(awg_time*qContext.DAC_FS))
+    readout_length = int(np.ceil(
+        Unit2SI(q_ref['readout_len'])*qContext.ADC_FS))
+
+    hds = qContext.get_servers_group('hd')
+    for dev_name, awg_index in plan.awg_keys:
+        hds[dev_name].reserve_length(awg_length, awg_index=awg_index)
+    qas = qContext.get_servers_group('qa')
+    for qa_name in plan.qa_names:
+        qas[qa_name].reserve_length(readout_length)
+
+
+def clearReservations():
+    """ remove the reservations of an experiment (see presizeSequencers
+    and reserveSlots), called when an experiment starts and ends (see
+    zilabrad.multiplex.expfunc_decorator), the sequencers are then
+    built for the length of the new waveforms with one slot.
+    """
+    qContext = qubitContext()
+    for hd in qContext.get_servers_group('hd').values():
+        for awg_index in range(len(hd.reserved_length)):
+            hd.reserve_length(0, awg_index=awg_index)
+            hd.reserve_slots(1, awg_index=awg_index)
+    for qa in qContext.get_servers_group('qa').values():
+        qa.reserve_length(0)
+        qa.reserve_slots(1)
+
+
+# limit of reserveSlots, the waveform memory is shared by the slots
+max_number_slot = 32
+
+
+def reserveSlots(qubits, number_slot, readout_slots=1):
+    """ keep number_slot waveforms of every HD core (readout_slots for
+    the QAs) in the devices, for experiments alternating between a few
+    sequences, e.g. IQraw (|1>, |0>). Each different sequence is
+    uploaded once, then only the slot is selected by a user register,
+    see zurich_hd.reserve_slots. The sequencers are compiled again in
+    the next runQubits. The slots are removed when the experiment ends
+    (see clearReservations), or by number_slot=1. HDs with grouped
+    channels keep one slot.
+    """
+    qContext = qubitContext()
+    plan = qContext.wiringPlan(qubits)
+    number_slot = min(number_slot, max_number_slot)
+    hds = qContext.get_servers_group('hd')
+    for dev_name, awg_index in plan.awg_keys:
+        if hds[dev_name].grouping > 0:
+            continue
+        hds[dev_name].reserve_slots(number_slot, awg_index=awg_index)
+    qas = qContext.get_servers_group('qa')
+    for qa_name in plan.qa_names:
+        qas[qa_name].reserve_slots(min(readout_slots, max_number_slot))
+
+
+def averageNumber(qubits):
+    """number of averages in QA for the qubits.
+
+    The averaged mode is selected by q['average_mode'] of all qubits
+    (see zilabrad.multiplex.set_averageMode), then only one averaged
+    result of all the stats is returned. It falls back to single-shot
+    (1) if stats is not a power of 2, which is required by QA, or if
+    the experiment needs single shots (multiplex.set_singleShot).
+    """
+    q_ref = qubits[0]
+    if not all(q.get('average_mode') for q in qubits):
+        return 1
+    if any(q.get('single_shot') for q in qubits):
+        return 1
+    stats = int(q_ref['stats'])
+    if stats & (stats-1) != 0:
+        logger.warning(
+            'stats (%d) is not a power of 2, use single-shot mode' % stats)
+        return 1
+    return stats
+
+
+@timing.timed('setupDevices')
+def setupDevices(qubits, result_samples=None, plan=None):
+    """
+    Args:
+        result_samples (int): number of single-shot results in one run
+        of QA, default is given by q_ref['stats'] and averageNumber
+        plan (WiringPlan): default is qubitContext().wiringPlan(qubits)
+    """
     q_ref = qubits[0]
     # only run once in the whole experimental loop
     qContext = qubitContext()
-    # qas = qContext.get_servers_group('qa')
-    qa = qContext.get_server('qa', 'qa_1')
+    if plan is None:
+        plan = qContext.wiringPlan(qubits)
+    qas = qContext.get_servers_group('qa')
+
+    if result_samples is None:
+        average = averageNumber(qubits)
+        result_samples = q_ref['stats'] // average
+    else:
+        average = 1
 
     if 'isNewExpStart' not in q_ref:
         print('isNewExpStart, setupDevices')
         qContext.refresh()
         setup_wiring(qContext)
-        # int: sample number for one sweep point
-        qa.set_result_samples(q_ref['stats'])
-
-        # only related with wiring and devices, delay between QA
-        # signal output and demodulation
-        qa.set_readout_delay(q_ref['readout_delay'])
-
-        # set qa pulse length in AWGs, and set same length for demodulate.
-        qa.set_pulse_length(q_ref['readout_len'])
-
-        # delay between zurich HD and QA
-        qa.set_adc_trig_delay(
-            q_ref['bias_start']['s']+q_ref['experiment_length'])
-
-        # set demodulate frequency for qubits if you need readout the qubit
-        f_read = []
-        for qb in qubits:
-            if qb.get('do_readout'):  # in _q.keys():
-                f_read += [qb.demod_freq]
-        if len(f_read) == 0:
+
+        n_read = 0
+        for qa_name in plan.qa_names:
+            qa = qas[qa_name]
+            readout_qubits = plan.readout_qubits(qubits, qa_name)
+            # the other QAs are triggered by the master QA
+            qa.set_wait_trigger(qa_name != plan.qa_master)
+
+            # int: sample number for one sweep point
+            qa.set_result_samples(result_samples)
+            qa.set_average(average)
+
+            # only related with wiring and devices, delay between QA
+            # signal output and demodulation
+            qa.set_readout_delay(q_ref['readout_delay'])
+
+            # set qa pulse length in AWGs, and set same length for
+            # demodulate.
+            qa.set_pulse_length(q_ref['readout_len'])
+
+            # delay between zurich HD and QA
+            qa.set_adc_trig_delay(
+                q_ref['bias_start']['s']+q_ref['experiment_length'])
+
+            # set demodulate frequency for qubits if you need readout
+            # the qubit
+            f_read = [qb.demod_freq for qb in readout_qubits]
+            if len(f_read) > 0:
+                qa.set_qubit_frequency(f_read)
+            n_read += len(f_read)
+        if n_read == 0:
             raise Exception('Must set one readout frequency at least')
-        qa.set_qubit_frequency(f_read)
 
         q_ref['isNewExpStart'] = False  # actually it can be arbitrary value
 
     else:
-        # delay between zurich HD and QA
-        # for example: in T1 measurement
-        qa.set_adc_trig_delay(
-            q_ref['bias_start']['s']+q_ref['experiment_length'])
+        for qa_name in plan.qa_names:
+            qa = qas[qa_name]
+            if average != qa.average:
+                qa.set_result_samples(result_samples)
+                qa.set_average(average)
+            elif result_samples != qa.result_samples:
+                qa.set_result_samples(result_samples)
+            # delay between zurich HD and QA
+            # for example: in T1 measurement
+            qa.set_adc_trig_delay(
+                q_ref['bias_start']['s']+q_ref['experiment_length'])
     return
 
 
-def runDevices(qubits, wave_AWG, wave_readout):
+class UploadError(Exception):
+    """ raised by uploadParallel when the upload of some cores failed
+    Attributes:
+        errors (dict): {(device name, awg_index): exception}
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__('Failed to upload to %s' % ', '.join(
+            '%s-AWG%d (%r)' % (key[0], key[1], error)
+            for key, error in errors.items()))
+
+
+# threads uploading to the cores of devices, see uploadParallel
+_upload_executor = None
+max_upload_workers = 8
+
+
+def uploadParallel(tasks, sessions=None):
+    """ run the uploads of different cores at the same time, and wait
+    for all of them (the barrier before the QAs start).
+    A ziDAQServer connection can not be used from several threads, the
+    tasks of the same session are run one after another in one thread,
+    only different sessions are uploaded in parallel. Each device has
+    its own session (ziDAQ.session), so the devices are uploaded in
+    parallel and the cores of a device one after another.
+    Args:
+        tasks (dict): {(device name, awg_index): function without args}
+        sessions (dict): {(device name, awg_index): daq session of the
+        device}, default is a session for each task
+    Raises:
+        UploadError with the errors of all failed cores
+    """
+    global _upload_executor
+    if _upload_executor is None:
+        _upload_executor = ThreadPoolExecutor(
+            max_workers=max_upload_workers, thread_name_prefix='upload')
+    if sessions is None:
+        sessions = {key: key for key in tasks}
+    groups = {}
+    for key, func in tasks.items():
+        groups.setdefault(id(sessions[key]), []).append((key, func))
+    if len(groups) == 1:
+        # no thread for a single session
+        errors = _uploadSerial(list(groups.values())[0])
+    else:
+        results = [
+            _upload_executor.submit(_uploadSerial, group)
+            for group in groups.values()]
+        errors = {}
+        for future in results:
+            errors.update(future.result())
+    if errors:
+        raise UploadError(errors)
+
+
+def _uploadSerial(group):
+    """ run the tasks [(key, function)] in order
+    Returns: {key: exception} of the failed tasks
+    """
+    errors = {}
+    for key, func in group:
+        try:
+            func()
+        except Exception as e:
+            errors[key] = e
+    return errors
+
+
+def armDevices(sequence):
+    """ upload the waveforms of the sequence (made by makeSequence)
+    and start the devices, the data is not downloaded.
+    Returns:
+        list of qa servers which are acquiring, the master QA is the
+        first one and it is started in the end.
+    """
     qContext = qubitContext()
-    # qas = qContext.get_servers_group('qa')
-    qa = qContext.get_server('qa', 'qa_1')
-    # send data packet to multiply devices
-    qa.send_waveform(waveform=wave_readout)
+    qas = qContext.get_servers_group('qa')
+    qas = [qas[name] for name in sequence.readout_native]
+    # send data packet to multiply devices, all cores at the same time
+    tasks = {}
+    for qa in qas:
+        tasks[(qa.obj_name, 0)] = partial(
+            qa.send_waveform_native, sequence.readout_native[qa.obj_name])
 
     hds = qContext.get_servers_group('hd')
-    qubits_port = qContext.getPorts(qubits)
-    awg_waves = AWG_wave_dict(qubits_port, wave_AWG)
+    for (dev_name, awg_index), wave in sequence.awg_native.items():
+        tasks[(dev_name, awg_index)] = partial(
+            _upload_hd, hds[dev_name], wave, awg_index)
+    uploadParallel(tasks, uploadSessions(tasks))
+
+    # the master QA triggers the other devices
+    for qa in qas[::-1]:
+        qa.awg_open()
+    return qas
+
+
+def uploadSessions(tasks):
+    """ {(device name, awg_index): daq session of the device} for the
+    keys of tasks, see uploadParallel
+    """
+    servers = qubitContext().get_servers_group('zurich')
+    return {key: servers[key[0]].session for key in tasks}
+
+
+def _upload_hd(hd, wave, awg_index):
+    hd.send_waveform_native(wave, awg_index=awg_index)
+    hd.awg_open(awgs_index=[awg_index])
+
 
-    for (dev_name, awg_index), wave in awg_waves.items():
-        hd = hds[dev_name]
-        hd.send_waveform(
-            waveform=wave, awg_index=awg_index)
-        hd.awg_open(awgs_index=[awg_index])
+def acquireData(qas, readout_order):
+    """ download experimental data of qas (blocking)
+    Args:
+        qas (list): QAs given by armDevices
+        readout_order (list): [(qa_name, channel)] of the readout
+        qubits, see WiringPlan.readout_order
+    Returns:
+        data of the readout qubits in readout_order, the same for one
+        or several QAs
+    """
+    if len(qas) == 1:
+        _datas = [qas[0].get_data()]
+    else:
+        _datas = get_data_many(qas)
+    datas = {
+        qa.obj_name: combineChannels(qa, _data)
+        for qa, _data in zip(qas, _datas)}
+    return [datas[qa_name][channel] for qa_name, channel in readout_order]
 
-    qa.awg_open()  # download experimental data
-    _data = qa.get_data()
 
+def runDevices(sequence):
+    """ upload the waveforms of the sequence (made by makeSequence),
+    run the devices and get data
+    """
+    qas = armDevices(sequence)
+    return acquireData(qas, sequence.readout_order)
+
+
+def combineChannels(qa, _data):
+    """combine the result channels of qa into complex data
+    """
     if qa.source == 7:  # single channels
         return _data
     else:  # double channels
@@ -286,58 +592,77 @@ def runDevices(qubits, wave_AWG, wave_readout):
         return data_doubleChannel
 
 
-def AWG_wave_dict(devices_info, waves):
-    """ Combine waveform sequence and device info (name, port)
-    as dictionary.
-    Args:
-        devices_info (list): [(dev_name, channel)], channel is in [1,2...8]
-        for example, [('hd_1', 3), ('hd_1', 4)]
-    Return:
-        port_dict = {
-            (dev_name, awg_index): [wave1, wave2]
-            }
-    """
-    port_dict = {}
-    for wave in waves:
-        if wave is not None:
-            wave_len = len(wave)
-            break
-
-    for k, info in enumerate(devices_info):
-        if info is None:
-            continue
-        dev_name, channel = info
-        awg_index = (channel-1) // 2
-        _key = (dev_name, awg_index)
-        # initiate
-        if port_dict.get(_key) is None:
-            port_dict[_key] = [None, None]
-
-        # add waves
-        wave_order = (channel-1) % 2
-        wave = waves[k]
-        # wave_order == 0 or 1
-        port_dict[_key][wave_order] = wave
-
-    # fill zero array if wave_list still has None
-    for wave_list in port_dict.values():
-        for i in range(len(wave_list)):
-            if wave_list[i] is None:
-                wave_list[i] = np.zeros(wave_len)
-
-    return port_dict
+class deviceSequence(object):
+    """ Everything the devices need for one run of runQubits,
+    waveforms are already rendered in the native AWG format.
 
+    The qubits are copied, so that they can be modified for the
+    next run (see zilabrad.instrument.pipeline) before the devices
+    start. The waveforms are the buffers of WiringPlan, which are
+    reused after a few runs, see copy_waveforms.
+    """
 
-def runQubits(qubits, exp_devices=None):
-    """ generally for running multiqubits
-    Args:
-        qubits (list): a list of dictionary
+    def __init__(self, qubits, awg_native, readout_native, plan):
+        self.qubits = [copy.copy(q) for q in qubits]
+        self.awg_native = awg_native
+        # {qa_name: waveform}
+        self.readout_native = readout_native
+        self.plan = plan
+        self.readout_order = plan.readout_order(qubits)
+
+    def copy_waveforms(self):
+        """own the waveforms, if the sequence is kept longer
+        """
+        self.awg_native = {
+            key: wave.copy() for key, wave in self.awg_native.items()}
+        self.readout_native = {
+            key: wave.copy() for key, wave in self.readout_native.items()}
+
+
+def makeSequence(qubits):
+    """ render and convert the waveforms of qubits,
+    which does not need the devices.
+    Returns:
+        deviceSequence
     """
     qContext = qubitContext()
 
-    wave_readout = makeSequence_readout(qubits, FS=qContext.ADC_FS)
-    wave_AWG = makeSequence_AWG(qubits, FS=qContext.DAC_FS)
+    plan = qContext.wiringPlan(qubits)
+    # render into buffers as long as the sequencers, no padding
+    qas = qContext.get_servers_group('qa')
+    hds = qContext.get_servers_group('hd')
+    sizes = {
+        (dev_name, awg_index): hds[dev_name].waveform_length[awg_index]
+        for (dev_name, awg_index) in plan.awg_keys}
+
+    readout_native = {}
+    for qa_name in plan.qa_names:
+        readout_native[qa_name] = makeSequence_readout(
+            qubits, FS=qContext.ADC_FS,
+            buffer=plan.readout_buffers[qa_name],
+            size=qas[qa_name].waveform_length,
+            readout_qubits=plan.readout_qubits(qubits, qa_name))
+    awg_native = makeSequence_AWG(
+        qubits, plan, FS=qContext.DAC_FS, sizes=sizes)
+
+    return deviceSequence(qubits, awg_native, readout_native, plan)
+
+
+def keepSetup(sequence, qubits):
+    """ setupDevices marks the copied qubits of the sequence, copy the
+    mark back to qubits after the devices are armed, so that the next
+    runQubits only updates the devices. If the setup or the upload
+    failed, the next runQubits sets up the devices again.
+    """
+    if 'isNewExpStart' in sequence.qubits[0]:
+        qubits[0]['isNewExpStart'] = sequence.qubits[0]['isNewExpStart']
+
 
+def armSequence(sequence):
+    """ set up and start the devices with the sequence given by
+    makeSequence, see armDevices
+    """
+    qubits = sequence.qubits
     q_ref = qubits[0]
     # Now it is only two microwave sources, more should be covered
     # in the future
@@ -345,7 +670,275 @@ def runQubits(qubits, exp_devices=None):
         freqList=[q_ref['readout_mw_fc'], q_ref['xy_mw_fc']],
         powerList=[q_ref['readout_mw_power'], q_ref['xy_mw_power']])
 
-    setupDevices(qubits)
-    data = runDevices(qubits, wave_AWG, wave_readout)
+    setupDevices(qubits, plan=sequence.plan)
+    return armDevices(sequence)
 
+
+def runSequence(sequence):
+    """ run the devices with the sequence given by makeSequence
+    """
+    qas = armSequence(sequence)
+    return acquireData(qas, sequence.readout_order)
+
+
+# one thread downloads the data, acquisitions are not overlapped
+_acquisition_executor = None
+# the last submitted acquisition, see submitSequence
+_acquisition_pending = None
+
+
+class acquisitionFuture(futures.Future):
+    """ Future of the data of submitSequence, which remembers whether
+    its result (or error) was read by the caller.
+    """
+    retrieved = False
+
+    def result(self, timeout=None):
+        self.retrieved = True
+        return super().result(timeout)
+
+    def exception(self, timeout=None):
+        self.retrieved = True
+        return super().exception(timeout)
+
+    def unread_exception(self):
+        """the error of the finished acquisition if nobody read it
+        """
+        if self.retrieved or self.cancelled():
+            return None
+        return super().exception(0)
+
+
+def _setFuture(future, func, *args):
+    if not future.set_running_or_notify_cancel():
+        return
+    try:
+        future.set_result(func(*args))
+    except BaseException as e:
+        future.set_exception(e)
+
+
+def submitSequence(sequence):
+    """ start the devices with the sequence and download the data in
+    the background.
+    The devices are set up and armed in the calling thread, after the
+    previous acquisition is finished. If the previous acquisition failed
+    and its future was never read, its error is raised here instead of
+    arming the devices.
+    The devices can be used while the data is downloaded, the calls on
+    the session of a device are serialized (shadowDAQ.lock), and the
+    download polls qa.session, not a transaction of the caller.
+    Returns:
+        acquisitionFuture of the data
+    """
+    global _acquisition_executor, _acquisition_pending
+    if _acquisition_executor is None:
+        _acquisition_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='acquisition')
+    pending = _acquisition_pending
+    if pending is not None:
+        futures.wait([pending])
+        error = pending.unread_exception()
+        if error is not None:
+            pending.retrieved = True
+            raise error
+    qas = armSequence(sequence)
+    future = acquisitionFuture()
+    _acquisition_executor.submit(
+        _setFuture, future, acquireData, qas, sequence.readout_order)
+    _acquisition_pending = future
+    return future
+
+
+def _upload_hd_table(hd, waves, repetition, awg_index):
+    hd.send_waveform_table(waves, repetition=repetition, awg_index=awg_index)
+    hd.awg_open(awgs_index=[awg_index])
+
+
+def deviceSettings(sequence):
+    """settings of the devices which can not be changed
+    inside one sequencer program
+    """
+    q_ref = sequence.qubits[0]
+    f_read = [qb.demod_freq for qb in sequence.qubits if qb.get('do_readout')]
+    return [
+        q_ref['readout_mw_fc'], q_ref['xy_mw_fc'],
+        q_ref['readout_mw_power'], q_ref['xy_mw_power'], q_ref['stats'],
+        q_ref['bias_start']['s']+q_ref['experiment_length'], f_read]
+
+
+class sequenceTable(object):
+    """ Run a whole sweep in one sequencer program.
+
+    The function of the sweep is called twice for each sweep point:
+    the first pass records the sequence of every runQubits call
+    (returning zeros as data), then all the sequences are uploaded as a
+    waveform table of HD and QA, and acquired in one QA result run with
+    (number of sequences)*stats samples. The second pass replays the
+    function with the data of the corresponding runQubits call.
+
+    The settings of devices (microwave sources, stats, demodulation)
+    must be the same for all sweep points, see deviceSettings.
+    The function is called with the same parameters in both passes, so
+    it should call runQubits the same number of times.
+    """
+    def __init__(self):
+        self.sequences = []
+        self.data = []
+        self.replay = False
+        self._index = 0
+
+    def run(self, qubits):
+        """runQubits in the recording or replaying pass
+        """
+        if self.replay:
+            if self._index >= len(self.data):
+                raise Exception(
+                    'runQubits is called more times than recorded')
+            data = self.data[self._index]
+            self._index += 1
+            return data
+        sequence = makeSequence(qubits)
+        # all sequences are kept until the sweep is uploaded
+        sequence.copy_waveforms()
+        self.sequences.append(sequence)
+        stats = qubits[0]['stats']
+        return [np.zeros(stats) for _ in sequence.readout_order]
+
+    def execute(self):
+        """run all recorded sequences in one sequencer program
+        """
+        sequences = self.sequences
+        if len(sequences) == 0:
+            return
+        settings = deviceSettings(sequences[0])
+        for k, sequence in enumerate(sequences):
+            if deviceSettings(sequence) != settings:
+                raise ValueError(
+                    "The settings of devices are changed in sequence %d, "
+                    "the sweep can not be compiled into one program" % k)
+
+        qa_names = list(sequences[0].readout_native)
+        if len(qa_names) > 1:
+            raise ValueError(
+                "The sweep with several QAs can not be compiled")
+
+        qContext = qubitContext()
+        qa = qContext.get_server('qa', qa_names[0])
+        hds = qContext.get_servers_group('hd')
+        q_ref = sequences[0].qubits[0]
+        stats = q_ref['stats']
+        number_sequence = len(sequences)
+
+        set_microwaveSource(
+            freqList=[q_ref['readout_mw_fc'], q_ref['xy_mw_fc']],
+            powerList=[q_ref['readout_mw_power'], q_ref['xy_mw_power']])
+        setupDevices(
+            sequences[0].qubits, result_samples=number_sequence*stats,
+            plan=sequences[0].plan)
+
+        tasks = {}
+        tasks[(qa.obj_name, 0)] = partial(
+            qa.send_waveform_table,
+            [sequence.readout_native[qa.obj_name] for sequence in sequences],
+            repetition=stats)
+
+        awg_keys = []
+        for sequence in sequences:
+            for key in sequence.awg_native:
+                if key not in awg_keys:
+                    awg_keys.append(key)
+        # zeros will be filled by send_waveform_table
+        empty = np.zeros(0, dtype=np.uint16)
+        for (dev_name, awg_index) in awg_keys:
+            waves = [
+                sequence.awg_native.get((dev_name, awg_index), empty)
+                for sequence in sequences]
+            tasks[(dev_name, awg_index)] = partial(
+                _upload_hd_table, hds[dev_name], waves, stats, awg_index)
+        uploadParallel(tasks, uploadSessions(tasks))
+
+        qa.awg_open()
+        _data = qa.get_data(timeout=10*number_sequence)
+        data = combineChannels(qa, _data)
+
+        # split back for every sequence, data of its readout qubits
+        self.data = [
+            [data[channel][k*stats:(k+1)*stats]
+             for qa_name, channel in sequence.readout_order]
+            for k, sequence in enumerate(sequences)]
+
+    def map(self, function, iterable):
+        """yield function(paras) for paras in iterable, in order.
+        """
+        global _sequence_table
+        paras_list = list(iterable)
+        _sequence_table = self
+        try:
+            # recording pass, results are discarded
+            for paras in paras_list:
+                function(paras)
+            self.execute()
+            self.replay = True
+            for paras in paras_list:
+                yield function(paras)
+        finally:
+            _sequence_table = None
+
+
+# sequenceTable in use, see runQubits
+_sequence_table = None
+
+
+def _doneFuture(result):
+    future = futures.Future()
+    future.set_result(result)
+    return future
+
+
+def runQubitsAsync(qubits, exp_devices=None):
+    """ start the devices for multiqubits without waiting for the data,
+    the next sequence can be prepared or the dataset written meanwhile.
+    The waveforms are rendered and the devices armed in the calling
+    thread, only the download of the data runs in the background
+    (see submitSequence), the devices can be used meanwhile.
+    Args:
+        qubits (list): a list of dictionary
+    Returns:
+        concurrent.futures.Future, the result is the data of runQubits,
+        use asyncio.wrap_future(future) to await it in asyncio.
+
+    In a compiled sweep (sequenceTable) or pipelined sweep
+    (SweepPipeline), the data is ready when the future is returned.
+    """
+    timing.lap('runSweeper.envelope')
+    if _sequence_table is not None:
+        return _doneFuture(_sequence_table.run(qubits))
+
+    sequence = makeSequence(qubits)
+
+    pipeline = current_pipeline()
+    if pipeline is None:
+        future = submitSequence(sequence)
+        keepSetup(sequence, qubits)
+        timing.start_lap()
+        return future
+
+    # the next sweep point can be rendered while the devices are running
+    pipeline.track(qubits)
+    with pipeline.device_stage():
+        data = runSequence(sequence)
+    # after the qubits are restored by the pipeline
+    keepSetup(sequence, qubits)
+    timing.start_lap()
+    return _doneFuture(data)
+
+
+def runQubits(qubits, exp_devices=None):
+    """ generally for running multiqubits
+    Args:
+        qubits (list): a list of dictionary
+    """
+    data = runQubitsAsync(qubits, exp_devices).result()
+    timing.start_lap()
     return data
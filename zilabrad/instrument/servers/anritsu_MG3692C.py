@@ -27,6 +27,8 @@ class AnritsuServer(object):
             self.devices[address] = rm.open_resource(address)
         self.rm = rm
         self.selectedDevice = self.devices.get(address)
+        # last written state of each device, {address: {'output': True}}
+        self.shadow = {}
 
     def add_device(self, address):
         self.devices[address] = rm.open_resource(address)
@@ -34,11 +36,25 @@ class AnritsuServer(object):
     def select_device(self, address):
         self.selectedDevice = self.devices[address]
 
+    def invalidate(self, address=None):
+        """forget the shadow state of the device (all devices if None),
+        the next setting is written even if it is the same as before.
+        Use it when the device is touched outside of this server.
+        """
+        if address is None:
+            self.shadow.clear()
+        else:
+            self.shadow.pop(address, None)
+
+    def _shadow(self, dev):
+        return self.shadow.setdefault(dev._resource_name, {})
+
     def refresh_device(self, dev):
         address = dev._resource_name
 
         # clear storage
         del self.devices[address]
+        self.invalidate(address)
         gc.collect()
 
         rm = self.rm
@@ -63,30 +79,48 @@ class AnritsuServer(object):
 
     @refresh_when_error
     def frequency(self, dev, freq=None):
-        """Get or set the frequency (MHz)."""
+        """Get or set the frequency (MHz).
+        Setting is skipped if the frequency is not changed.
+        """
+        shadow = self._shadow(dev)
         if freq is None:
             res = dev.query(':sour:freq?')
-            return eval(res)/1e6
-        else:
+            shadow['frequency'] = eval(res)/1e6
+            return shadow['frequency']
+        elif shadow.get('frequency') != freq:
+            shadow.pop('frequency', None)
             dev.write(':sour:freq %f MHz' % freq)
+            shadow['frequency'] = freq
 
     @refresh_when_error
     def amplitude(self, dev, amp=None):
-        """Get or set the amplitude (dBm)."""
+        """Get or set the amplitude (dBm).
+        Setting is skipped if the amplitude is not changed.
+        """
+        shadow = self._shadow(dev)
         if amp is None:
             res = dev.query(':sour:pow?')
-            return eval(res)
-        else:
+            shadow['amplitude'] = eval(res)
+            return shadow['amplitude']
+        elif shadow.get('amplitude') != amp:
+            shadow.pop('amplitude', None)
             dev.write(':sour:pow %f' % amp)
+            shadow['amplitude'] = amp
 
     @refresh_when_error
     def output(self, dev, state: (None or bool) = None):
-        """Get or set the output status."""
+        """Get or set the output status.
+        Setting is skipped if the status is not changed.
+        """
+        shadow = self._shadow(dev)
         if state is None:
             res = dev.query('outp?')
-            return bool(eval(res))
-        else:
+            shadow['output'] = bool(eval(res))
+            return shadow['output']
+        elif shadow.get('output') != bool(state):
+            shadow.pop('output', None)
             dev.write('outp %d' % int(state))
+            shadow['output'] = bool(state)
 
     def stop_all(self):
         for address in self.devices.keys():
@@ -0,0 +1,443 @@
+# -*- coding: utf-8 -*-
+"""
+Simulated data server of zurich instruments, in process
+
+It implements the subset of zhinst.ziPython.ziDAQServer used by
+zurichHelper, so that the run loop can be profiled and tested
+without hardware:
+
+    ziDAQ(simulate=True)  # before the devices are created
+    qa = zurich_qa('qa_1', device_id='dev2592')['qa_1']
+
+Latencies of the calls are given in simDAQServer.latency (second),
+scaled by time_scale (0 for no waiting at all). The QA returns
+integration results of the uploaded readout waveform, weighted by
+the integration weights, with the qubit in the excited state with
+probability excited_probability, see simDAQServer.shot_results.
+"""
+
+import copy
+import fnmatch
+import os
+import re
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+
+# typical latencies (second) of a data server in the local network
+default_latency = {
+    'set': 50e-6,  # setInt, setDouble ...
+    'get': 1e-3,  # getInt, getDouble ...
+    'setVector': 1e-3,  # fixed part of setVector
+    'setVector_sample': 2e-9,  # setVector, per sample
+    'awgModule': 0.2,  # create an awgModule
+    'compile': 0.5,  # compile a sequencer program
+    'compile_sample': 1e-7,  # compile, per sample of the waveforms
+    'elf': 0.05,  # upload an ELF file
+}
+
+# node paths accepted by the server, wildcards included
+_node_path = re.compile(r'^/?[a-z0-9_*]+(/[a-z0-9_*]+)*/?$')
+
+
+def _check_path(path):
+    # the data server rejects paths which are not nodes
+    if not _node_path.match(path):
+        raise RuntimeError('invalid node path: %r' % path)
+
+
+class simAwgModule(object):
+    """ awgModule of simDAQServer, compiles a program or uploads
+    an ELF file (the program text) when the node is set.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.nodes = {
+            'awgModule/device': '',
+            'awgModule/index': 0,
+            'awgModule/directory': server.directory,
+            'awgModule/compiler/status': -1,
+            'awgModule/compiler/statusstring': '',
+            'awgModule/elf/file': '',
+            'awgModule/elf/upload': 0,
+            'awgModule/elf/status': 0,
+            'awgModule/progress': 0.0,
+        }
+
+    def execute(self):
+        pass
+
+    def finish(self):
+        pass
+
+    def clear(self):
+        pass
+
+    def set(self, path, value):
+        self.nodes[path] = value
+        if path == 'awgModule/compiler/sourcestring':
+            self._compile(value)
+        elif path == 'awgModule/elf/upload' and value == 1:
+            self._upload_elf()
+
+    def getInt(self, path):
+        return int(self.nodes[path])
+
+    def getDouble(self, path):
+        return float(self.nodes[path])
+
+    def getString(self, path):
+        return str(self.nodes[path])
+
+    def _elf_path(self):
+        return os.path.join(
+            self.nodes['awgModule/directory'], 'awg', 'elf',
+            self.nodes['awgModule/elf/file'])
+
+    def _compile(self, program):
+        self.nodes['awgModule/progress'] = 0.0
+        length, number_wave = parse_program(program)
+        self.server.wait(
+            'compile', 'compile_sample', 2*length*number_wave)
+        path = self._elf_path()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(program)
+        self._load(program)
+        self.nodes['awgModule/compiler/status'] = 0
+        self.nodes['awgModule/progress'] = 1.0
+
+    def _upload_elf(self):
+        self.nodes['awgModule/elf/status'] = 2
+        self.server.wait('elf')
+        path = self._elf_path()
+        if os.path.isfile(path):
+            with open(path) as f:
+                self._load(f.read())
+            self.nodes['awgModule/elf/status'] = 0
+        else:
+            self.nodes['awgModule/elf/status'] = 1
+        self.nodes['awgModule/elf/upload'] = 0
+
+    def _load(self, program):
+        self.server.load_program(
+            self.nodes['awgModule/device'],
+            int(self.nodes['awgModule/index']), program)
+
+
+def parse_program(program):
+    """ Returns: (wave length, number of waves) of the programs of
+    zurichHelper, one wave for each playWave.
+    """
+    lengths = re.findall(r'zeros\((\d+)\)', program)
+    length = int(lengths[0]) if lengths else 0
+    return length, len(re.findall(r'playWave\(', program))
+
+
+class simDAQServer(object):
+    """ In-process ziDAQServer, see the module doc.
+    Args:
+        host, port, api_level: as ziDAQServer, not used
+        time_scale (float): scale of all latencies and of the
+            acquisition time, 0 for no waiting
+        directory (str): directory of awgModule (ELF files),
+            default is a temporary directory
+        seed: seed of the random shots
+    """
+
+    adc_fs = 1.8e9
+    # the qubit is excited with this probability in each shot
+    excited_probability = 0.3
+    # result of the excited state relative to the ground state
+    excited_factor = 0.6*np.exp(0.8j)
+    # standard deviation of the noise relative to the ground state
+    noise = 0.1
+
+    def __init__(self, host='localhost', port=8004, api_level=6,
+                 time_scale=1.0, directory=None, seed=None):
+        self.host = host
+        self.time_scale = time_scale
+        self.latency = dict(default_latency)
+        self.directory = directory or tempfile.mkdtemp(prefix='zisim_')
+        self.rng = np.random.default_rng(seed)
+        self._lock = threading.RLock()
+        self.nodes = {}
+        # [(wildcard path, value)] in the order of writing
+        self.patterns = []
+        # {path: vector}
+        self.vectors = {}
+        # {(device, awg_index): program}
+        self.programs = {}
+        self.devices = set()
+        self.subscribed = []
+        # {path: [(time when ready, vector)]}
+        self.pending = {}
+        # all sessions of the server, see session
+        self.sessions = [self]
+
+    def session(self):
+        """ another connection to the same server: the nodes, waveforms
+        and programs are shared, the subscriptions and polled data are
+        not.
+        """
+        with self._lock:
+            session = copy.copy(self)
+            session.subscribed = []
+            session.pending = {}
+            self.sessions.append(session)
+        return session
+
+    # -- timing
+    def wait(self, kind, per_sample_kind=None, samples=0):
+        delay = self.latency.get(kind, 0.0)
+        if per_sample_kind is not None:
+            delay += self.latency.get(per_sample_kind, 0.0)*samples
+        delay *= self.time_scale
+        if delay > 0:
+            time.sleep(delay)
+
+    # -- connection
+    def connectDevice(self, device, interface):
+        with self._lock:
+            self.devices.add(device.lower())
+
+    def disconnectDevice(self, device):
+        with self._lock:
+            self.devices.discard(device.lower())
+
+    def awgModule(self):
+        self.wait('awgModule')
+        return simAwgModule(self)
+
+    def sync(self):
+        self.wait('get')
+
+    # -- nodes
+    def _set(self, path, value):
+        path = path.lower()
+        _check_path(path)
+        with self._lock:
+            if '*' in path:
+                for p in fnmatch.filter(list(self.nodes), path):
+                    del self.nodes[p]
+                self.patterns.append((path, value))
+            else:
+                self.nodes[path] = value
+        self._on_set(path, value)
+
+    def _get(self, path, default=0):
+        path = path.lower()
+        _check_path(path)
+        with self._lock:
+            if path in self.nodes:
+                return self.nodes[path]
+            for pattern, value in reversed(self.patterns):
+                if fnmatch.fnmatch(path, pattern):
+                    return value
+        if path.endswith('system/clocks/sampleclock/freq'):
+            return 2.4e9
+        return default
+
+    def setInt(self, path, value):
+        self.wait('set')
+        self._set(path, int(value))
+
+    def syncSetInt(self, path, value):
+        self.wait('get')
+        self._set(path, int(value))
+        return int(value)
+
+    def setDouble(self, path, value):
+        self.wait('set')
+        self._set(path, float(value))
+
+    def setComplex(self, path, value):
+        self.wait('set')
+        self._set(path, complex(value))
+
+    def setString(self, path, value):
+        self.wait('set')
+        self._set(path, str(value))
+
+    def set(self, nodes):
+        self.wait('set')
+        for path, value in nodes:
+            self._set(path, value)
+
+    def getInt(self, path, *args):
+        self.wait('get')
+        return int(np.real(self._get(path)))
+
+    def getDouble(self, path, *args):
+        self.wait('get')
+        return float(np.real(self._get(path)))
+
+    def getComplex(self, path, *args):
+        self.wait('get')
+        return complex(self._get(path))
+
+    def getString(self, path, *args):
+        self.wait('get')
+        return str(self._get(path, ''))
+
+    def setVector(self, path, vector):
+        vector = np.array(vector)
+        self.wait('setVector', 'setVector_sample', len(vector))
+        path = path.lower()
+        with self._lock:
+            old = self.vectors.get(path)
+            if '/waveform/waves/' in path and (
+                    old is None or len(old) != len(vector)):
+                raise RuntimeError(
+                    'Waveform %s does not exist or length mismatch '
+                    '(%d != %s)' % (
+                        path, len(vector), None if old is None else len(old)))
+            self.vectors[path] = vector
+
+    def getList(self, path, *args):
+        self.wait('get')
+        path = path.lower()
+        with self._lock:
+            if path not in self.vectors:
+                return []
+            return [(path, [{'vector': self.vectors[path].copy()}])]
+
+    # -- sequencer
+    def load_program(self, device, awg_index, program):
+        """ new program: the waveform memory is reset by zeros
+        """
+        device = device.lower()
+        length, number_wave = parse_program(program)
+        prefix = '/%s/awgs/%d/waveform/waves/' % (device, awg_index)
+        with self._lock:
+            self.programs[(device, awg_index)] = program
+            for path in list(self.vectors):
+                if path.startswith(prefix):
+                    del self.vectors[path]
+            for k in range(number_wave):
+                self.vectors[prefix + str(k)] = np.zeros(
+                    2*length, dtype=np.uint16)
+
+    def _on_set(self, path, value):
+        """ start the acquisition of a QA if its sequencer is enabled
+        """
+        match = re.match(r'/(\w+)/awgs/0/enable$', path)
+        if match and value == 1 and self._get(
+                '/%s/qas/0/result/enable' % match.group(1)):
+            self._start_qa(match.group(1))
+
+    # -- acquisition
+    def _start_qa(self, device):
+        program = self.programs.get((device, 0))
+        if program is None:
+            return
+        length, number_wave = parse_program(program)
+        repetitions = re.findall(r'repeat \((\d+)\)', program)
+        if 'getUserReg(0)' in program:
+            shots = int(self._get('/%s/awgs/0/userregs/0' % device))
+            # the slot selected by user register 3, see get_QA_program
+            slot = int(self._get('/%s/awgs/0/userregs/3' % device))
+            entries = np.full(shots, slot if number_wave > 1 else 0)
+        else:
+            repetition = int(repetitions[0])
+            shots = repetition*number_wave
+            entries = np.arange(shots)//repetition
+        result_length = int(self._get('/%s/qas/0/result/length' % device))
+        averages = max(int(self._get(
+            '/%s/qas/0/result/averages' % device, 1)), 1)
+        # same loop as the sequencer of get_QA_program
+        fs = self.adc_fs/(int(self._get('/%s/awgs/0/time' % device))+1)
+        period = (length/fs
+                  + self._get('/%s/awgs/0/userregs/1' % device)/fs
+                  + 8*self._get('/%s/awgs/0/userregs/2' % device)/fs
+                  + 8*self._get('/%s/awgs/0/userregs/4' % device)/fs)
+        ready = time.perf_counter() + shots*period*self.time_scale
+
+        prefix = '/%s/qas/0/result/data/' % device
+        # the results are sent to every session subscribing them
+        for session in list(self.sessions):
+            for path in list(session.subscribed):
+                if not path.lower().startswith(prefix):
+                    continue
+                channel = int(path.lower()[len(prefix):].split('/')[0])
+                results = self.shot_results(device, channel, entries)
+                # results are averaged cyclically, result i of shots
+                # i, i+result_length, i+2*result_length, ...
+                n = result_length*averages
+                results = np.resize(results, n)
+                data = results.reshape(averages, result_length).mean(axis=0)
+                with self._lock:
+                    session.pending.setdefault(path, []).append((ready, data))
+
+    def shot_results(self, device, channel, entries):
+        """ integration results of the shots playing the readout
+        waveforms entries (array of the indices): the inputs are the
+        outputs (I, Q) of the QA, integrated with the weights of the
+        channel and rotated by the channel rotation.
+        """
+        entries = np.asarray(entries, dtype=int)
+        shots = len(entries)
+        node = '/%s/qas/0/integration/weights/%d/' % (device, channel)
+        w_real = self.vectors.get(node + 'real')
+        w_imag = self.vectors.get(node + 'imag')
+        waves = [
+            self.vectors.get('/%s/awgs/0/waveform/waves/%d' % (device, k))
+            for k in range(entries.max()+1 if shots else 0)]
+        if w_real is None or w_imag is None or any(
+                wave is None for wave in waves):
+            z = np.zeros(shots, dtype=complex)
+        else:
+            n = min(min(len(wave)//2 for wave in waves), len(w_real), int(
+                self._get('/%s/qas/0/integration/length' % device,
+                          len(w_real))))
+            # (entry, sample, I/Q)
+            signal = np.stack([
+                wave.view(np.int16).reshape(-1, 2)[:n] for wave in waves
+                ])/(2**15 - 1)
+            # one product for all the entries, then indexed by the shots
+            z = (signal[:, :, 0] @ w_real[:n]
+                 + 1j*(signal[:, :, 1] @ w_imag[:n]))[entries]
+        excited = self.rng.random(shots) < self.excited_probability
+        z = np.where(excited, z*self.excited_factor, z)
+        scale = np.maximum(np.abs(z), 1.0)*self.noise
+        z = z + scale*(self.rng.normal(size=shots)
+                       + 1j*self.rng.normal(size=shots))
+        rotation = complex(self._get(
+            '/%s/qas/0/rotations/%d' % (device, channel), 1))
+        return np.real(rotation*z)
+
+    def subscribe(self, paths):
+        if isinstance(paths, str):
+            paths = [paths]
+        with self._lock:
+            for p in paths:
+                if p not in self.subscribed:
+                    self.subscribed.append(p)
+
+    def unsubscribe(self, paths):
+        if isinstance(paths, str):
+            paths = [paths]
+        with self._lock:
+            self.subscribed = [p for p in self.subscribed if p not in paths]
+            for p in paths:
+                self.pending.pop(p, None)
+
+    def poll(self, length, timeout, flags=0, flat=True):
+        """ Returns: {path: [{'vector': data}]} of the results which
+        are ready after length (second)
+        """
+        if self.time_scale > 0:
+            time.sleep(length*self.time_scale)
+        now = time.perf_counter()
+        dataset = {}
+        with self._lock:
+            for path, chunks in self.pending.items():
+                ready = [data for t, data in chunks if t <= now]
+                if ready:
+                    dataset[path] = [{'vector': data} for data in ready]
+                self.pending[path] = [c for c in chunks if c[0] > now]
+        return dataset
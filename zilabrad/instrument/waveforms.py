@@ -11,9 +11,15 @@ from math import ceil, pi
 import math
 import inspect
 import functools
-from numba import jit
+try:
+    from numba import jit, types
+    from numba.typed import List
+except ImportError:
+    jit = None
 
+from zilabrad.pyle import envelopes
 from zilabrad.pyle.envelopes import Envelope, NOTHING
+from zilabrad.pyle.util.cache import LRUCache
 from zilabrad.util import singleton
 
 
@@ -149,7 +155,11 @@ class waveServer(object):
             return []
 
         interval = 1./fs
-        return func(np.arange(start, end, interval))
+        t = np.arange(start, end, interval)
+        if isinstance(func, Envelope):
+            # each pulse only on its own samples
+            return synthesize(func, t, fs)
+        return func(t)
 
     def func2array(self, func,
                    start: float = None,
@@ -173,51 +183,218 @@ class waveServer(object):
 # Envelope to define timefunction, which can be added, multiplied...
 
 
+def _square(t, amp, start, end):
+    return amp*(t < end)*(t >= start)
+
+
+def _cosine(t, amp, freq, phase, start, end):
+    return amp*np.cos(2*pi*freq*(t-start)+phase)*(t < end)*(t >= start)
+
+
+def _sine(t, amp, freq, phase, start, end):
+    return amp*np.sin(2*pi*freq*(t-start)+phase)*(t < end)*(t >= start)
+
+
+# samples of the carriers exp(2j*pi*freq*t) of pulses, shared by all the
+# pulses with the same frequency, length and offset to the sampling grid.
+# Used by Envelope.render and by synthesize (the compiled loop only for
+# the long pulses, see _carriers)
+pulse_cache = LRUCache(maxsize=None, maxbytes=64*2**20)
+
+
+def _carrier(freq, offset, n, fs):
+    carrier = np.exp(2j*pi*freq*(offset + np.arange(n)/fs))
+    carrier.flags.writeable = False
+    return carrier
+
+
+def _carrier_cached(freq, offset, n, fs):
+    # offset is rounded to 1e-6 sample, so that pulses starting on the
+    # same place of the grid share the samples
+    offset = round(offset*fs, 6)/fs
+    return pulse_cache.get(
+        (freq, offset, n, fs), _carrier, freq, offset, n, fs)
+
+
+def _square_samples(offset, n, fs, amp, start, end):
+    return np.full(n, amp)
+
+
+def _cosine_samples(offset, n, fs, amp, freq, phase, start, end):
+    carrier = _carrier_cached(freq, offset, n, fs)
+    # rotate by phase: amp*cos(x + phase)
+    return (amp*np.cos(phase))*carrier.real - (amp*np.sin(phase))*carrier.imag
+
+
+def _sine_samples(offset, n, fs, amp, freq, phase, start, end):
+    carrier = _carrier_cached(freq, offset, n, fs)
+    return (amp*np.sin(phase))*carrier.real + (amp*np.cos(phase))*carrier.imag
+
+
+envelopes.primitive('square', _square, windowed=True,
+                    samples=_square_samples)
+envelopes.primitive('cosine', _cosine, windowed=True,
+                    samples=_cosine_samples)
+envelopes.primitive('sine', _sine, windowed=True,
+                    samples=_sine_samples)
+
+
+# Synthesis of the square, sine and cosine terms of an envelope from a
+# table of pulses, one row (type, i0, i1, amp, freq, phase, offset) for
+# each pulse: type 0 is square, 1 is amp*cos(2*pi*freq*(t-start)+phase)
+# on the samples [i0, i1), t[i0]-start is offset.
+_SQUARE, _COSINE = 0, 1
+
+
+def pulse_table(terms, t):
+    """Table of the pulses of terms on the sorted array t, and the list
+    of the other terms (other kinds or complex scale).
+    """
+    rows = []
+    rest = []
+    for term in terms:
+        kind, params, scale, start, end = term
+        if kind not in ('square', 'cosine', 'sine') or np.iscomplexobj(scale):
+            rest.append(term)
+            continue
+        i0, i1 = np.searchsorted(t, (start, end))
+        if i1 <= i0:
+            continue
+        offset = t[i0] - start
+        if kind == 'square':
+            rows.append((_SQUARE, i0, i1, params[0]*scale, 0., 0., offset))
+        else:
+            amp, freq, phase = params[:3]
+            if kind == 'sine':
+                phase -= pi/2
+            rows.append((_COSINE, i0, i1, amp*scale, freq, phase, offset))
+    table = np.array(rows, dtype=np.float64).reshape(-1, 7)
+    return table, rest
+
+
+# pulses with fewer samples are computed by the compiled loop, reading
+# the carriers from pulse_cache costs about 10 us of Python per pulse
+_CACHED_LENGTH = 1024
+
+
+def _carriers(table, fs, min_length=0):
+    """Cached carriers of the cosine rows of table with at least
+    min_length samples.
+    Returns:
+        (index, carriers), carriers[index[row]] is the carrier of row,
+        index[row] is -1 for the other rows
+    """
+    length = table[:, 2] - table[:, 1]
+    rows = np.flatnonzero((table[:, 0] == _COSINE) & (length >= min_length))
+    index = np.full(len(table), -1, dtype=np.int64)
+    index[rows] = np.arange(len(rows))
+    carriers = [
+        _carrier_cached(table[row, 4], table[row, 6], int(length[row]), fs)
+        for row in rows]
+    return index, carriers
+
+
+def _synthesize_loop(table, index, carriers, out, fs):
+    for row in range(table.shape[0]):
+        i0 = int(table[row, 1])
+        i1 = int(table[row, 2])
+        amp = table[row, 3]
+        if table[row, 0] == _SQUARE:
+            for i in range(i0, i1):
+                out[i] += amp
+        elif index[row] >= 0:
+            # rotate the cached carrier by phase
+            carrier = carriers[index[row]]
+            a = amp*math.cos(table[row, 5])
+            b = amp*math.sin(table[row, 5])
+            for k in range(i1-i0):
+                out[i0+k] += a*carrier[k].real - b*carrier[k].imag
+        else:
+            w = 2*pi*table[row, 4]
+            phase = table[row, 5] + w*table[row, 6]
+            for i in range(i0, i1):
+                out[i] += amp*math.cos(w*(i-i0)/fs + phase)
+
+
+def _synthesize_numpy(table, out, fs):
+    index, carriers = _carriers(table, fs)
+    for row, (_type, i0, i1, amp, freq, phase, offset) in enumerate(table):
+        window = slice(int(i0), int(i1))
+        if _type == _SQUARE:
+            out[window] += amp
+        else:
+            carrier = carriers[index[row]]
+            out[window] += (amp*np.cos(phase))*carrier.real - (
+                amp*np.sin(phase))*carrier.imag
+
+
+if jit is not None:
+    # compiled at the first call, not cached in files next to the package
+    _synthesize_jit = jit(nopython=True)(_synthesize_loop)
+    _carrier_type = types.Array(types.complex128, 1, 'C', readonly=True)
+    # never changed, for the tables without long pulses
+    _no_carriers = List.empty_list(_carrier_type)
+
+    def _synthesize(table, out, fs):
+        index, carriers = _carriers(table, fs, _CACHED_LENGTH)
+        typed = _no_carriers
+        if carriers:
+            typed = List.empty_list(_carrier_type)
+            for carrier in carriers:
+                typed.append(carrier)
+        _synthesize_jit(table, index, typed, out, fs)
+else:
+    _synthesize = _synthesize_numpy
+
+
+def synthesize(env, t, fs, dtype=np.float32):
+    """Render the envelope on the grid t with sampling rate fs.
+
+    The square, sine and cosine pulses are added into one output of
+    dtype in a single pass (compiled by numba, if available), the other
+    terms are added by envelopes.renderTerms. The carriers of the long
+    pulses are read from pulse_cache, see _carriers.
+    """
+    t = np.asarray(t)
+    table, rest = pulse_table(env.terms, t)
+    out = np.zeros(len(t), dtype=dtype)
+    if len(table):
+        _synthesize(table, out, fs)
+    if rest:
+        out = envelopes.renderTerms(rest, t, fs, out=out)
+    return out
+
+
 @convertUnits(start='s', end='s', amp=None, length='s')
 def square(start=50e-9, end=None, amp=1.0, length=100e-9):
     if end is None:
         end = start + length
-    # @jit(nopython=True)
-
-    def timeFunc(t):
-        return amp*(t < end)*(t >= start)
-    envelopes = Envelope(timeFunc, None, start, end)
-    return envelopes
+    return Envelope.primitive('square', (amp, start, end), start, end)
 
 
 @convertUnits(start='s', end='s', freq='Hz', length='s')
 def sine(amp=0.1, phase=0.0, start=0, end=None, freq=10e6, length=100e-9):
     if end is None:
         end = start + length
-
-    def timeFunc(t): return amp*np.sin(2*pi*freq *
-                                       (t-start)+phase)*(t < end)*(t >= start)
-    envelopes = Envelope(timeFunc, None, start, end)
-    return envelopes
+    return Envelope.primitive(
+        'sine', (amp, freq, phase, start, end), start, end)
 
 
 @convertUnits(start='s', end='s', freq='Hz', length='s')
 def cosine(amp=0.1, phase=0.0, start=0, end=None, freq=10e6, length=100e-9):
     if end is None:
         end = start + length
-
-    def timeFunc(t): return amp*np.cos(2*pi*freq *
-                                       (t-start)+phase)*(t < end)*(t >= start)
-    envelopes = Envelope(timeFunc, None, start, end)
-    return envelopes
+    return Envelope.primitive(
+        'cosine', (amp, freq, phase, start, end), start, end)
 
 
 @convertUnits(start='s', end='s', freq='Hz', length='s')
 def readout(amp=0.1, phase=0.0, start=0, end=None, freq=10e6, length=100e-9):
     if end is None:
         end = start + length
-
-    def timeFunc1(t): return amp*np.cos(2*pi*freq *
-                                        (t-start)+phase)*(t < end)*(t >= start)
-    env1 = Envelope(timeFunc1, None, start, end)
-    def timeFunc2(t): return amp*np.sin(2*pi*freq *
-                                        (t-start)+phase)*(t < end)*(t >= start)
-    env2 = Envelope(timeFunc2, None, start, end)
+    params = (amp, freq, phase, start, end)
+    env1 = Envelope.primitive('cosine', params, start, end)
+    env2 = Envelope.primitive('sine', params, start, end)
     return env1, env2
 
 # Collection of Array timeFunc, which returns an array
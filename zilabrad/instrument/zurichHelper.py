@@ -4,11 +4,18 @@ import enum
 import zhinst.utils  # create API object
 import numpy as np
 from numpy import pi
-from functools import wraps
+from functools import wraps, lru_cache
+from contextlib import contextmanager
 import logging
 import os
+import hashlib
+import fnmatch
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 from zilabrad.util import singleton, singletonMany
+from zilabrad import timing
 from zilabrad.instrument.waveforms import convertUnits
 
 
@@ -28,11 +35,34 @@ def create_logger(name, filename):
 logger = create_logger(__name__, __name__)
 
 
+def get_slot_strings(number_port, wave_length, number_slot, register):
+    """ wave definitions and play statement of a program with
+    number_slot wave sets, the slot played is given by the user
+    register, the waves of slot k are uploaded into waves/k.
+    Returns:
+        (define string, play statement)
+    """
+    define_str = "".join(
+        f"wave w{i+1}_{k} = zeros({wave_length});\n"
+        for k in range(number_slot) for i in range(number_port))
+    cases = "".join(
+        "case %d:\n    playWave(%s);\n" % (k, ",".join(
+            f"{i+1},w{i+1}_{k}" for i in range(number_port)))
+        for k in range(number_slot))
+    play_str = "switch (getUserReg(%d)) {\n%s}" % (register, cases)
+    return define_str, play_str
+
+
 def get_QA_program(
-        sample_rate, number_port, wave_length, *args, **kwargs):
+        sample_rate, number_port, wave_length, *args,
+        wait_trigger=False, number_slot=1, **kwargs):
     """awg program for labone
     Example:
     awg_program = get_QA_program(sample_rate=int(1.8e9), number_port=2)
+    wait_trigger: wait for the trigger of the master QA in each repetition,
+    for the other QAs in an experiment with several QAs.
+    number_slot: number of wave sets, the one played is given by
+    user register 3, see get_slot_strings.
     """
     wave_define_string = ""
     wave_play_string = ""
@@ -42,6 +72,10 @@ def get_QA_program(
         wave_play_string += (',' + str(i+1) + ',w'+str(i+1))
     wave_play_string = wave_play_string[1:]
     # delect the first comma
+    wave_play_string = "playWave(" + wave_play_string + ");"
+    if number_slot > 1:
+        wave_define_string, wave_play_string = get_slot_strings(
+            number_port, wave_length, number_slot, register=3)
 
     awg_program = textwrap.dedent("""\
 const f_s = $sample_rate;
@@ -49,11 +83,12 @@ $wave_define_string
 setTrigger(AWG_INTEGRATION_ARM);// initialize integration
 setTrigger(0b000);
 repeat (getUserReg(0)) {  // = qa.result_samples
-        // waitDigTrigger(1,1);
+        $wait_trigger_string
         setTrigger(0b11); // trigger output: rise
         wait(5); // trigger length: 22.2 ns / 40 samples
         setTrigger(0b00); // trigger output: fall
-        playWave($wave_play_string);
+        wait(getUserReg(4)); // adc trig delay -> qa pulse start
+        $wave_play_string
         wait(getUserReg(1)); // demod wait time -> qa demod start
         setTrigger(AWG_INTEGRATION_ARM + AWG_INTEGRATION_TRIGGER + \
 AWG_MONITOR_TRIGGER);// start demodulate
@@ -68,12 +103,21 @@ AWG_MONITOR_TRIGGER);// start demodulate
         '$wave_define_string', wave_define_string)
     awg_program = awg_program.replace(
         '$wave_play_string', wave_play_string)
+    if wait_trigger:
+        wait_trigger_string = 'waitDigTrigger(1,1);'
+    else:
+        wait_trigger_string = '// waitDigTrigger(1,1);'
+    awg_program = awg_program.replace(
+        '$wait_trigger_string', wait_trigger_string)
     return awg_program
 
 
 def get_HD_program(
-        sample_rate: int, number_port: int, wave_length: int, loop=False):
+        sample_rate: int, number_port: int, wave_length: int, loop=False,
+        number_slot=1):
     """
+    number_slot: number of wave sets, the one played is given by
+    user register 0, see get_slot_strings.
     Return (str):
         awg program for labone
     """
@@ -89,12 +133,17 @@ const f_s = {FS};
 {define_str}
 while(1){"{"}
 {trigger_str}
-playWave({play_str});
+{play_str}
 waitWave();
 {"}"}
 """)
         return program
 
+    if number_slot > 1:
+        wave_define_str, wave_play_str = get_slot_strings(
+            number_port, wave_length, number_slot, register=0)
+        return raw_program(sample_rate, wave_define_str, wave_play_str, loop)
+
     def wave_define_func(idx):
         return f'wave w{idx} = zeros({wave_length});\n'
 
@@ -108,13 +157,132 @@ waitWave();
     )
     # remove last comma ","
     wave_play_list[-1] = wave_play_list[-1][:-1]
-    wave_play_str = "".join(wave_play_list)
+    wave_play_str = "playWave(" + "".join(wave_play_list) + ");"
 
     awg_program = raw_program(
         sample_rate, wave_define_str, wave_play_str, loop)
     return awg_program
 
 
+def get_QA_table_program(
+        sample_rate, number_port, wave_length, number_wave, repetition):
+    """awg program for labone, which plays a table of waveforms,
+    each one is repeated (repetition) times.
+    The waveform of table entry k is uploaded into waves/k,
+    indices follow the order of playWave in the program.
+    Example:
+    awg_program = get_QA_table_program(
+        sample_rate=int(1.8e9), number_port=2, wave_length=3600,
+        number_wave=20, repetition=1024)
+    """
+    def wave_define_func(k):
+        return "".join(
+            f"wave w{i+1}_{k} = zeros({wave_length});\n"
+            for i in range(number_port))
+
+    def wave_play_func(k):
+        play_str = ",".join(
+            f"{i+1},w{i+1}_{k}" for i in range(number_port))
+        return textwrap.dedent(f"""\
+repeat ({repetition}) {"{"}  // table entry {k}
+        setTrigger(0b11); // trigger output: rise
+        wait(5); // trigger length: 22.2 ns / 40 samples
+        setTrigger(0b00); // trigger output: fall
+        wait(getUserReg(4)); // adc trig delay -> qa pulse start
+        playWave({play_str});
+        wait(getUserReg(1)); // demod wait time -> qa demod start
+        setTrigger(AWG_INTEGRATION_ARM + AWG_INTEGRATION_TRIGGER + \
+AWG_MONITOR_TRIGGER);// start demodulate
+        setTrigger(AWG_INTEGRATION_ARM);// reset intergration
+        waitWave();
+        wait(getUserReg(2)); // wait relaxation (default 200us)
+{"}"}
+""")
+
+    wave_define_str = "".join(map(wave_define_func, range(number_wave)))
+    wave_play_str = "".join(map(wave_play_func, range(number_wave)))
+    awg_program = textwrap.dedent(f"""\
+const f_s = {sample_rate};
+{wave_define_str}
+setTrigger(AWG_INTEGRATION_ARM);// initialize integration
+setTrigger(0b000);
+{wave_play_str}
+""")
+    return awg_program
+
+
+def get_HD_table_program(
+        sample_rate, number_port, wave_length, number_wave, repetition):
+    """
+    awg program for labone, which plays a table of waveforms,
+    each one is repeated (repetition) times after the trigger of QA.
+    The waveform of table entry k is uploaded into waves/k.
+    Return (str):
+        awg program for labone
+    """
+    def wave_define_func(k):
+        return "".join(
+            f"wave w{i+1}_{k} = zeros({wave_length});\n"
+            for i in range(number_port))
+
+    def wave_play_func(k):
+        play_str = ",".join(
+            f"{i+1},w{i+1}_{k}" for i in range(number_port))
+        return textwrap.dedent(f"""\
+repeat ({repetition}) {"{"}  // table entry {k}
+waitDigTrigger(1);
+playWave({play_str});
+waitWave();
+{"}"}
+""")
+
+    wave_define_str = "".join(map(wave_define_func, range(number_wave)))
+    wave_play_str = "".join(map(wave_play_func, range(number_wave)))
+    awg_program = textwrap.dedent(f"""\
+const f_s = {sample_rate};
+{wave_define_str}
+{wave_play_str}
+""")
+    return awg_program
+
+
+def bucket_length(wave_length, granularity=16, ratio=1.25):
+    """ length of the sequencer for waveforms of wave_length samples,
+    rounded up to geometric buckets (ratio) of granularity samples, so
+    that a slowly growing waveform does not compile the sequencer at
+    every step.
+    Example:
+        bucket_length(1000) == bucket_length(1100) == 1120
+    """
+    n = max(int(np.ceil(wave_length/granularity)), 1)
+    # smallest power of ratio, not less than n
+    bucket = ratio**np.ceil(np.log(n)/np.log(ratio) - 1e-9)
+    return int(max(np.ceil(bucket - 1e-9), n))*granularity
+
+
+@lru_cache(maxsize=64)
+def integration_weights(freq, length, fs=1.8e9):
+    """ cos and sin integration weights of the demodulation frequency
+    freq (Hz), for an integration of length samples at rate fs.
+    The arrays are cached and read-only.
+    """
+    phase = np.arange(length)*(2*pi*freq/fs)
+    w_real, w_imag = np.cos(phase), np.sin(phase)
+    w_real.flags.writeable = False
+    w_imag.flags.writeable = False
+    return w_real, w_imag
+
+
+def pad_native(waveform_native, wave_length):
+    """fill zeros at the end of a native waveform (two waves)
+    to get wave_length samples for each wave.
+    """
+    _n_ = wave_length - len(waveform_native)//2
+    if _n_ == 0:
+        return waveform_native
+    return np.hstack((waveform_native, np.zeros(2*_n_, dtype=np.uint16)))
+
+
 def convert_awg_waveform(wave_list):
     """
     Converts one or multiple arrays with waveform data to the native AWG
@@ -129,14 +297,555 @@ def convert_awg_waveform(wave_list):
       The converted uint16 waveform is returned.
     NOTE: waveform reload needs each two channel one by one.
     """
-    def uint16_waveform(wave):  # Prepare waveforms
-        wave = np.asarray(wave)
-        if np.issubdtype(wave.dtype, np.floating):
-            return np.asarray((np.power(2, 15) - 1) * wave, dtype=np.uint16)
-        return np.asarray(wave, dtype=np.uint16)
+    buffer = np.empty((len(wave_list[0]), 2), dtype=np.int16)
+    for i in [0, 1]:
+        wave = np.asarray(wave_list[i])
+        if np.issubdtype(wave.dtype, np.integer):
+            nativeBuffer.write_codes(buffer, i, wave)
+        else:
+            nativeBuffer.write(buffer, i, wave)
+    return nativeBuffer.native(buffer)
+
+
+class nativeBuffer(object):
+    """ Preallocated waveforms in the native AWG format: two waves
+    interleaved as int16, array of shape (length, 2), so that the
+    waves are rendered into the columns and the flattened array is
+    uploaded without conversion.
+
+    The buffers are used in turn (depth), since a buffer can still be
+    uploading when the next waveform is rendered.
+
+    Waves out of range are saturated, the number of clipped samples is
+    counted in nativeBuffer.clipped (and logged if clip_warning).
+    """
+    amplitude = 2**15 - 1
+    clipped = 0
+    clip_warning = True
+
+    def __init__(self, depth=3):
+        self.ring = [None]*depth
+        self.index = 0
+
+    def get(self, length):
+        """ next buffer of length samples for each wave, filled with zeros
+        """
+        self.index = (self.index + 1) % len(self.ring)
+        buffer = self.ring[self.index]
+        if buffer is None or len(buffer) != length:
+            buffer = np.zeros((length, 2), dtype=np.int16)
+            self.ring[self.index] = buffer
+        else:
+            buffer.fill(0)
+        return buffer
+
+    @classmethod
+    def write(cls, buffer, column, wave):
+        """ write a wave (range -1 to 1) into a column of the buffer
+        """
+        codes = np.multiply(np.real(wave), cls.amplitude, dtype=np.float32)
+        cls._saturate(codes, -cls.amplitude, cls.amplitude)
+        # float32 to int16 truncates like before
+        buffer[:len(codes), column] = codes
+
+    @classmethod
+    def write_codes(cls, buffer, column, codes):
+        """ write a wave of integer DAC codes (int16 or uint16 of the
+        negative codes) into a column of the buffer
+        """
+        codes = np.asarray(codes)
+        if codes.dtype == np.uint16:
+            codes = codes.view(np.int16)
+        elif codes.dtype != np.int16:
+            codes = codes.copy()
+            cls._saturate(codes, -2**15, 2**15 - 1)
+        buffer[:len(codes), column] = codes
+
+    @classmethod
+    def _saturate(cls, codes, low, high):
+        if not len(codes) or low <= codes.min() and codes.max() <= high:
+            return
+        n = np.count_nonzero((codes < low) | (codes > high))
+        np.clip(codes, low, high, out=codes)
+        cls.clipped += n
+        if cls.clip_warning:
+            logger.warning('%d samples of a waveform are clipped' % n)
+
+    @staticmethod
+    def native(buffer):
+        """ view of the buffer as native waveform (uint16), no copy
+        """
+        return buffer.reshape(-1).view(np.uint16)
+
+
+_ProgramInfo = namedtuple("ProgramInfo", ["hits", "misses", "currsize"])
+
+
+@singleton
+class programCache(object):
+    """ Compiled sequencer programs (ELF files), keyed by the hash of
+    the device type and the program text.
+
+    The ELF files are kept in the elf directory of awgModule
+    (awgModule/directory/awg/elf) with the name zilabrad_<hash>.elf,
+    so that they are reused by later sessions. A cached program is
+    uploaded directly without compiling.
+    """
+
+    prefix = 'zilabrad_'
+
+    def __init__(self):
+        # {key: path of ELF file}
+        self.files = {}
+        self.hits = self.misses = 0
+        # upload may be called by several compiling threads
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(awg_program, device_type):
+        text = '%s\n%s' % (device_type, awg_program)
+        return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+    @staticmethod
+    def _wait(awgModule, path, busy):
+        while awgModule.getInt(path) in busy:
+            time.sleep(0.01)
+
+    def upload(self, awgModule, awg_program, device_type):
+        """ upload the program by awgModule (device and index are set),
+        from the ELF file if it is cached, else compile it.
+        """
+        key = self.key(awg_program, device_type)
+        elf_name = self.prefix + key + '.elf'
+        elf_path = os.path.join(
+            awgModule.getString('awgModule/directory'), 'awg', 'elf',
+            elf_name)
+        if key in self.files or os.path.isfile(elf_path):
+            if self._upload_elf(awgModule, elf_name):
+                with self._lock:
+                    self.hits += 1
+                    self.files[key] = elf_path
+                return
+            logger.warning('Failed to upload %s, compile again' % elf_name)
+        with self._lock:
+            self.misses += 1
+        self._compile(awgModule, awg_program, elf_name)
+        with self._lock:
+            self.files[key] = elf_path
+
+    def _upload_elf(self, awgModule, elf_name):
+        """ Returns: True if successful
+        """
+        awgModule.set('awgModule/elf/file', elf_name)
+        awgModule.set('awgModule/elf/upload', 1)
+        self._wait(awgModule, 'awgModule/elf/upload', busy=[1])
+        # elf/status: 0 success, 1 failure, 2 busy
+        self._wait(awgModule, 'awgModule/elf/status', busy=[2])
+        return awgModule.getInt('awgModule/elf/status') == 0
+
+    def _compile(self, awgModule, awg_program, elf_name):
+        # the compiled program is saved as elf_name
+        awgModule.set('awgModule/elf/file', elf_name)
+        awgModule.set('awgModule/compiler/sourcestring', awg_program)
+        self._wait(awgModule, 'awgModule/compiler/status', busy=[-1])
+        # Ensure that compilation was successful
+        status = awgModule.getInt('awgModule/compiler/status')
+        if status == 1:
+            # compilation failed, raise an exception
+            raise Exception(awgModule.getString(
+                'awgModule/compiler/statusstring'))
+        if status == 2:
+            logger.warning(
+                "Compilation successful with warnings, \
+                will upload the program to the instrument.")
+            logger.warning("Compiler warning: %s" % awgModule.getString(
+                'awgModule/compiler/statusstring'))
+        # wait for waveform upload to finish
+        while awgModule.getDouble('awgModule/progress') < 1.0:
+            time.sleep(0.01)
+
+    def info(self):
+        return _ProgramInfo(self.hits, self.misses, len(self.files))
+
+    def clear(self):
+        """ forget the programs, the ELF files are not deleted
+        """
+        self.files.clear()
+        self.hits = self.misses = 0
+
+
+_UploadInfo = namedtuple("UploadInfo", ["hits", "misses", "currsize"])
+
+
+class uploadCache(object):
+    """ Digest of the last uploaded native waveform for each
+    (awg_index, index) of one device, so that uploading the same
+    waveform again can be skipped.
+
+    The waveform memory of the device is reset when the sequencer
+    is compiled (or changed outside of this code), call invalidate()
+    in that case. The cores of a device may be uploaded by several
+    threads, see qubitServer.uploadParallel.
+    """
+
+    def __init__(self):
+        self.digests = {}
+        self.hits = self.misses = 0
+        # {key: time of the last use}, see find
+        self.used = {}
+        self._clock = 0
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def digest(waveform_native):
+        data = np.ascontiguousarray(waveform_native)
+        return hashlib.blake2b(data, digest_size=16).digest()
+
+    def is_uploaded(self, key, digest):
+        """ return True if the waveform (digest) is already in key,
+        or remove key since the upload is going to change it.
+        """
+        with self._lock:
+            if self.digests.get(key) == digest:
+                self.hits += 1
+                self._touch(key)
+                return True
+            self.misses += 1
+            self.digests.pop(key, None)
+            return False
+
+    def update(self, key, digest):
+        with self._lock:
+            self.digests[key] = digest
+            self._touch(key)
+
+    def _touch(self, key):
+        self._clock += 1
+        self.used[key] = self._clock
+
+    def find(self, awg_index, digest, number_slot):
+        """ slot (index) of the waveform (digest) among the indices
+        0...number_slot-1 of awg_index, or the least recently used
+        index to upload it.
+        Returns:
+            (index, True if the waveform is already there)
+        """
+        with self._lock:
+            for index in range(number_slot):
+                if self.digests.get((awg_index, index)) == digest:
+                    return index, True
+            index = min(
+                range(number_slot),
+                key=lambda index: self.used.get((awg_index, index), 0))
+            return index, False
+
+    def invalidate(self, awg_index=None):
+        """forget the uploaded waveforms of awg_index (all if None)
+        """
+        with self._lock:
+            if awg_index is None:
+                self.digests.clear()
+                self.used.clear()
+                return
+            for key in list(self.digests):
+                if key[0] == awg_index:
+                    del self.digests[key]
+            for key in list(self.used):
+                if key[0] == awg_index:
+                    del self.used[key]
+
+    def info(self):
+        """Report cache statistics"""
+        with self._lock:
+            return _UploadInfo(self.hits, self.misses, len(self.digests))
+
+    def clear(self):
+        """Clear the digests and statistics"""
+        with self._lock:
+            self.digests.clear()
+            self.used.clear()
+            self.hits = self.misses = 0
+
+
+_PoolInfo = namedtuple("PoolInfo", ["created", "reused", "currsize"])
+
+
+class awgModulePool(object):
+    """ Long-lived awgModule for each (device, awg_index), owned by
+    ziDAQ. Creating an awgModule takes about 0.2 s, so it is created
+    and started (execute) only once and reused by later compiles.
+
+    compile_async compiles in a worker thread and returns a Future,
+    different cores can then compile in parallel. The compiles of
+    the same core are serialized by the lock of its module.
+    """
+
+    def __init__(self, daq, max_workers=4):
+        self.daq = daq
+        self.max_workers = max_workers
+        # {(device_id, awg_index): (awgModule, lock)}
+        self.modules = {}
+        self.created = self.reused = 0
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def get(self, device_id, awg_index=0):
+        """ Returns: (awgModule, lock) of the core, created if needed
+        """
+        key = (device_id, awg_index)
+        with self._lock:
+            if key in self.modules:
+                self.reused += 1
+                return self.modules[key]
+            awgModule = self.daq.awgModule()
+            awgModule.set('awgModule/device', device_id)
+            awgModule.set('awgModule/index', awg_index)
+            awgModule.execute()  # Starts the awgModule thread
+            self.modules[key] = (awgModule, threading.Lock())
+            self.created += 1
+            return self.modules[key]
+
+    def compile(self, device_id, awg_index, awg_program, device_type):
+        """ compile (or load from programCache) and upload the program,
+        blocks until it is done.
+        """
+        awgModule, lock = self.get(device_id, awg_index)
+        with lock:
+            programCache().upload(awgModule, awg_program, device_type)
+
+    def compile_async(self, device_id, awg_index, awg_program, device_type):
+        """ Returns: concurrent.futures.Future of compile
+        """
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers)
+            executor = self._executor
+        return executor.submit(
+            self.compile, device_id, awg_index, awg_program, device_type)
+
+    def release(self, device_id=None):
+        """ stop and remove the modules of device_id (all if None)
+        """
+        with self._lock:
+            keys = [key for key in self.modules
+                    if device_id is None or key[0] == device_id]
+            modules = [self.modules.pop(key) for key in keys]
+            if device_id is None and self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+        for awgModule, lock in modules:
+            with lock:
+                try:
+                    awgModule.finish()
+                    awgModule.clear()
+                except Exception as e:
+                    logger.warning('Failed to clear awgModule: %s' % e)
+
+    def info(self):
+        return _PoolInfo(self.created, self.reused, len(self.modules))
+
+
+class nodeBatch(object):
+    """ Collects the node writes (setInt, setDouble, setComplex) of a
+    daq and sends them in one daq.set, see zurich_qa.transaction.
+    A node written several times is sent once with the last value.
+    Any other call (getInt, setVector, sync ...) sends the collected
+    writes first, so that the order of node accesses is kept.
+    """
+
+    def __init__(self, daq):
+        self.daq = daq
+        # {lower case path: (path, value)}
+        self.nodes = {}
+
+    def setInt(self, path, value):
+        self._add(path, int(value))
+
+    def setDouble(self, path, value):
+        self._add(path, float(value))
+
+    def setComplex(self, path, value):
+        self._add(path, complex(value))
+
+    def _add(self, path, value):
+        key = path.lower()
+        # move the node to the end, as if it was written now
+        self.nodes.pop(key, None)
+        self.nodes[key] = (path, value)
+
+    def discard(self):
+        """forget the collected writes without sending them
+        """
+        self.nodes.clear()
+
+    def flush(self):
+        if len(self.nodes) == 0:
+            return
+        nodes = list(self.nodes.values())
+        self.nodes.clear()
+        self.daq.set(nodes)
+
+    def __getattr__(self, name):
+        self.flush()
+        return getattr(self.daq, name)
+
+
+_ShadowInfo = namedtuple("ShadowInfo", ["hits", "misses", "currsize"])
+
+
+class nodeShadow(object):
+    """ Last written value of each node of one device, so that
+    writing the same value again can be skipped, see shadowDAQ.
+
+    Nodes which are changed by the device itself (enable, reset ...)
+    are not kept. Call invalidate() when the device may have been
+    changed outside of this code (refresh_api, reconnect, LabOne UI).
+
+    verify: debug mode, read back the skipped nodes by daq.get and
+    write them again if the value is different.
+    """
+
+    verify = False
+    volatile = ('enable', 'reset', 'upload', 'sync')
+
+    def __init__(self):
+        self.values = {}
+        self.hits = self.misses = 0
+        # the nodes may be written by several upload threads
+        self._lock = threading.RLock()
+
+    def is_volatile(self, path):
+        return path.rstrip('/').rsplit('/', 1)[-1] in self.volatile
+
+    def is_written(self, path, value):
+        """ Returns: True if value is the last written value of path
+        """
+        with self._lock:
+            if self.values.get(path, None) == value:
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def update(self, path, value):
+        with self._lock:
+            if '*' in path:
+                # the nodes matching the wildcard are changed
+                self.invalidate(path)
+            elif not self.is_volatile(path):
+                self.values[path] = value
+
+    def invalidate(self, pattern=None):
+        """forget the nodes matching pattern (all if None)
+        """
+        with self._lock:
+            if pattern is None:
+                self.values.clear()
+                return
+            for path in fnmatch.filter(list(self.values), pattern):
+                del self.values[path]
+
+    def info(self):
+        with self._lock:
+            return _ShadowInfo(self.hits, self.misses, len(self.values))
+
+
+class shadowDAQ(object):
+    """ ziDAQServer with the node writes (setInt, setDouble, setComplex
+    and set) checked against the nodeShadow of the device, given by
+    the path /<device>/... . Devices without shadow, and all the other
+    methods, go directly to the daq.
+    A ziDAQServer can not be used by several threads at the same time,
+    the calls are serialized by lock (e.g. the polls of a background
+    acquisition and the node writes of the calling thread).
+    """
 
-    data_tuple = (uint16_waveform(wave_list[0]), uint16_waveform(wave_list[1]))
-    return np.vstack(data_tuple).reshape((-2,), order='F')
+    def __init__(self, daq, shadows):
+        self.daq = daq
+        # {device id: nodeShadow}
+        self.shadows = shadows
+        self.lock = threading.RLock()
+
+    def _shadow(self, path):
+        return self.shadows.get(path.lstrip('/').split('/', 1)[0])
+
+    def _skip(self, path, value):
+        """ Returns: (shadow, True if the write can be skipped)
+        """
+        path = path.lower()
+        shadow = self._shadow(path)
+        if shadow is None or '*' in path or shadow.is_volatile(path):
+            return shadow, False
+        if not shadow.is_written(path, value):
+            return shadow, False
+        if shadow.verify and not self._verify(path, value):
+            return shadow, False
+        return shadow, True
+
+    def _verify(self, path, value):
+        if isinstance(value, complex):
+            device_value = self.daq.getComplex(path)
+        else:
+            device_value = self.daq.getDouble(path)
+        if np.isclose(device_value, value):
+            return True
+        logger.warning('Node shadow of %s is %r, device %r' % (
+            path, value, device_value))
+        return False
+
+    def _write(self, method, path, value):
+        with self.lock:
+            shadow, skip = self._skip(path, value)
+            if skip:
+                return
+            method(path, value)
+            if shadow is not None:
+                shadow.update(path.lower(), value)
+
+    def setInt(self, path, value):
+        self._write(self.daq.setInt, path, value)
+
+    def setDouble(self, path, value):
+        self._write(self.daq.setDouble, path, value)
+
+    def setComplex(self, path, value):
+        self._write(self.daq.setComplex, path, value)
+
+    def set(self, nodes):
+        """ nodes: list of (path, value), see nodeBatch
+        """
+        with self.lock:
+            nodes = [(path, value) for path, value in nodes
+                     if not self._skip(path, value)[1]]
+            if len(nodes) == 0:
+                return
+            self.daq.set(nodes)
+            for path, value in nodes:
+                shadow = self._shadow(path.lower())
+                if shadow is not None:
+                    shadow.update(path.lower(), value)
+
+    def __getattr__(self, name):
+        attr = getattr(self.daq, name)
+        if not callable(attr):
+            return attr
+
+        @wraps(attr)
+        def locked(*args, **kwargs):
+            with self.lock:
+                return attr(*args, **kwargs)
+        return locked
+
+
+def batched(func):
+    """ decorator, run the method of device in one transaction
+    """
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with self.transaction():
+            return func(self, *args, **kwargs)
+    return wrapper
 
 
 class qaSource(enum.Enum):
@@ -158,19 +867,70 @@ class qaSource(enum.Enum):
 @singleton
 class ziDAQ(object):
     """singleton class for zurich daq
+    simulate: use the simulated data server in process, without
+    devices, see zilabrad.instrument.simulator. It must be given in
+    the first call, before the devices are created. A dict is passed
+    to simDAQServer, e.g. simulate={'time_scale': 0}.
+
+    Each device has its own connection (session) to the data server,
+    so that different devices can be used from different threads,
+    see qubitServer.uploadParallel. daq is the shared connection of
+    the awgModules.
     """
-    def __init__(self,labone_ip='localhost'):
-        # connectivity must 8004 for zurish instruments
-        self.daq = zhinst.ziPython.ziDAQServer(labone_ip,8004,6)
+    def __init__(self,labone_ip='localhost',simulate=False):
+        self.simulate = simulate
+        self.labone_ip = labone_ip
+        # the simulated data server of all sessions
+        self._simulated = None
+        # {device id: nodeShadow}, see shadowDAQ
+        self.shadows = {}
+        # {device id: shadowDAQ}, see session
+        self.sessions = {}
+        self.daq = shadowDAQ(self._server(labone_ip), self.shadows)
+        self.awg_pool = awgModulePool(self.daq)
         self.secret_mode(mode=1) ## (default) daq can be used by everyone.
 
+    def shadow(self, device_id):
+        """ Returns: nodeShadow of the device
+        """
+        return self.shadows.setdefault(device_id.lower(), nodeShadow())
+
+    def session(self, device_id):
+        """ Returns: shadowDAQ of the connection of the device,
+        created at the first call
+        """
+        key = device_id.lower()
+        if key not in self.sessions:
+            self.sessions[key] = shadowDAQ(
+                self._server(self.labone_ip), self.shadows)
+        return self.sessions[key]
+
     def secret_mode(self, mode=1):
         # mode = 1: daq can be created by everyone
         # mode = 0: daq only be used by localhost
         self.daq.setInt('/zi/config/open', mode)
 
     def refresh_api(self,labone_ip):
-        self.daq = zhinst.ziPython.ziDAQServer(labone_ip,8004,6)
+        # the modules belong to the old connection
+        self.awg_pool.release()
+        for shadow in self.shadows.values():
+            shadow.invalidate()
+        self.labone_ip = labone_ip
+        # the devices get new sessions by their refresh_api
+        self.sessions.clear()
+        self.daq = shadowDAQ(self._server(labone_ip), self.shadows)
+        self.awg_pool = awgModulePool(self.daq)
+
+    def _server(self, labone_ip):
+        if self.simulate:
+            if self._simulated is not None:
+                return self._simulated.session()
+            from zilabrad.instrument.simulator import simDAQServer
+            kwargs = self.simulate if isinstance(self.simulate, dict) else {}
+            self._simulated = simDAQServer(labone_ip,8004,6,**kwargs)
+            return self._simulated
+        # connectivity must 8004 for zurish instruments
+        return zhinst.ziPython.ziDAQServer(labone_ip,8004,6)
 
 
 @singletonMany
@@ -186,13 +946,22 @@ class zurich_qa(object):
     and their obj_name (key) that has been created
     """
 
+    device_type = 'UHFQA'
+
     def __init__(self, obj_name='qa_1', device_id='dev2592',
                  labone_ip='localhost'):
         self.obj_name = obj_name
         self.id = device_id
+        self.upload_cache = uploadCache()
         try:
             logger.info("\nBring up %s in %s" % (self.id, labone_ip))
-            self.daq = ziDAQ(labone_ip=labone_ip).daq
+            # the connection of the device, daq is replaced by a
+            # nodeBatch of it in transactions, see transaction
+            self.session = ziDAQ(labone_ip=labone_ip).session(self.id)
+            self.daq = self.session
+            self.awg_pool = ziDAQ().awg_pool
+            # last written node values, see shadowDAQ
+            self.shadow = ziDAQ().shadow(self.id)
             self.connect()
             logger.info(self.daq)
             self.FS = 1.8e9 / \
@@ -205,27 +974,84 @@ class zurich_qa(object):
 
     # -- set device status
     def connect(self):
+        self.shadow.invalidate()
         self.daq.connectDevice(self.id, '1gbe')
 
     def disconnect(self):
+        self.release()
         self.daq.disconnectDevice(self.id)
 
-    def refresh_api(self,labone_ip='localhost'):
-        self.daq = ziDAQ(labone_ip=labone_ip).daq
+    def release(self):
+        """ stop the awgModules of this device, see clear_singletonMany
+        """
+        self.awg_pool.release(self.id)
 
+    def refresh_api(self,labone_ip='localhost'):
+        self.release()
+        self.session = ziDAQ(labone_ip=labone_ip).session(self.id)
+        self.daq = self.session
+        self.awg_pool = ziDAQ().awg_pool
+        self.shadow.invalidate()
+        self.upload_cache.invalidate()
+        self.uploaded_integration = [None, {}]
+
+    @contextmanager
+    def transaction(self):
+        """ node writes in the with-statement are sent in one daq.set
+        when it exits, or dropped if it exits by an exception (writes
+        before any read of nodes are already sent), see nodeBatch:
+            with qa.transaction():
+                qa.port_range(1.5)
+                qa.set_qaSource_mode()
+        """
+        if isinstance(self.daq, nodeBatch):
+            # nested transaction
+            yield self.daq
+            return
+        batch = nodeBatch(self.daq)
+        self.daq = batch
+        try:
+            yield batch
+        except BaseException:
+            # incomplete settings are not sent
+            batch.discard()
+            raise
+        finally:
+            self.daq = batch.daq
+        batch.flush()
+
+    @batched
     def init_setup(self):
         """ initialize device settings.
         """
         self.average = 1  # default 1, no average in device
         self.result_samples = 1024
+        # wait for the trigger of the master QA, see set_wait_trigger
+        self.wait_trigger = False
         self.qubit_frequency = []  # all demodulate frequency; unit: Hz
         self.paths = []  # save result path, equal to channel number
         # qa pulse length in AWGs; unit: sample number
         self.waveform_length = 0
+        # (number_wave, wave_length, repetition) of the table program,
+        # None for the program with one waveform
+        self.table_shape = None
+        # minimum length of the sequencer, see reserve_length
+        self.reserved_length = 0
+        # wave slots of the sequencer and the reserved number,
+        # see reserve_slots
+        self.number_slot = 1
+        self.reserved_slots = 1
         # qa integration length; unit: sample number
         self.integration_length = 4096
+        # integration length and {channel: (freq, length, fs)} of the
+        # weights in the device, see _set_all_integration
+        self.uploaded_integration = [None, {}]
         # qa result mode: integration--> return origin (I+iQ)
         self.source = qaSource.INTEGRATION.value
+        # unit: second, see acquisition_time
+        self.demod_start = 0.0
+        self.relaxation_length = 0.0
+        self.adc_trig_delay = 0.0
 
         ## set experimental parameters ##
         self.set_relaxation_length(relax_time=200e-6) ## unit: second
@@ -242,8 +1068,9 @@ class zurich_qa(object):
         # awgs output mode: 0=plain, 1=modulation; 
         self.daq.setInt('/{:s}/awgs/0/outputs/*/mode'.format(self.id), 0)
         # awgs hold maximum amplitude 1
-        self.daq.setDouble('/{:s}/awgs/0/outputs/*/amplitude', 1)
-        self.daq.setInt('/{:s}/sigouts/*/imp50', 0) ## close 50 Ohm output impedance
+        self.daq.setDouble(
+            '/{:s}/awgs/0/outputs/*/amplitude'.format(self.id), 1)
+        self.daq.setInt('/{:s}/sigouts/*/imp50'.format(self.id), 0) ## close 50 Ohm output impedance
         self.port_range(1.5,port=[1,2]) ## awg output range 1.5V(default);
 
         # set signal input (readout line)
@@ -292,11 +1119,39 @@ class zurich_qa(object):
         self.daq.syncSetInt('/{:s}/awgs/0/enable'.format(self.id), 1)
         logger.debug('\n AWG running. \n')
 
+    def reserve_length(self, wave_length):
+        """ wave_length: the maximum waveform length (sample number)
+            in the next experiment, the sequencer is built with this
+            length when it is compiled, 0 for no reservation.
+        """
+        self.reserved_length = int(wave_length)
+
+    def reserve_slots(self, number_slot):
+        """ number_slot: number of readout waveforms which are kept in
+            the device together (the sequencer is compiled again in the
+            next send_waveform if it is changed), each different
+            waveform is uploaded once and then selected by user
+            register 3, see get_slot_strings. 1 for no slot.
+        """
+        self.reserved_slots = max(int(number_slot), 1)
+
+    def set_wait_trigger(self, wait_trigger):
+        """ wait_trigger (bool): each repetition waits for the trigger
+            of the master QA, the sequencer is compiled again
+            in the next send_waveform if it is changed.
+        """
+        wait_trigger = bool(wait_trigger)
+        if wait_trigger != self.wait_trigger:
+            self.wait_trigger = wait_trigger
+            # force to build the sequencer
+            self.waveform_length = 0
+
     def awg_close(self):
         # Stop result unit
         self.daq.unsubscribe(self.paths)
         self.daq.setInt('/{:s}/qas/0/result/enable'.format(self.id), 0)
 
+    @batched
     def port_output(self,output=True,port=[1,2]):
         # output = 1, open AWG port; output = 0, close AWG port;
         if isinstance(port, int):
@@ -304,6 +1159,7 @@ class zurich_qa(object):
         for p in port:
             self.daq.setInt('/{:s}/sigouts/{:d}/on'.format(self.id,int(p-1)), int(output))
 
+    @batched
     @convertUnits(range_='V')
     def port_range(self,range_=None,port=[1,2]):
         # AWG output range = 1.5V or 150mV
@@ -321,6 +1177,7 @@ class zurich_qa(object):
                 self.daq.setDouble('/{:s}/sigouts/{:d}/range'.format(self.id,int(p-1)), range_)
 
     # -- send AWGs waveform
+    @timing.timed('qa.compile')
     def _awg_builder(self, number_port, wave_length, awg_index=0):
         """ Build waveforms sequencer. Then compile and send it to devices.
         """
@@ -332,9 +1189,15 @@ class zurich_qa(object):
         awg_program = get_QA_program(
             sample_rate=int(self.FS),
             number_port=number_port,
-            wave_length=wave_length)
+            wave_length=wave_length,
+            wait_trigger=self.wait_trigger,
+            number_slot=self.reserved_slots)
 
         self._awg_upload_string(awg_program, awg_index=awg_index)
+        # waveform memory is reset by the new program
+        self.upload_cache.invalidate(awg_index)
+        self.table_shape = None
+        self.number_slot = self.reserved_slots
         self.update_pulse_length()  # updata self.waveform_lenght
         logger.info(
             '[%s-AWG0] builder: %.3f s' % (self.id, time.time()-t0))
@@ -344,37 +1207,20 @@ class zurich_qa(object):
             awg_index: this device's awgs sequencer index. 
                        If awgs grouping == 4*2, this index 
                        can be selected as 0,1,2,3
-            write into waveforms sequencer and compile it.
-        """
-        awgModule = self.daq.awgModule()  # this API needs 0.2s to create
-        awgModule.set('awgModule/device', self.id)
-        awgModule.set('awgModule/index', awg_index)
-        awgModule.execute()  # Starts the awgModule if not yet running.
-        awgModule.set('awgModule/compiler/sourcestring',
-                      awg_program)  # to compile
-        while awgModule.getInt('awgModule/compiler/status') == -1:
-            time.sleep(0.1)
-        # Ensure that compilation was successful
-        if awgModule.getInt('awgModule/compiler/status') == 1:
-            # compilation failed, raise an exception
-            raise Exception(awgModule.getString(
-                'awgModule/compiler/statusstring'))
-        else:
-            if awgModule.getInt('awgModule/compiler/status') == 0:
-                logger.debug(
-                    "Compilation successful with no warnings, \
-                will upload the program to the instrument.")
-            if awgModule.getInt('awgModule/compiler/status') == 2:
-                logger.warning(
-                    "Compilation successful with no warnings, \
-                will upload the program to the instrument.")
-                logger.warning("Compiler warning: ", awgModule.getString(
-                    'awgModule/compiler/statusstring'))
-            # wait for waveform upload to finish
-            while awgModule.getDouble('awgModule/progress') < 1.0:
-                time.sleep(0.1)
+            write into waveforms sequencer and compile it,
+            the compiled program is cached, see programCache.
+        """
+        self.awg_pool.compile(
+            self.id, awg_index, awg_program, self.device_type)
         logger.debug('\n AWG upload successful. Output enabled. AWG Standby.')
 
+    def compile_async(self, awg_program, awg_index=0):
+        """ non-blocking _awg_upload_string
+        Returns: concurrent.futures.Future
+        """
+        return self.awg_pool.compile_async(
+            self.id, awg_index, awg_program, self.device_type)
+
     def send_waveform(self, waveform, recursion=3):
         """
         Args:
@@ -388,28 +1234,44 @@ class zurich_qa(object):
             recursion (int): the function will be called
             at most (recursion+1) times
         """
+        self.send_waveform_native(
+            convert_awg_waveform(waveform), recursion=recursion)
+
+    @timing.timed('qa.send_waveform')
+    def send_waveform_native(self, waveform_native, recursion=3):
+        """
+        Args:
+            waveform_native: two waves in the native AWG format,
+            given by convert_awg_waveform. The conversion can then be
+            done before the devices are running.
+            recursion (int): the function will be called
+            at most (recursion+1) times
+        """
         if recursion < 0:
             raise Exception("recursion callings exceed")
 
-        _n_ = self.waveform_length - len(waveform[0])
-        if _n_ < 0:
+        wave_length = len(waveform_native)//2
+        _n_ = self.waveform_length - wave_length
+        if (_n_ < 0 or self.table_shape is not None
+                or self.number_slot != self.reserved_slots):
             self._awg_builder(
-                number_port=len(waveform),
-                wave_length=len(waveform[0]),
+                number_port=2,
+                wave_length=bucket_length(
+                    max(wave_length, self.reserved_length)),
                 awg_index=0)
 
-            self.send_waveform(
-                waveform=waveform,
+            self.send_waveform_native(
+                waveform_native=waveform_native,
                 recursion=recursion-1)
             return
         else:
-            waveform_add = [np.hstack((wf, np.zeros(_n_))) for wf in waveform]
+            waveform_add = pad_native(waveform_native, self.waveform_length)
             try:
-                self._reload_waveform(waveform=waveform_add)
+                self._reload_slot(waveform_add)
             except Exception:
                 self.update_pulse_length()
-                self.send_waveform(
-                    waveform=waveform,
+                self.send_waveform_native(
+                    waveform_native=waveform_native,
                     recursion=recursion-1)
             return
 
@@ -419,38 +1281,104 @@ class zurich_qa(object):
             index: this waveform index in total sequencer
         """
         waveform_native = convert_awg_waveform(waveform)
+        self._reload_native(waveform_native, awg_index, index)
+
+    def _reload_native(self, waveform_native, awg_index=0, index=0):
+        """ waveform_native: waves in the native AWG format,
+        skipped if it is the same as the last upload
+        """
+        key = (awg_index, index)
+        digest = self.upload_cache.digest(waveform_native)
+        if self.upload_cache.is_uploaded(key, digest):
+            return
         path = '/{:s}/awgs/{:d}/waveform/waves/{:d}'.format(
             self.id, awg_index, index)
         self.daq.setVector(path, waveform_native)
+        self.upload_cache.update(key, digest)
+
+    def _reload_slot(self, waveform_native):
+        """ upload the waveform into its slot (if it is not there)
+        and select the slot, see reserve_slots
+        """
+        if self.number_slot == 1:
+            self._reload_native(waveform_native)
+            return
+        digest = self.upload_cache.digest(waveform_native)
+        index, found = self.upload_cache.find(0, digest, self.number_slot)
+        self._reload_native(waveform_native, index=index)
+        self.daq.setDouble(
+            '/{:s}/awgs/0/userregs/3'.format(self.id), index)
+
+    @timing.timed('qa.send_waveform')
+    def send_waveform_table(self, waveforms_native, repetition):
+        """ Upload a table of waveforms, played one after another
+        in a single run, each one (repetition) times.
+        Args:
+            waveforms_native (list): waveforms in the native AWG format,
+            given by convert_awg_waveform
+            repetition (int): number of shots for each waveform
+        """
+        wave_length = max(map(len, waveforms_native))//2
+        shape = (len(waveforms_native), wave_length, repetition)
+        if shape != self.table_shape:
+            logger.info(
+                'Bulid [%s-AWG0] table Sequencer (shape=%r)' % (self.id, shape))
+            awg_program = get_QA_table_program(
+                sample_rate=int(self.FS), number_port=2,
+                wave_length=wave_length, number_wave=shape[0],
+                repetition=repetition)
+            self._awg_upload_string(awg_program, awg_index=0)
+            self.upload_cache.invalidate(0)
+            self.table_shape = shape
+        for index, wave in enumerate(waveforms_native):
+            self._reload_native(
+                pad_native(wave, wave_length), awg_index=0, index=index)
 
     # -- set qa demod parameters
-    @convertUnits(readout_delay='s')
+    @convertUnits(relax_time='s')
     def set_relaxation_length(self,relax_time):
+        self.relaxation_length = relax_time
         # send to device: Register 3
         self.daq.setDouble(
                     '/{:s}/awgs/0/userregs/2'.format(self.id), 
                     int(relax_time*self.FS/8))
 
     def set_result_samples(self, sample=None):
-        """ sample: repetition number
+        """ sample: number of results
             Meanwhile update repeat index in AWG sequencer
-            and QA result parameter.
+            (result_samples*average) and QA result parameter.
         """
         if sample != None:
             self.result_samples = sample
         # send to device: Register 1
         self.daq.setDouble(
                     '/{:s}/awgs/0/userregs/0'.format(self.id),
-                    self.result_samples)
+                    self.result_samples*self.average)
         self.daq.setInt('/{:s}/qas/0/result/length'.format(self.id),
                         self.result_samples)  # results length
 
-    @convertUnits(readout_delay='s')
+    def set_average(self, average=None):
+        """ average: number of averages in device, each result is
+            averaged over (average) repetitions, 1 for single-shot.
+            The number of averages should be a power of 2.
+        """
+        if average != None:
+            if average < 1 or average & (average-1) != 0:
+                raise ValueError(
+                    'average should be a power of 2, not %r' % average)
+            self.average = int(average)
+        self.daq.setInt(
+            '/{:s}/qas/0/result/averages'.format(self.id), self.average)
+        # update the repeat index in AWG sequencer
+        self.set_result_samples()
+
+    @convertUnits(demod_start='s')
     def set_demod_start(self,demod_start):
         ''' demod_start: All device trigger --> QA integration start
             Here convert value from second to sample number, 
             8 samples as a unit.
         '''
+        self.demod_start = demod_start
         # unit: Sample Number
         # send to device: Register 1
         self.daq.setInt(
@@ -470,10 +1398,36 @@ class zurich_qa(object):
                 (length, 4096/1.8))
             self.waveform_length = 4096  # set the maximum length
         else:
-        # unit --> Sample Number
-        self.integration_length = int(length*self.FS/4)*4
+            # unit --> Sample Number
+            self.integration_length = int(length*self.FS/4)*4
+
+    @convertUnits(delay='s')
+    def set_readout_delay(self, delay):
+        ''' delay: qa pulse start --> QA integration start, given by
+            the wiring (readout line and devices).
+        '''
+        self.set_demod_start(delay)
+
+    @convertUnits(length='s')
+    def set_pulse_length(self, length):
+        ''' length: qa pulse length, the same length is demodulated.
+            The waveform length is given by the uploaded waveform.
+        '''
+        self.set_demod_length(length)
+
+    @convertUnits(delay='s')
+    def set_adc_trig_delay(self, delay):
+        ''' delay: All device trigger --> qa pulse start, the qa
+            pulse is played after the pulses of HD.
+        '''
+        self.adc_trig_delay = delay
+        # unit: 8 samples; send to device: Register 5
+        self.daq.setDouble(
+            '/{:s}/awgs/0/userregs/4'.format(self.id),
+            int(delay*self.FS/8))
 
     # -- set qa demod mode
+    @batched
     def set_qaSource_mode(self, mode=None):
         if mode == None:
             mode = self.source
@@ -505,6 +1459,7 @@ class zurich_qa(object):
         logger.info(
             ' [%s] QA Source Mode: %s' % (self.id, qaSource.name.value[self.source]))
 
+    @batched
     def _set_deskew_matrix(self, matrix=[[1, 1], [1, 1]]):
         self.daq.setDouble(
             '/{:s}/qas/0/deskew/rows/0/cols/0'.format(self.id), matrix[0][0])
@@ -535,23 +1490,32 @@ class zurich_qa(object):
         self._set_subscribe()  # set result paths
 
     def _set_all_integration(self):
-        w_index = np.arange(0, self.integration_length, 1)
-        for channel, freq in enumerate(self.qubit_frequency):
-            # assign real and image integration coefficient
-            # integration settings for one I/Q pair
+        """ upload the integration weights of the channels whose
+        (freq, length, fs) changed, channels without frequency (0)
+        are unused and skipped.
+        """
+        uploaded_length, uploaded = self.uploaded_integration
+        if uploaded_length != self.integration_length:
             self.daq.setDouble(
                 '/{:s}/qas/0/integration/length'.format(self.id),
                 self.integration_length)
-
-            w_real = np.cos(w_index*freq/1e9/1.8*2*pi)
-            w_imag = np.sin(w_index*freq/1e9/1.8*2*pi)
-
+            self.uploaded_integration[0] = self.integration_length
+        for channel, freq in enumerate(self.qubit_frequency):
+            if freq == 0:
+                continue
+            key = (float(freq), self.integration_length, 1.8e9)
+            if uploaded.get(channel) == key:
+                continue
+            # assign real and image integration coefficient
+            # integration settings for one I/Q pair
+            w_real, w_imag = integration_weights(*key)
             self.daq.setVector(
                 '/{:s}/qas/0/integration/weights/{}/real'.format(
                     self.id, channel), w_real)
             self.daq.setVector(
                 '/{:s}/qas/0/integration/weights/{}/imag'.format(
                     self.id, channel), w_imag)
+            uploaded[channel] = key
 
     def _set_subscribe(self, source=None):
         """ set demodulate result parameters -> upload qa result's paths
@@ -578,6 +1542,15 @@ class zurich_qa(object):
         self.daq.subscribe(self.paths)
 
     # -- get demod result
+    def acquisition_time(self):
+        """ expected time (second) of one run of the sequencer,
+        (result_samples*average) repetitions of the readout pulse,
+        demod wait and relaxation.
+        """
+        period = (self.waveform_length/self.FS + self.demod_start
+                  + self.relaxation_length + self.adc_trig_delay)
+        return self.result_samples*self.average*period
+
     def _acquisition_poll(self, daq, paths, num_samples, timeout=10.0):
         """ Polls the UHFQA for data.
         Args:
@@ -586,51 +1559,117 @@ class zurich_qa(object):
             timeout (float): time in seconds before timeout Error is raised.
         """
         logger.debug('acquisition_poll')
-        poll_length = 0.01  # s
-        poll_timeout = 100  # ms
-        poll_flags = 0
-        poll_return_flat_dict = True
-
-        # Keep list of recorded chunks of data for each subscribed path
-        chunks = {p: [] for p in paths}
-        gotem = {p: False for p in paths}
-
-        # Poll data
-        time = 0
-
-        def get_vec(v): return v['vector']
-
-        while time < timeout and not all(gotem.values()):
-            logger.debug('collecting results')
-            dataset = daq.poll(poll_length, poll_timeout,
-                               poll_flags, poll_return_flat_dict)
-            for p in paths:
-                if p not in dataset:
-                    continue
-                chunks[p] = list(map(get_vec, dataset[p]))
-                num_obtained = sum(map(len, chunks[p]))
-                if num_obtained >= num_samples:
-                    gotem[p] = True
-            time += poll_length
-
-        if not all(gotem.values()):
-            for p in paths:
-                num_obtained = sum(map(len, chunks[p]))
-                logger.error('Path {}: Got {} of {} samples'.format(
-                    p, num_obtained, num_samples))
-            raise Exception(
-                'Timeout Error: Did not get all results \
-                within {:.1f} s!'.format(timeout))
-
-        # Return dict of flattened data
-        return {p: np.concatenate(v) for p, v in chunks.items()}
-
-    def get_data(self):
+        return acquisition_poll(
+            daq, {p: num_samples for p in paths}, timeout=timeout,
+            expected_time=self.acquisition_time())
+
+    def get_data(self, timeout=10):
+        """ polls the session, not daq, which may be a nodeBatch of a
+        transaction in another thread, see qubitServer.submitSequence
+        """
         data = self._acquisition_poll(
-            self.daq, self.paths, self.result_samples, timeout=10)
+            self.session, self.paths, self.result_samples, timeout=timeout)
         return list(data.values())
 
 
+def poll_length(remaining, minimum=0.01, maximum=0.5):
+    """ poll window (second) for the remaining expected acquisition
+    time: long windows at the start of a long acquisition, then
+    short ones when the data is about to come.
+    """
+    return min(max(remaining/2, minimum), maximum)
+
+
+@timing.timed('qa.acquisition_poll')
+def acquisition_poll(daq, num_samples, timeout=10.0, expected_time=0.0):
+    """ Polls the subscribed paths of one data server for data.
+    The data of each path is copied into one array (allocated at the
+    first chunk with the dtype of the data) at a running offset.
+    Args:
+        daq: ziDAQServer
+        num_samples (dict): {path: expected number of samples}
+        timeout (float): time in seconds before timeout Error is raised.
+        expected_time (float): expected time of the acquisition,
+            see zurich_qa.acquisition_time and poll_length
+    Returns:
+        dict {path: data}
+    """
+    poll_timeout = 100  # ms
+    poll_flags = 0
+    poll_return_flat_dict = True
+
+    paths = list(num_samples.keys())
+    buffers = {p: None for p in paths}
+    obtained = {p: 0 for p in paths}
+
+    def finished():
+        return all(obtained[p] >= num_samples[p] for p in paths)
+
+    def copy_chunk(p, vector):
+        if buffers[p] is None:
+            buffers[p] = np.empty(num_samples[p], dtype=vector.dtype)
+        # samples beyond num_samples are dropped
+        n = min(len(vector), num_samples[p] - obtained[p])
+        buffers[p][obtained[p]:obtained[p]+n] = vector[:n]
+        obtained[p] += n
+
+    t0 = time.perf_counter()
+    elapsed = 0.0
+    while elapsed < timeout and not finished():
+        logger.debug('collecting results')
+        dataset = daq.poll(poll_length(expected_time - elapsed),
+                           poll_timeout, poll_flags, poll_return_flat_dict)
+        for p in paths:
+            # each poll returns the new chunks only
+            for chunk in dataset.get(p, []):
+                copy_chunk(p, chunk['vector'])
+        elapsed = time.perf_counter() - t0
+
+    if not finished():
+        for p in paths:
+            logger.error('Path {}: Got {} of {} samples'.format(
+                p, obtained[p], num_samples[p]))
+        raise Exception(
+            'Timeout Error: Did not get all results \
+            within {:.1f} s!'.format(timeout))
+
+    return buffers
+
+
+def get_data_many(qas, timeout=10):
+    """ get data of several zurich_qa which are running together.
+    The paths of the QAs sharing a session are got by one poll, and
+    the sessions are polled at the same time.
+    Args:
+        qas (list): zurich_qa objects
+    Returns:
+        list of data (see zurich_qa.get_data) for each QA
+    """
+    groups = {}
+    for qa in qas:
+        groups.setdefault(id(qa.session), []).append(qa)
+
+    def poll(group):
+        num_samples = {}
+        for qa in group:
+            for p in qa.paths:
+                num_samples[p] = qa.result_samples
+        expected_time = max(qa.acquisition_time() for qa in group)
+        return acquisition_poll(
+            group[0].session, num_samples, timeout=timeout,
+            expected_time=expected_time)
+
+    if len(groups) == 1:
+        results = [poll(group) for group in groups.values()]
+    else:
+        with ThreadPoolExecutor(max_workers=len(groups)) as executor:
+            results = list(executor.map(poll, groups.values()))
+    data = {}
+    for result in results:
+        data.update(result)
+    return [[data[p] for p in qa.paths] for qa in qas]
+
+
 @singletonMany
 class zurich_hd:
     """server for zurich hd
@@ -644,13 +1683,22 @@ class zurich_hd:
     and their obj_name (key) that has been created
     """
 
+    device_type = 'HDAWG'
+
     def __init__(self, obj_name='hd_1', device_id='dev8334',
                  labone_ip='localhost'):
         self.id = device_id
         self.obj_name = obj_name
+        self.upload_cache = uploadCache()
         try:
             logger.info('\nBring up %s in %s' % (self.id, labone_ip))
-            self.daq = ziDAQ(labone_ip=labone_ip).daq
+            # the connection of the device, daq is replaced by a
+            # nodeBatch of it in transactions, see transaction
+            self.session = ziDAQ(labone_ip=labone_ip).session(self.id)
+            self.daq = self.session
+            self.awg_pool = ziDAQ().awg_pool
+            # last written node values, see shadowDAQ
+            self.shadow = ziDAQ().shadow(self.id)
             self.connect()
             logger.info(self.daq)
             # sample rate
@@ -663,17 +1711,64 @@ class zurich_hd:
 
     # -- set device status
     def connect(self):
+        self.shadow.invalidate()
         self.daq.connectDevice(self.id, '1gbe')
 
     def disconnect(self):
+        self.release()
         self.daq.disconnectDevice(self.id)
 
-    def refresh_api(self,labone_ip='localhost'):
-        self.daq = ziDAQ(labone_ip=labone_ip).daq
+    def release(self):
+        """ stop the awgModules of this device, see clear_singletonMany
+        """
+        self.awg_pool.release(self.id)
 
+    def refresh_api(self,labone_ip='localhost'):
+        self.release()
+        self.session = ziDAQ(labone_ip=labone_ip).session(self.id)
+        self.daq = self.session
+        self.awg_pool = ziDAQ().awg_pool
+        self.shadow.invalidate()
+        self.upload_cache.invalidate()
+
+    @contextmanager
+    def transaction(self):
+        """ node writes in the with-statement are sent in one daq.set
+        when it exits, or dropped if it exits by an exception (writes
+        before any read of nodes are already sent), see nodeBatch:
+            with hd.transaction():
+                hd.port_range(1.5)
+                hd.port_offset(0)
+        """
+        if isinstance(self.daq, nodeBatch):
+            # nested transaction
+            yield self.daq
+            return
+        batch = nodeBatch(self.daq)
+        self.daq = batch
+        try:
+            yield batch
+        except BaseException:
+            # incomplete settings are not sent
+            batch.discard()
+            raise
+        finally:
+            self.daq = batch.daq
+        batch.flush()
+
+    @batched
     def init_setup(self):
         # four awg's waveform length, unit --> Sample Number
         self.waveform_length = [0, 0, 0, 0]
+        # (number_wave, wave_length, repetition) of the table program
+        # for four awgs, None for the program with one waveform
+        self.table_shape = [None, None, None, None]
+        # minimum length of the sequencers, see reserve_length
+        self.reserved_length = [0, 0, 0, 0]
+        # wave slots of the sequencers and the reserved numbers,
+        # see reserve_slots
+        self.number_slot = [1, 1, 1, 1]
+        self.reserved_slots = [1, 1, 1, 1]
         self.update_pulse_length() ## update current 'waveform_length' from ZI device
         self.port_output(output=True) # open all signal output port
         self.port_range(range_=1) # default output range: 1V
@@ -689,7 +1784,7 @@ class zurich_hd:
         # set ref clock mode as 'External'
         self.daq.setInt('/{:s}/system/clocks/referenceclock/source'.format(self.id), 1) 
         # awgs hold maximum amplitude 1
-        self.daq.setInt('/{:s}/awgs/0/outputs/*/amplitude'.format(self.id), 1.0) 
+        self.daq.setDouble('/{:s}/awgs/0/outputs/*/amplitude'.format(self.id), 1.0)
         # awgs output mode: 0=plain, 1=modulation; 
         self.daq.setInt('/{:s}/awgs/0/outputs/0/modulation/mode'.format(self.id), 0)  
 
@@ -701,15 +1796,15 @@ class zurich_hd:
         ### self.daq.sync()
         logger.info('%s: Complete Initialization' % self.id.upper())
 
-    def _unknown_settings(self)
+    def _unknown_settings(self):
         ## Unknown settings were suggested by ZI engineer
-        self.daq.setInt('/%s/awgs/0/dio/strobe/slope'.format(self.id), 0)
-        self.daq.setInt('/%s/awgs/0/dio/strobe/index'.format(self.id), 15)
-        self.daq.setInt('/%s/awgs/0/dio/valid/index'.format(self.id), 0)
-        self.daq.setInt('/%s/awgs/0/dio/valid/polarity'.format(self.id), 2)
-        self.daq.setInt('/%s/awgs/0/dio/mask/value'.format(self.id), 7)  # 111 三位qubit results
-        self.daq.setInt('/%s/awgs/0/dio/mask/shift'.format(self.id), 1)
-        self.daq.setInt('/%s/raw/dios/0/extclk'.format(self.id), 2)
+        self.daq.setInt('/{:s}/awgs/0/dio/strobe/slope'.format(self.id), 0)
+        self.daq.setInt('/{:s}/awgs/0/dio/strobe/index'.format(self.id), 15)
+        self.daq.setInt('/{:s}/awgs/0/dio/valid/index'.format(self.id), 0)
+        self.daq.setInt('/{:s}/awgs/0/dio/valid/polarity'.format(self.id), 2)
+        self.daq.setInt('/{:s}/awgs/0/dio/mask/value'.format(self.id), 7)  # 111 三位qubit results
+        self.daq.setInt('/{:s}/awgs/0/dio/mask/shift'.format(self.id), 1)
+        self.daq.setInt('/{:s}/raw/dios/0/extclk'.format(self.id), 2)
 
     # -- set awg status
     def awg_open(self, awgs_index=[0, 1, 2, 3]):
@@ -745,8 +1840,13 @@ class zurich_hd:
 
         ## try to set grouping mode
         if int(grouping_index) != int(self.grouping):
+            self.upload_cache.invalidate()
+            if grouping_index > 0:
+                # no wave slots for grouped channels, see reserve_slots
+                self.reserved_slots = [1, 1, 1, 1]
             self.daq.setInt(
                 '/{:s}/system/awg/channelgrouping'.format(self.id), grouping_index)
+            self.grouping = int(grouping_index)
             if grouping_index == 0:
                 for awg in range(4):
                     # set digital trigger
@@ -776,6 +1876,27 @@ class zurich_hd:
             '[%s] channel grouping: %s' %
             (self.id.upper(), grouping_name[self.grouping]))
 
+    def reserve_length(self, wave_length, awg_index=0):
+        """ wave_length: the maximum waveform length (sample number)
+            of the awg in the next experiment, the sequencer is built
+            with this length when it is compiled, 0 for no reservation.
+        """
+        self.reserved_length[awg_index] = int(wave_length)
+
+    def reserve_slots(self, number_slot, awg_index=0):
+        """ number_slot: number of waveforms of the awg which are kept
+            in the device together, selected by user register 0,
+            see zurich_qa.reserve_slots. 1 for no slot.
+            Only for the 4x2 channel grouping, the cores of a grouped
+            sequencer would share one register.
+        """
+        number_slot = max(int(number_slot), 1)
+        if number_slot > 1 and self.grouping > 0:
+            raise ValueError(
+                '[%s] wave slots need the 4x2 channel grouping, '
+                'see awg_grouping' % self.id.upper())
+        self.reserved_slots[awg_index] = number_slot
+
     def update_pulse_length(self):
         for awg_index in range(4):
             hdinfo = self.daq.getList(
@@ -794,6 +1915,7 @@ class zurich_hd:
             '[%s-AWG] update_pulse_length: %r' %
             (self.id, self.waveform_length))
 
+    @batched
     def port_output(self,output=True,port=np.linspace(1,8,8)):
         # output = 1, open AWG port; output = 0, close AWG port;
         if isinstance(port, int):
@@ -801,6 +1923,7 @@ class zurich_hd:
         for p in port:
             self.daq.setInt('/{:s}/sigouts/{:d}/on'.format(self.id,int(p-1)), int(output))
 
+    @batched
     @convertUnits(range_='V')
     def port_range(self,range_=None,port=np.linspace(1,8,8)):
         # AWG output range = 200mV,400mV,600mV,800mV,1V,2V,3V,4V,5V
@@ -818,6 +1941,7 @@ class zurich_hd:
                 self.daq.setDouble(
                     '/{:s}/sigouts/{:d}/range'.format(self.id,int(p-1)),range_)
 
+    @batched
     @convertUnits(offset='V')
     def port_offset(self,offset=None,port=np.linspace(1,8,8)):
         ## set offset voltage to port; 
@@ -836,20 +1960,27 @@ class zurich_hd:
                     '/{:s}/sigouts/{:d}/offset'.format(self.id,int(p-1)), offset)
 
     # -- bulid and send AWGs
+    @timing.timed('hd.compile')
     def _awg_builder(
-        self, waveform: list, awg_index=0, loop=False):
+        self, wave_length: int, awg_index=0, loop=False):
         """ Build awg program for labone, then compile and send it to devices.
+        wave_length: sample number of each wave
         """
         build_wave_num = 2**(self.grouping+1)
-        wave_length = len(waveform[0])
 
         awg_program = get_HD_program(
             sample_rate=self.FS, number_port=build_wave_num,
-            wave_length=wave_length, loop=loop)
+            wave_length=wave_length, loop=loop,
+            number_slot=self.reserved_slots[awg_index])
 
         # complie index varies for different grouping
         awg_index_group = awg_index//(2**self.grouping)
         self._awg_upload_string(awg_program, awg_index=awg_index_group)
+        # waveform memory is reset by the new program, one sequencer
+        # may cover several awg_index when the channels are grouped
+        self.upload_cache.invalidate()
+        self.table_shape[awg_index] = None
+        self.number_slot[awg_index] = self.reserved_slots[awg_index]
         self.update_pulse_length()
 
     def _awg_upload_string(self, awg_program, awg_index=0):
@@ -858,49 +1989,59 @@ class zurich_hd:
         awg_index: this device's awgs sequencer index.
         If awgs grouping == 4*2, this index can be selected
         as 0,1,2,3.
+        The compiled program is cached, see programCache.
         """
-        awgModule = self.daq.awgModule()
-        awgModule.set('awgModule/device', self.id)
-        awgModule.set('awgModule/index', awg_index)  # AWG 0, 1, 2, 3
-        awgModule.execute()
-        awgModule.set('awgModule/compiler/sourcestring', awg_program)
-        while awgModule.getInt('awgModule/compiler/status') == -1:
-            time.sleep(0.1)
-        # Ensure that compilation was successful
-        if awgModule.getInt('awgModule/compiler/status') == 1:
-            # compilation failed, raise an exception
-            raise Exception(awgModule.getString(
-                'awgModule/compiler/statusstring'))
-        else:
-            if awgModule.getInt('awgModule/compiler/status') == 0:
-                logger.info(
-                    "Compilation successful with no warnings,\
-                    will upload the program to the instrument.")
-            if awgModule.getInt('awgModule/compiler/status') == 2:
-                logger.warning(
-                    "Compilation successful with warnings,\
-                    upload program to the instrument.")
-                logger.warning("Compiler warning: ", awgModule.getString(
-                    'awgModule/compiler/statusstring'))
-            # wait for waveform upload to finish
-            i = 0
-            while awgModule.getDouble('awgModule/progress') < 1.0:
-                time.sleep(0.1)
-                i += 1
+        self.awg_pool.compile(
+            self.id, awg_index, awg_program, self.device_type)
         logger.info('\n AWG upload successful. Output enabled. AWG Standby.')
 
+    def compile_async(self, awg_program, awg_index=0):
+        """ non-blocking _awg_upload_string, the cores can be compiled
+        in parallel:
+            futures = [hd.compile_async(program, k) for k in range(4)]
+            [f.result() for f in futures]
+        Returns: concurrent.futures.Future
+        """
+        return self.awg_pool.compile_async(
+            self.id, awg_index, awg_program, self.device_type)
+
     def _reload_waveform(self, waveform, awg_index=0, index=0):
         """ waveform: (numpy.array) one/two waves with unit amplitude.
             awg_index: this devices awg sequencer index
             index: this waveform index in total sequencer
         """
         waveform_native = convert_awg_waveform(waveform)
+        self._reload_native(waveform_native, awg_index, index)
+
+    def _reload_native(self, waveform_native, awg_index=0, index=0):
+        """ waveform_native: waves in the native AWG format,
+        skipped if it is the same as the last upload
+        """
+        key = (awg_index, index)
+        digest = self.upload_cache.digest(waveform_native)
+        if self.upload_cache.is_uploaded(key, digest):
+            return
         logger.debug(
             '[%s-AWG%d] reload waveform length: %d' %
             (self.id, awg_index, len(waveform_native)))
         path = '/{:s}/awgs/{:d}/waveform/waves/{:d}'.format(
             self.id, awg_index, index)
         self.daq.setVector(path, waveform_native)
+        self.upload_cache.update(key, digest)
+
+    def _reload_slot(self, waveform_native, awg_index=0):
+        """ upload the waveform into its slot (if it is not there)
+        and select the slot, see reserve_slots
+        """
+        number_slot = self.number_slot[awg_index]
+        if number_slot == 1:
+            self._reload_native(waveform_native, awg_index=awg_index)
+            return
+        digest = self.upload_cache.digest(waveform_native)
+        index, found = self.upload_cache.find(awg_index, digest, number_slot)
+        self._reload_native(waveform_native, awg_index=awg_index, index=index)
+        self.daq.setDouble('/{:s}/awgs/{:d}/userregs/0'.format(
+            self.id, awg_index//(2**self.grouping)), index)
 
     def _update_when_error(func):
         @wraps(func)
@@ -916,7 +2057,6 @@ class zurich_hd:
             return func(self, *args, **kwargs)
         return wrapper
 
-    @_update_when_error
     def send_waveform(self, waveform: list, awg_index=0):
         """
         Args:
@@ -927,26 +2067,65 @@ class zurich_hd:
         """
         if len(waveform) != 2:
             raise ValueError("len(waveform) is not 2")
-        _length_diff = self.waveform_length[awg_index] - len(waveform[0])
-        if _length_diff < 0:
+        self.send_waveform_native(
+            convert_awg_waveform(waveform), awg_index=awg_index)
+
+    @timing.timed('hd.send_waveform')
+    @_update_when_error
+    def send_waveform_native(self, waveform_native, awg_index=0):
+        """
+        Args:
+            waveform_native: two waves in the native AWG format,
+            given by convert_awg_waveform. The conversion can then be
+            done before the devices are running.
+        """
+        wave_length = len(waveform_native)//2
+        _length_diff = self.waveform_length[awg_index] - wave_length
+        if (_length_diff < 0 or self.table_shape[awg_index] is not None
+                or self.number_slot[awg_index]
+                != self.reserved_slots[awg_index]):
             _info_build = 'Bulid [%s-AWG%d] Sequencer2 (len=%r > %r)' % (
-                self.id, awg_index, len(waveform[0]),
+                self.id, awg_index, wave_length,
                 self.waveform_length[awg_index])
             logger.info(_info_build)
 
             t0 = time.time()
             self._awg_builder(
-                waveform=waveform,
+                wave_length=bucket_length(
+                    max(wave_length, self.reserved_length[awg_index])),
                 awg_index=awg_index)
             logger.info(
                 '[%s-AWG%d] builder: %.3f s' %
                 (self.id, awg_index, time.time()-t0))
-            return
-        else:
-            waveform_add = [
-                np.hstack((w, np.zeros(_length_diff))) for w in waveform
-            ]
-            self._reload_waveform(waveform_add, awg_index=awg_index)
-            return
-
-
+            # the new program has zeros, upload the waveform as well
+        waveform_add = pad_native(
+            waveform_native, self.waveform_length[awg_index])
+        self._reload_slot(waveform_add, awg_index=awg_index)
+
+    @timing.timed('hd.send_waveform')
+    def send_waveform_table(self, waveforms_native, repetition, awg_index=0):
+        """ Upload a table of waveforms, played one after another
+        after the triggers of QA, each one (repetition) times.
+        Args:
+            waveforms_native (list): waveforms in the native AWG format,
+            given by convert_awg_waveform
+            repetition (int): number of shots for each waveform
+        """
+        wave_length = max(map(len, waveforms_native))//2
+        shape = (len(waveforms_native), wave_length, repetition)
+        if shape != self.table_shape[awg_index]:
+            logger.info(
+                'Bulid [%s-AWG%d] table Sequencer (shape=%r)' %
+                (self.id, awg_index, shape))
+            awg_program = get_HD_table_program(
+                sample_rate=self.FS, number_port=2**(self.grouping+1),
+                wave_length=wave_length, number_wave=shape[0],
+                repetition=repetition)
+            awg_index_group = awg_index//(2**self.grouping)
+            self._awg_upload_string(awg_program, awg_index=awg_index_group)
+            self.upload_cache.invalidate()
+            self.table_shape[awg_index] = shape
+        for index, wave in enumerate(waveforms_native):
+            self._reload_native(
+                pad_native(wave, wave_length),
+                awg_index=awg_index, index=index)
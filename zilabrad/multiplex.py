@@ -23,6 +23,9 @@ from zilabrad.instrument.qubitServer import stop_device
 from zilabrad.instrument.qubitServer import RunAllExperiment as RunAllExp
 from zilabrad.instrument.QubitContext import loadQubits, qubitContext
 from zilabrad.instrument.qubitServer import runQubits as runQ
+from zilabrad.instrument.qubitServer import presizeSequencers, reserveSlots
+from zilabrad.instrument.qubitServer import clearReservations
+from zilabrad.instrument.qubitServer import averageNumber
 
 
 import zilabrad.instrument.waveforms as waveforms
@@ -31,10 +34,14 @@ from zilabrad.plots import dataProcess
 
 from zilabrad.pyle import sweeps
 from zilabrad.pyle.util import sweeptools
+from zilabrad import timing
 
 
 from labrad.units import Unit, Value
 import labrad
+
+logger = logging.getLogger(__name__)
+
 _unitSpace = ('V', 'mV', 'us', 'ns', 's', 'GHz',
               'MHz', 'kHz', 'Hz', 'dBm', 'rad', 'None')
 V, mV, us, ns, s, GHz, MHz, kHz, Hz, dBm, rad, _l = [
@@ -83,6 +90,9 @@ def expfunc_decorator(func):
     @wraps(func)
     def wrapper(*args, **kwargs):
         start_ts = time.time()
+        timing.reset()
+        # the sequencers reserved by the last experiment
+        clearReservations()
         try:
             result = func(*args, **kwargs)
         except KeyboardInterrupt:
@@ -92,14 +102,19 @@ def expfunc_decorator(func):
             timeNow = time.strftime("%Y-%m-%d %X", time.localtime())
             print(timeNow)
             stop_device()  # stop all device running
-
+            timing.finish_experiment(func.__name__)
             return
         else:
             # finish in the end
             stop_device()
             timeNow = time.strftime("%Y-%m-%d %X", time.localtime())
             print(timeNow)
+            timing.finish_experiment(func.__name__)
             return result
+        finally:
+            # the wave slots (see reserveSlots) are not kept for
+            # the next experiments
+            clearReservations()
     return wrapper
 
 
@@ -157,6 +172,34 @@ def DCbiasPulse(q):
         q['dc'] = pulse
 
 
+def set_averageMode(qubits, average=True):
+    """ select the averaged acquisition of QA, runQ returns only the
+    mean of stats repetitions (array with one element) for each channel.
+    It is ignored for the experiments which call set_singleShot.
+    Args:
+        average (bool): use the averaged mode
+    """
+    for q in qubits:
+        q['average_mode'] = average
+
+
+def set_singleShot(qubits):
+    """ the experiment discriminates the states of single shots (see
+    tunneling), runQ returns single-shot data even if the averaged mode
+    is selected for the qubits (see set_averageMode).
+    """
+    for q in qubits:
+        q['single_shot'] = True
+
+
+def readout_index(qubits, q):
+    """ index of the data of q in the result of runQ, which has the
+    data of the qubits with do_readout, in the order of qubits
+    """
+    readout = [id(qb) for qb in qubits if qb.get('do_readout')]
+    return readout.index(id(q))
+
+
 def clear_waveforms(qubits):
     clear_keys = ['z', 'xy', 'dc', 'r']
     for q in qubits:
@@ -198,17 +241,19 @@ def correct_zero(sample):
 @expfunc_decorator
 def s21_scan(sample, measure=0, stats=1024, freq=6.0*GHz, delay=0*ns, phase=0,
              mw_power=None, bias=None, power=None, zpa=0.0,
-             name='s21_scan', des=''):
+             name='s21_scan', des='', average=False):
     """
     s21 scanning
     Args:
         sample: select experimental parameter from registry;
         stats: Number of Samples for one sweep point;
+        average: average stats samples in QA, see set_averageMode
     """
     sample, qubits, Qubits = loadQubits(sample, write_access=True)
     q = qubits[measure]
     q.channels = dict(q['channels'])
     q.stats = stats
+    set_averageMode(qubits, average)
     if freq is None:
         freq = q['readout_freq']
     if bias is None:
@@ -278,6 +323,7 @@ def spectroscopy(
         stats: Number of Samples for one sweep point;
     """
     sample, qubits, Qubits = loadQubits(sample, write_access=True)
+    set_singleShot(qubits)
     q = qubits[measure]
     q.stats = stats
 
@@ -331,7 +377,7 @@ def spectroscopy(
         set_qubitsDC(qubits, q['experiment_length'])
         q.r = readoutPulse(q)
 
-        data = runQ(qubits, devices)[measure]
+        data = runQ(qubits, devices)[readout_index(qubits, q)]
         clear_waveforms(qubits)
         return processData_1q(data, q)
 
@@ -349,6 +395,7 @@ def rabihigh(sample, measure=0, stats=1024, piamp=None, piLen=None, df=0*MHz,
         stats: Number of Samples for one sweep point;
     """
     sample, qubits, Qubits = loadQubits(sample, write_access=True)
+    set_singleShot(qubits)
     q = qubits[measure]
 
     if bias is None:
@@ -406,7 +453,7 @@ def rabihigh(sample, measure=0, stats=1024, piamp=None, piLen=None, df=0*MHz,
         q['do_readout'] = True
         set_qubitsDC(qubits, q['experiment_length'])
         q.r = readoutPulse(q)
-        data = runQ(qubits, devices)[0]
+        data = runQ(qubits, devices)[readout_index(qubits, q)]
         clear_waveforms(qubits)
         return processData_1q(data, q)
 
@@ -423,6 +470,7 @@ def rabihigh21(
         stats: Number of Samples for one sweep point;
     """
     sample, qubits, Qubits = loadQubits(sample, write_access=True)
+    set_singleShot(qubits)
     q = qubits[measure]
     q.channels = dict(q['channels'])
     q_copy = q.copy()
@@ -545,10 +593,10 @@ def IQraw(sample, measure=0, stats=16384, update=False, analyze=False, reps=1,
         set_qubitsDC(qubits, q['experiment_length'])
 
         # start to run experiment
-        data1 = runQ(qubits, devices)[measure]
+        data1 = runQ(qubits, devices)[readout_index(qubits, q)]
 
         q['xy'] = XYnothing(q)
-        data0 = runQ(qubits, devices)[measure]
+        data0 = runQ(qubits, devices)[readout_index(qubits, q)]
 
         Is0 = np.real(data0)
         Qs0 = np.imag(data0)
@@ -559,6 +607,8 @@ def IQraw(sample, measure=0, stats=16384, update=False, analyze=False, reps=1,
         clear_waveforms(qubits)
         return result
 
+    # |1> and |0> are uploaded once, see reserveSlots
+    reserveSlots(qubits, 2)
     collect, raw = True, True
     axes_scans = gridSweep(axes)
 
@@ -596,8 +646,8 @@ def IQraw210(
         sample, name+des, axes, deps, kw=kw, measure=measure)
 
     def get_IQ(data):
-        Is = np.real(data[0])
-        Qs = np.imag(data[0])
+        Is = np.real(data[readout_index(qubits, q)])
+        Qs = np.imag(data[readout_index(qubits, q)])
         return [Is, Qs]
 
     def runSweeper(devices, para_list):
@@ -652,6 +702,8 @@ def IQraw210(
         return result
 
     collect, raw = True, True
+    # |1>, |2> and |0> are uploaded once, see reserveSlots
+    reserveSlots(qubits, 3)
     axes_scans = gridSweep(axes)
     results = RunAllExp(runSweeper, axes_scans, dataset, collect, raw)
     data = np.asarray(results[0])
@@ -667,6 +719,7 @@ def measureFidelity(
     reps = np.arange(rep)
 
     sample, qubits, Qubits = loadQubits(sample, write_access=True)
+    set_singleShot(qubits)
     q = qubits[measure]
     Qb = Qubits[measure]
     q.channels = dict(q['channels'])
@@ -712,20 +765,22 @@ def measureFidelity(
 
         result = []
         # start to run experiment
-        data1 = runQ(qubits, devices)[measure]
+        data1 = runQ(qubits, devices)[readout_index(qubits, q)]
 
         # no pi pulse --> |0> ##
         q.xy = XYnothing(q)
         addXYgate(q, start, 0., 0.)
 
         # start to run experiment
-        data0 = runQ(qubits, devices)[measure]
+        data0 = runQ(qubits, devices)[readout_index(qubits, q)]
 
         prob0 = tunneling([q], [data0], level=2)
         prob1 = tunneling([q], [data1], level=2)
         clear_waveforms(qubits)
         return [prob0[0], prob1[0], prob0[1], prob1[1]]
 
+    # |1> and |0> are uploaded once, see reserveSlots
+    reserveSlots(qubits, 2)
     axes_scans = gridSweep(axes)
     results = RunAllExp(runSweeper, axes_scans, dataset)
     if update:
@@ -742,6 +797,7 @@ def T1_visibility(sample, measure=0, stats=1024, delay=0.8*us,
         stats: Number of Samples for one sweep point;
     """
     sample, qubits, Qubits = loadQubits(sample, write_access=True)
+    set_singleShot(qubits)
     q = qubits[measure]
     for qb in qubits:
         qb.channels = dict(qb['channels'])
@@ -756,6 +812,8 @@ def T1_visibility(sample, measure=0, stats=1024, delay=0.8*us,
 
     for qb in qubits:
         qb['awgs_pulse_len'] += np.max(delay)  # add max length of hd waveforms
+    # compile the sequencers once for the longest delay
+    presizeSequencers(qubits)
 
     # set some parameters name;
     axes = [(bias, 'bias'), (zpa, 'zpa'), (delay, 'delay')]
@@ -798,7 +856,7 @@ def T1_visibility(sample, measure=0, stats=1024, delay=0.8*us,
         # start to run experiment
         data1 = runQ(qubits, devices)
         # analyze data and return
-        _d_ = data1[0]
+        _d_ = data1[readout_index(qubits, q)]
         # unit: dB; only relative strength;
         amp1 = np.mean(np.abs(_d_))/q.power_r
         phase1 = np.mean(np.angle(_d_))
@@ -808,7 +866,7 @@ def T1_visibility(sample, measure=0, stats=1024, delay=0.8*us,
         q.xy = XYnothing(q)
         # start to run experiment
         data0 = runQ(qubits, devices)
-        _d_ = data0[0]
+        _d_ = data0[readout_index(qubits, q)]
         # analyze data and return
         amp0 = np.abs(np.mean(_d_))/q.power_r
         phase0 = np.angle(np.mean(_d_))
@@ -831,6 +889,7 @@ def ramsey(sample, measure=0, stats=1024, delay=ar[0:10:0.4, us],
         stats: Number of Samples for one sweep point;
     """
     sample, qubits, Qubits = loadQubits(sample, write_access=True)
+    set_singleShot(qubits)
     q = qubits[measure]
 
     q.power_r = power2amp(q['readout_amp']['dBm'])
@@ -838,6 +897,8 @@ def ramsey(sample, measure=0, stats=1024, delay=ar[0:10:0.4, us],
     q.sb_freq = (q['f10'] - q['xy_mw_fc'])[Hz]
     for qb in qubits:
         qb['awgs_pulse_len'] += np.max(delay)
+    # compile the sequencers once for the longest delay
+    presizeSequencers(qubits)
     # set some parameters name;
     axes = [(repetition, 'repetition'), (delay, 'delay'), (df, 'df'),
             (fringeFreq, 'fringeFreq'), (PHASE, 'PHASE')]
@@ -881,7 +942,7 @@ def ramsey(sample, measure=0, stats=1024, delay=ar[0:10:0.4, us],
         # start to run experiment
         data = runQ(qubits, devices)
         # analyze data and return
-        _d_ = data[0]
+        _d_ = data[readout_index(qubits, q)]
         # unit: dB; only relative strength;
         amp = np.abs(np.mean(_d_))/q.power_r
         phase = np.angle(np.mean(_d_))
@@ -902,14 +963,16 @@ def ramsey(sample, measure=0, stats=1024, delay=ar[0:10:0.4, us],
 def s21_dispersiveShift(
         sample, measure=0, stats=1024, freq=ar[6.4:6.5:0.02, GHz],
         delay=0*ns, mw_power=None, bias=None, power=None, sb_freq=None,
-        name='s21_disperShift', des='', back=False):
+        name='s21_disperShift', des='', back=False, average=False):
     """
         sample: select experimental parameter from registry;
         stats: Number of Samples for one sweep point;
+        average: average stats samples in QA, see set_averageMode
     """
     sample, qubits, Qubits = loadQubits(sample, write_access=True)
     q = qubits[measure]
     q.channels = dict(q['channels'])
+    set_averageMode(qubits, average)
 
     if bias is None:
         bias = q['bias']
@@ -1047,6 +1110,7 @@ def Nqubit_state(
         sample, reps=10, measure=[0, 1], states=[0, 0],
         name='Nqubit_state', des=''):
     sample, qubits, Qubits = loadQubits(sample, write_access=True)
+    set_singleShot(qubits)
     reps = np.arange(reps)
     prep_Nqbit(qubits)
     axes = [(reps, 'reps')]
@@ -1088,6 +1152,7 @@ def Qstate_tomo(
         sample, rep=10, state=[0, 1], name='tomoTest',
         tbuffer=10e-9, des=''):
     sample, qubits, Qubits = loadQubits(sample, write_access=True)
+    set_singleShot(qubits)
     num_q = len(qubits)
     prep_Nqbit(qubits)
     reps = range(rep)
@@ -1152,6 +1217,8 @@ def Qstate_tomo(
         clear_waveforms(qubits)
         return np.hstack(reqs)
 
+    # the pre-rotations are uploaded once, see reserveSlots
+    reserveSlots(qubits, 3**num_q)
     axes_scans = gridSweep(axes)
     result_list = RunAllExp(runSweeper, axes_scans, dataset)
     return
@@ -1164,6 +1231,7 @@ def qqiswap(sample, measure=0, delay=20*ns, zpa=None, name='iswap', des=''):
         stats: Number of Samples for one sweep point;
     """
     sample, qubits, Qubits = loadQubits(sample, write_access=True)
+    set_singleShot(qubits)
 
     prep_Nqbit(qubits)
 
@@ -1219,8 +1287,13 @@ def tunneling(qubits, data, level=2):
         qubits (dict): qubit information in registry
         data (list): list of IQ data (array of complex number) for N qubits
         level (int): level of qubit
+    Raises ValueError for the data of the averaged mode, the experiment
+    should call set_singleShot before runQ.
     """
     qNum = len(qubits)
+    if averageNumber(qubits) > 1:
+        raise ValueError(
+            'tunneling needs single-shot data, see set_singleShot')
     counts_num = len(data[0])
     binary_count = np.zeros((counts_num), dtype=float)
 
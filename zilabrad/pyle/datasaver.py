@@ -1,6 +1,8 @@
 import labrad
 from labrad import types
 
+from zilabrad import timing
+
 
 class Dataset(object):
     """Encapsulates a dataset that is created and written to via the data vault.
@@ -110,6 +112,10 @@ class Dataset(object):
         request will be popped out of the buffer and waited for
         before the new data are added.
         """
+        with timing.span('Dataset.add'):
+            return self._add(data)
+
+    def _add(self, data):
         if self.lazy and not self.created:
             self._create() # make sure the dataset has been created
         if len(self.requests) >= self.delay:
@@ -23,6 +23,7 @@
  # have to do this so we get math std library
 
 import math
+from collections import namedtuple
 
 import numpy as np
 from scipy.special import erf
@@ -31,6 +32,29 @@ import matplotlib.pyplot as plt
 from zilabrad.pyle.util import convertUnits
 
 
+_Term = namedtuple('_Term', ['kind', 'params', 'scale', 'start', 'end'])
+
+# kind -> (timeFunc(t, *params), freqFunc(f, *params), windowed, samples)
+# windowed kinds are zero outside of [start, end) of their term
+_kinds = {
+    'func': (lambda t, timeFunc, freqFunc: timeFunc(t),
+             lambda f, timeFunc, freqFunc: freqFunc(f),
+             False, None),
+}
+
+
+def primitive(kind, timeFunc, freqFunc=None, windowed=False, samples=None):
+    """Register a kind of primitive term.
+
+    The term is evaluated as timeFunc(t, *params) or freqFunc(f, *params),
+    see Envelope.primitive.  A windowed kind may give
+    samples(offset, n, fs, *params), the n samples of the term on a grid
+    with sampling rate fs, whose first time is offset after the start of
+    the term.  It is used by Envelope.render instead of timeFunc.
+    """
+    _kinds[kind] = (timeFunc, freqFunc, windowed, samples)
+
+
 class Envelope(object):
     """Represents a control envelope as a function of time or frequency.
     
@@ -45,27 +69,85 @@ class Envelope(object):
     
     Envelopes can be evaluated as functions of time or frequency using the
     fourier flag.  By default, they are evaluated as a function of time.
+
+    An envelope is a flat list of primitive terms (kind, params, scale,
+    start, end), see terms.  Adding or scaling envelopes only links the
+    operands (no closure is wrapped around them), the list is built once
+    when the envelope is evaluated, so a sequence of many gates is
+    evaluated term by term instead of through a deep call chain.
     """
     def __init__(self, timeFunc, freqFunc, start=None, end=None):
-        self.timeFunc = timeFunc
-        self.freqFunc = freqFunc
         self.start = start
         self.end = end
+        self._parts = ()
+        self._terms = [_Term('func', (timeFunc, freqFunc), 1, start, end)]
+
+    @classmethod
+    def primitive(cls, kind, params, start=None, end=None):
+        """Envelope of one term of a kind registered by primitive()."""
+        env = cls._linked((), start, end)
+        env._terms = [_Term(kind, tuple(params), 1, start, end)]
+        return env
+
+    @classmethod
+    def _linked(cls, parts, start, end):
+        # parts: ((scale, envelope), ...), flattened lazily in terms
+        env = cls.__new__(cls)
+        env.start = start
+        env.end = end
+        env._parts = parts
+        env._terms = None
+        return env
+
+    @property
+    def terms(self):
+        """The flat list of terms of this envelope."""
+        if self._terms is None:
+            terms = []
+            stack = [(1, self)]
+            while stack:
+                scale, env = stack.pop()
+                if env._terms is not None:
+                    if scale == 1:
+                        terms.extend(env._terms)
+                    else:
+                        terms.extend(
+                            term._replace(scale=scale*term.scale)
+                            for term in env._terms)
+                else:
+                    # reversed, so the terms keep the order of the operands
+                    stack.extend((scale*s, part)
+                                 for s, part in reversed(env._parts))
+            self._terms = terms
+        return self._terms
 
     def __call__(self, x, fourier=False):
-        if fourier:
-            return self.freqFunc(x)
-        else:
-            return self.timeFunc(x)
+        result = 0*x
+        for kind, params, scale, start, end in self.terms:
+            timeFunc, freqFunc, windowed, samples = _kinds[kind]
+            if fourier:
+                y = freqFunc(x, *params)
+            else:
+                y = timeFunc(x, *params)
+            result = result + (y if scale == 1 else scale*y)
+        return result
+
+    def render(self, t, fs=None):
+        """Evaluate in time on a sorted array t, see renderTerms."""
+        return renderTerms(self.terms, t, fs)
+
+    @property
+    def timeFunc(self):
+        return self.__call__
+
+    @property
+    def freqFunc(self):
+        return lambda f: self(f, fourier=True)
 
     def __add__(self, other):
         if isinstance(other, Envelope):
             start, end = timeRange((self, other))
-            def timeFunc(t):
-                return self.timeFunc(t) + other.timeFunc(t)
-            def freqFunc(f):
-                return self.freqFunc(f) + other.freqFunc(f)
-            return Envelope(timeFunc, freqFunc, start=start, end=end)
+            return Envelope._linked(((1, self), (1, other)), start, end)
         else:
             # if we try to add envelopes with the built in sum() function,
             # the first envelope is added to 0 before adding the rest.  To support
@@ -79,66 +161,50 @@ class Envelope(object):
     def __sub__(self, other):
         if isinstance(other, Envelope):
             start, end = timeRange((self, other))
-            def timeFunc(t):
-                return self.timeFunc(t) - other.timeFunc(t)
-            def freqFunc(f):
-                return self.freqFunc(f) - other.freqFunc(f)
-            return Envelope(timeFunc, freqFunc, start=start, end=end)
+            return Envelope._linked(((1, self), (-1, other)), start, end)
         else:
             # if we try to add envelopes with the built in sum() function,
             # the first envelope is added to 0 before adding the rest.  To support
             # this, we add a special case here since adding 0 in time or fourier
             # is equivalent
             if other == 0:
-                return -self
+                return self
             raise Exception("Cannot subtract a constant from hybrid time/fourier envelopes")
         
     def __rsub__(self, other):
         if isinstance(other, Envelope):
             start, end = timeRange((self, other))
-            def timeFunc(t):
-                return other.timeFunc(t) - self.timeFunc(t)
-            def freqFunc(f):
-                return other.freqFunc(f) - self.freqFunc(f)
-            return Envelope(timeFunc, freqFunc, start=start, end=end)
+            return Envelope._linked(((1, other), (-1, self)), start, end)
         else:
             # if we try to add envelopes with the built in sum() function,
             # the first envelope is added to 0 before adding the rest.  To support
             # this, we add a special case here since adding 0 in time or fourier
             # is equivalent
             if other == 0:
-                return self
+                return -self
             raise Exception("Cannot subtract a constant from hybrid time/fourier envelopes")
 
     def __mul__(self, other):
         if isinstance(other, Envelope):
             raise Exception("Hybrid time/fourier envelopes can only be multiplied by constants")
         else:
-            def timeFunc(t):
-                return self.timeFunc(t) * other
-            def freqFunc(f):
-                return self.freqFunc(f) * other
-            return Envelope(timeFunc, freqFunc, start=self.start, end=self.end)
+            return Envelope._linked(((other, self),), self.start, self.end)
     __rmul__ = __mul__
 
     def __truediv__(self, other):
         if isinstance(other, Envelope):
             raise Exception("Hybrid time/fourier envelopes can only be divided by constants")
         else:
-            def timeFunc(t):
-                return self.timeFunc(t) / other
-            def freqFunc(f):
-                return self.freqFunc(f) / other
-            return Envelope(timeFunc, freqFunc, start=self.start, end=self.end)
+            return self * (1.0 / other)
         
     def __rtruediv__(self, other):
         if isinstance(other, Envelope):
             raise Exception("Hybrid time/fourier envelopes can only be divided by constants")
         else:
             def timeFunc(t):
-                return other / self.timeFunc(t)
+                return other / self(t)
             def freqFunc(f):
-                return other / self.freqFunc(f)
+                return other / self(f, fourier=True)
             return Envelope(timeFunc, freqFunc, start=self.start, end=self.end)
 
     def __neg__(self):
@@ -152,7 +218,8 @@ _zero = lambda x: 0*x
 
 
 # empty envelope
-NOTHING = Envelope(_zero, _zero, start=None, end=None)
+NOTHING = Envelope._linked((), None, None)
+NOTHING._terms = []
 
 
 @convertUnits(t0='ns', w='ns', amp=None, phase=None, df='GHz')
@@ -312,6 +379,38 @@ def timeRange(envelopes):
     return start, end
 
 
+def renderTerms(terms, t, fs=None, out=None):
+    """Evaluate terms in time on a sorted array t, added to out.
+
+    A windowed term is evaluated only on the slice of t in its
+    [start, end), the other terms on the whole array.  If t is a grid
+    with sampling rate fs, the samples functions of the kinds are used.
+    out is converted to complex if a term is complex.
+    """
+    t = np.asarray(t)
+    if out is None:
+        out = np.zeros(len(t))
+    for kind, params, scale, start, end in terms:
+        timeFunc, freqFunc, windowed, samples = _kinds[kind]
+        if windowed:
+            i0, i1 = np.searchsorted(t, (start, end))
+            if i1 <= i0:
+                continue
+            window = slice(i0, i1)
+        else:
+            window = slice(None)
+        if windowed and samples is not None and fs is not None:
+            y = samples(t[i0] - start, i1 - i0, fs, *params)
+        else:
+            y = timeFunc(t[window], *params)
+        if scale != 1:
+            y = scale*y
+        if np.iscomplexobj(y) and not np.iscomplexobj(out):
+            out = out.astype(complex)
+        out[window] += y
+    return out
+
+
 def fftFreqs(time=1024):
     """Get a list of frequencies for evaluating fourier envelopes.
     
@@ -98,6 +98,11 @@ class LRUCache(object):
     If *maxsize* is set to None, the LRU features are disabled and the cache
     can grow without bound.
 
+    If *maxbytes* is given, least-recently used elements are also tossed out
+    while the total size of the results is larger than *maxbytes*.  The size
+    of a result is given by *sizeof*, default is the nbytes of numpy arrays
+    (and 0 for other objects).  The most recent element is always kept.
+
     See:  http://en.wikipedia.org/wiki/Cache_algorithms#Least_Recently_Used
 
     Based on a backport of functools.lru_cache from python 3.3+:
@@ -112,19 +117,22 @@ class LRUCache(object):
 
     PREV, NEXT, KEY, RESULT = 0, 1, 2, 3 # names for the link fields
 
-    def __init__(self, maxsize=128):
+    def __init__(self, maxsize=128, maxbytes=None, sizeof=None):
         self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof or (lambda result: getattr(result, 'nbytes', 0))
 
         # depending on maxsize, choose the implementation of 'get'
         # based on whether or not we need caching and size limitation
         if maxsize == 0:
             self.get = self._get_nocache
-        elif maxsize is None:
+        elif maxsize is None and maxbytes is None:
             self.get = self._get_nomax
         else:
             self.get = self._get
 
         self.hits = self.misses = 0
+        self.currbytes = 0
         self.cache = {}
         self.lock = RLock() # because linkedlist updates aren't threadsafe
         root = self.root = [] # root of the circular doubly-linked list
@@ -172,7 +180,7 @@ class LRUCache(object):
                 # update is already done, we need only return the
                 # computed result and update the count of misses.
                 pass
-            elif len(self.cache) >= self.maxsize:
+            elif self.maxsize is not None and len(self.cache) >= self.maxsize:
                 # use the old root to store the new key and result
                 oldroot = root
                 oldroot[self.KEY] = key
@@ -185,14 +193,29 @@ class LRUCache(object):
                 # now update the cache dictionary for the new links
                 del self.cache[oldkey]
                 self.cache[key] = oldroot
+                self._add_bytes(result, oldvalue)
             else:
                 # put result in a new link at the front of the list
                 last = root[self.PREV]
                 link = [last, root, key, result]
                 last[self.NEXT] = root[self.PREV] = self.cache[key] = link
+                self._add_bytes(result)
             self.misses += 1
         return result
 
+    def _add_bytes(self, result, oldvalue=None):
+        """count the bytes of a new result and toss out the oldest elements
+        while there are too many"""
+        if self.maxbytes is None:
+            return
+        self.currbytes += self.sizeof(result)
+        if oldvalue is not None:
+            self.currbytes -= self.sizeof(oldvalue)
+        root = self.root
+        while self.currbytes > self.maxbytes and len(self.cache) > 1:
+            link = root[self.NEXT]
+            self.evict(link[self.KEY])
+
     def info(self):
         """Report cache statistics"""
         with self.lock:
@@ -205,6 +228,7 @@ class LRUCache(object):
             root = self.root
             root[:] = [root, root, None, None]
             self.hits = self.misses = 0
+            self.currbytes = 0
 
     def evict(self, key):
         """Remove the given key from the cache."""
@@ -216,6 +240,8 @@ class LRUCache(object):
                 link[self.NEXT][self.PREV] = link[self.PREV]
                 # remove item from the cache
                 del self.cache[key]
+                if self.maxbytes is not None:
+                    self.currbytes -= self.sizeof(link[self.RESULT])
 
 def lru_cache(maxsize=128, typed=False):
     """Least-recently-used cache decorator.
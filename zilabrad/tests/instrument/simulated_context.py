@@ -0,0 +1,101 @@
+"""
+qubitContext of simulated devices (see zilabrad.instrument.simulator),
+without the labrad registry and microwave sources
+"""
+import copy
+from collections import OrderedDict
+
+from zilabrad.instrument.zurichHelper import ziDAQ, zurich_qa, zurich_hd
+from zilabrad.instrument.QubitContext import qubitContext, WiringPlan
+from zilabrad.pyle.registry import AttrDict
+from zilabrad.tests.default_parameter import _qubit_para
+
+
+class simMicrowave(object):
+    def __init__(self):
+        self.settings = {}
+        self.device = None
+
+    def select_device(self, address):
+        self.device = address
+
+    def output(self, on):
+        pass
+
+    def frequency(self, freq):
+        self.settings[self.device] = freq
+
+    def amplitude(self, power):
+        pass
+
+    def stop_all(self):
+        pass
+
+    def invalidate(self):
+        pass
+
+
+class simContext(object):
+    """ the attributes of qubitContext used by qubitServer
+    """
+    qa_master = 'qa_1'
+    max_wiring_plans = 8
+    wiring = {'qa_1': 7}
+    IPdict_microwave = {'anritsu_r_1': 'r', 'anritsu_xy_1': 'xy'}
+
+    def __init__(self, directory=None):
+        ziDAQ(simulate={'time_scale': 0, 'directory': directory, 'seed': 0})
+        self.servers_qa = {
+            'qa_1': zurich_qa('qa_1', device_id='dev2591')['qa_1']}
+        self.servers_hd = {
+            'hd_1': zurich_hd('hd_1', device_id='dev8334')['hd_1']}
+        self.servers_microwave = simMicrowave()
+        self.wiring_plans = OrderedDict()
+
+    ADC_FS = property(lambda self: self.servers_qa['qa_1'].FS)
+    DAC_FS = property(lambda self: self.servers_hd['hd_1'].FS)
+
+    def get_server(self, type, name):
+        if type == 'microwave_source':
+            return self.servers_microwave
+        return self.get_servers_group(type)[name]
+
+    def get_servers_group(self, type='qa'):
+        if type == 'qa':
+            return self.servers_qa
+        elif type == 'hd':
+            return self.servers_hd
+        elif type == 'zurich':
+            return {**self.servers_qa, **self.servers_hd}
+
+    def wiringPlan(self, qubits):
+        key = tuple(id(q) for q in qubits)
+        if key not in self.wiring_plans:
+            self.wiring_plans[key] = WiringPlan(
+                qubits, qa_master=self.qa_master)
+        return self.wiring_plans[key]
+
+    def refresh(self):
+        pass
+
+
+def use_simulated_context(directory=None):
+    """ qubitContext() returns a simContext until it is reset by
+    qubitContext.instance = None
+    """
+    qubitContext.instance = simContext(directory)
+    return qubitContext.instance
+
+
+def simulated_qubits(number=1):
+    """ qubits of the default parameters, on the channels of hd_1
+    """
+    qubits = []
+    for k in range(number):
+        q = AttrDict(copy.deepcopy(_qubit_para))
+        q['channels'] = [('xy_I', ('hd_1', 4*k+1)), ('xy_Q', ('hd_1', 4*k+2)),
+                         ('z', ('hd_1', 4*k+3))]
+        q['demod_freq'] = 20e6*(k+1)
+        q['do_readout'] = True
+        qubits.append(q)
+    return qubits
@@ -0,0 +1,47 @@
+import time
+import pytest
+from zilabrad.instrument.pipeline import SweepPipeline, current_pipeline
+
+
+def dummy_runQubits(qubits, device_time=0.02):
+    value = qubits[0]['value']
+    pipeline = current_pipeline()
+    pipeline.track(qubits)
+    with pipeline.device_stage():
+        time.sleep(device_time)
+    return value
+
+
+def test_pipeline_order_and_state():
+    q = {}
+
+    def runSweeper(x):
+        q['value'] = x
+        q['xy'] = [x]
+        data1 = dummy_runQubits([q])
+        q['xy'][0] += 100
+        data0 = dummy_runQubits([q])
+        # the qubit is not modified by the other sweep points
+        assert q['value'] == x
+        assert q['xy'] == [x+100]
+        q.pop('xy')
+        return data1, data0
+
+    results = list(SweepPipeline(depth=2).map(runSweeper, range(6)))
+    assert results == [(x, x) for x in range(6)]
+
+
+def test_pipeline_error():
+    q = {}
+
+    def runSweeper(x):
+        q['value'] = x
+        if x == 2:
+            raise ValueError('stop')
+        return dummy_runQubits([q])
+
+    results = []
+    with pytest.raises(ValueError):
+        for result in SweepPipeline(depth=2).map(runSweeper, range(6)):
+            results.append(result)
+    assert results == [0, 1]
@@ -0,0 +1,253 @@
+import time
+from functools import partial
+import threading
+import numpy as np
+import pytest
+from zilabrad import multiplex
+from zilabrad.instrument import waveforms
+from zilabrad.instrument.QubitContext import qubitContext
+from zilabrad.instrument.qubitServer import uploadParallel, UploadError
+from zilabrad.instrument import qubitServer
+from zilabrad.instrument.qubitServer import runQubits, submitSequence
+from zilabrad.tests.instrument.simulated_context import (
+    use_simulated_context, simulated_qubits)
+
+
+def test_upload_parallel():
+    barrier = threading.Barrier(3, timeout=5)
+    done = []
+
+    def upload(key):
+        # all cores are uploading at the same time
+        barrier.wait()
+        done.append(key)
+
+    keys = [('hd_1', 0), ('hd_1', 1), ('qa_1', 0)]
+    uploadParallel({key: (lambda key=key: upload(key)) for key in keys})
+    assert sorted(done) == sorted(keys)
+
+
+def test_upload_parallel_errors():
+    def fail(message):
+        raise ValueError(message)
+
+    tasks = {
+        ('hd_1', 0): lambda: fail('core 0'),
+        ('hd_1', 1): lambda: None,
+        ('hd_2', 3): lambda: fail('core 3'),
+    }
+    with pytest.raises(UploadError) as info:
+        uploadParallel(tasks)
+    errors = info.value.errors
+    assert sorted(errors) == [('hd_1', 0), ('hd_2', 3)]
+    assert str(errors[('hd_2', 3)]) == 'core 3'
+    with pytest.raises(UploadError):
+        uploadParallel({('hd_1', 0): lambda: fail('single')})
+
+
+def test_upload_parallel_sessions():
+    running = []
+    overlapped = []
+    lock = threading.Lock()
+
+    def upload(session):
+        with lock:
+            if session in running:
+                overlapped.append(session)
+            running.append(session)
+        time.sleep(0.01)
+        with lock:
+            running.remove(session)
+
+    sessions = {('hd_1', 0): 'a', ('hd_1', 1): 'a', ('hd_1', 2): 'a',
+                ('hd_2', 0): 'b', ('qa_1', 0): 'b'}
+    tasks = {key: partial(upload, session)
+             for key, session in sessions.items()}
+    uploadParallel(tasks, sessions)
+    # a session is never used by two threads at the same time
+    assert overlapped == []
+
+
+@pytest.fixture
+def context(tmp_path):
+    yield use_simulated_context(str(tmp_path))
+    qubitContext.instance = None
+
+
+def test_simulated_runQubits(context):
+    qubits = simulated_qubits(2)
+    for q in qubits:
+        q['experiment_length'] = 100e-9
+        q.xy = [waveforms.cosine(amp=0.5, freq=100e6, length=40e-9),
+                waveforms.sine(amp=0.5, freq=100e6, length=40e-9)]
+        q.z = waveforms.square(amp=0.1, start=0, length=60e-9)
+        q.r = multiplex.readoutPulse(q)
+    data = runQubits(qubits)
+    # the data of the readout qubits, the readout tones are integrated
+    assert len(data) == 2 and all(len(d) == 1024 for d in data)
+    assert all(np.mean(np.abs(d)) > 2 for d in data)
+    qubits[0]['do_readout'] = False
+    data = runQubits(qubits)
+    assert len(data) == 1 and multiplex.readout_index(qubits, qubits[1]) == 0
+    qubits[0]['do_readout'] = True
+    qa = context.servers_qa['qa_1']
+    server = qa.daq.daq
+    delay = server.getDouble('/dev2591/awgs/0/userregs/4')
+    assert delay == int((1e-6 + 100e-9)*qa.FS/8)
+
+
+def test_device_sessions(context):
+    qa = context.servers_qa['qa_1']
+    hd = context.servers_hd['hd_1']
+    # each device has its own connection to the same data server
+    assert qa.daq is not hd.daq
+    hd.daq.setInt('/dev8334/sigouts/0/on', 1)
+    assert qa.daq.daq.getInt('/dev8334/sigouts/0/on') == 1
+    sessions = qubitServer.uploadSessions(
+        {('hd_1', 0): None, ('hd_1', 1): None, ('qa_1', 0): None})
+    assert sessions[('hd_1', 0)] is sessions[('hd_1', 1)] is hd.daq
+    assert sessions[('qa_1', 0)] is qa.daq
+    # the uploads of the two devices wait for the server together
+    latency = qa.daq.daq.latency
+    fixed, latency['setVector'] = latency['setVector'], 0.1
+    for device in (qa, hd):
+        device.daq.daq.time_scale = 1
+    try:
+        start = time.perf_counter()
+        uploadParallel({
+            ('qa_1', 0): lambda: qa.daq.setVector('/dev2591/test', [0]*10),
+            ('hd_1', 0): lambda: hd.daq.setVector('/dev8334/test', [0]*10),
+        }, sessions)
+        elapsed = time.perf_counter() - start
+    finally:
+        for device in (qa, hd):
+            device.daq.daq.time_scale = 0
+        latency['setVector'] = fixed
+    assert elapsed < 0.18
+
+
+def test_transaction_while_pending(context, monkeypatch):
+    qubits = simulated_qubits(1)
+    qubits[0]['experiment_length'] = 100e-9
+    qubits[0].r = multiplex.readoutPulse(qubits[0])
+    qa = context.servers_qa['qa_1']
+    server = qa.session.daq
+    path = '/dev2591/sigins/0/range'
+    in_transaction = threading.Event()
+    acquireData = qubitServer.acquireData
+
+    def acquireLater(qas, readout_order):
+        # the data is polled while the caller is in a transaction
+        in_transaction.wait(5)
+        return acquireData(qas, readout_order)
+
+    monkeypatch.setattr(qubitServer, 'acquireData', acquireLater)
+    future = qubitServer.runQubitsAsync(qubits)
+    with qa.transaction():
+        qa.daq.setDouble(path, 0.25)
+        in_transaction.set()
+        time.sleep(0.05)
+        # the polls do not send the writes of the transaction
+        assert server.getDouble(path) != 0.25
+    data = future.result(5)
+    assert len(data) == 1 and np.mean(np.abs(data[0])) > 2
+    assert server.getDouble(path) == 0.25
+
+
+@pytest.fixture
+def acquisitions(monkeypatch):
+    """ submitSequence with fake arming and acquisition, each sequence
+    is (name, seconds to acquire, error of the acquisition or None)
+    """
+    events = []
+
+    def armSequence(sequence):
+        events.append(('arm', sequence[0]))
+        return sequence
+
+    def acquireData(sequence, readout_order):
+        name, seconds, error = sequence
+        time.sleep(seconds)
+        events.append(('data', name))
+        if error is not None:
+            raise error
+        return name
+
+    monkeypatch.setattr(qubitServer, 'armSequence', armSequence)
+    monkeypatch.setattr(qubitServer, 'acquireData', acquireData)
+    monkeypatch.setattr(qubitServer, '_acquisition_pending', None)
+    return events
+
+
+class fakeSequence(tuple):
+    readout_order = None
+
+
+def test_submit_sequence_order(acquisitions):
+    first = submitSequence(fakeSequence(('first', 0.05, None)))
+    # armed in the calling thread
+    assert acquisitions == [('arm', 'first')]
+    second = submitSequence(fakeSequence(('second', 0, None)))
+    assert acquisitions[:2] == [('arm', 'first'), ('data', 'first')]
+    assert second.result() == 'second' and first.result() == 'first'
+    assert acquisitions == [
+        ('arm', 'first'), ('data', 'first'),
+        ('arm', 'second'), ('data', 'second')]
+
+
+def test_submit_sequence_errors(acquisitions):
+    future = submitSequence(fakeSequence(('read', 0, ValueError('read'))))
+    with pytest.raises(ValueError, match='read'):
+        future.result()
+    # the error was read, the next sequence starts
+    future = submitSequence(fakeSequence(('checked', 0, KeyError('checked'))))
+    assert isinstance(future.exception(), KeyError)
+    submitSequence(fakeSequence(('lost', 0, ValueError('lost'))))
+    # the error of the future nobody read is raised by the next call
+    with pytest.raises(ValueError, match='lost'):
+        submitSequence(fakeSequence(('next', 0, None)))
+    assert ('arm', 'next') not in acquisitions
+    assert submitSequence(fakeSequence(('next', 0, None))).result() == 'next'
+
+
+def test_setup_after_failed_arm(context, monkeypatch):
+    qubits = simulated_qubits(1)
+    for q in qubits:
+        q['experiment_length'] = 100e-9
+        q.r = multiplex.readoutPulse(q)
+    refreshed = []
+    monkeypatch.setattr(context, 'refresh', lambda: refreshed.append(1))
+    armDevices = qubitServer.armDevices
+
+    def failing(sequence):
+        raise RuntimeError('upload failed')
+
+    monkeypatch.setattr(qubitServer, 'armDevices', failing)
+    with pytest.raises(RuntimeError):
+        runQubits(qubits)
+    # the retry sets up the devices again
+    assert 'isNewExpStart' not in qubits[0]
+    monkeypatch.setattr(qubitServer, 'armDevices', armDevices)
+    runQubits(qubits)
+    runQubits(qubits)
+    assert len(refreshed) == 2 and 'isNewExpStart' in qubits[0]
+
+
+def test_compiled_sweep_layout(context):
+    qubits = simulated_qubits(2)
+    qubits[1]['do_readout'] = False
+    for q in qubits:
+        q['experiment_length'] = 100e-9
+        q['stats'] = 64
+
+    def run(amp):
+        qubits[0].xy = [waveforms.cosine(amp=amp, freq=100e6, length=40e-9),
+                        waveforms.sine(amp=amp, freq=100e6, length=40e-9)]
+        for q in qubits:
+            q.r = multiplex.readoutPulse(q)
+        return runQubits(qubits)
+
+    results = list(qubitServer.sequenceTable().map(run, [0.1, 0.2, 0.3]))
+    # the same layout as runQubits: the data of the readout qubits
+    assert [len(data) for data in results] == [1, 1, 1]
+    assert all(len(data[0]) == 64 for data in results)
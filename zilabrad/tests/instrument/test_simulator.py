@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+from zilabrad.instrument.zurichHelper import ziDAQ, zurich_qa, zurich_hd
+from zilabrad.instrument.zurichHelper import convert_awg_waveform
+
+
+def test_simulated_devices(tmp_path):
+    ziDAQ(simulate={'time_scale': 0, 'directory': str(tmp_path), 'seed': 0})
+    assert ziDAQ().simulate
+    qa = zurich_qa('qa_sim', device_id='dev0001')['qa_sim']
+    hd = zurich_hd('hd_sim', device_id='dev0002')['hd_sim']
+    assert qa.FS == 1.8e9 and hd.FS == 2.4e9
+
+    t = np.arange(1000)/1.8e9
+    f_read = [100e6, -50e6]
+    wave = sum(0.4*np.exp(2j*np.pi*f*t) for f in f_read)
+    qa.send_waveform_native(convert_awg_waveform([wave.real, wave.imag]))
+    assert qa.waveform_length >= 1000
+    hd.send_waveform([np.zeros(500), np.zeros(500)], awg_index=1)
+    assert hd.waveform_length[1] >= 500
+
+    qa.set_result_samples(64)
+    qa.set_qubit_frequency(f_read)
+    qa.awg_open()
+    data = qa.get_data(timeout=1)
+    assert len(data) == 10 and all(len(d) == 64 for d in data)
+    # the readout tones are integrated, the unused channels are zero
+    assert np.mean(np.abs(data[0])) > 10*np.mean(np.abs(data[5])) + 1
+    qa.awg_close()
+
+
+def test_simulated_slots():
+    ziDAQ(simulate={'time_scale': 0})
+    hd = zurich_hd('hd_sim', device_id='dev0002')['hd_sim']
+    server = ziDAQ().daq.daq
+    hd.reserve_slots(2, awg_index=2)
+    waves = [convert_awg_waveform([np.full(300, a), np.zeros(300)])
+             for a in [0.1, 0.2]]
+    hd.send_waveform_native(waves[0], awg_index=2)
+    assert hd.number_slot[2] == 2
+    uploads = hd.upload_cache.info().misses
+    for k in [1, 0, 1, 0]:
+        hd.send_waveform_native(waves[k], awg_index=2)
+        assert server.getInt('/dev0002/awgs/2/userregs/0') == k
+        # the waveform of the slot is in the device
+        wave = server.getList('/dev0002/awgs/2/waveform/waves/%d' % k)
+        assert np.all(wave[0][1][0]['vector'][:600] == waves[k])
+    # only the first alternation is uploaded
+    assert hd.upload_cache.info().misses == uploads + 1
+    hd.reserve_slots(1, awg_index=2)
+    hd.send_waveform_native(waves[1], awg_index=2)
+    assert hd.number_slot[2] == 1
+
+
+def test_grouped_slots():
+    ziDAQ(simulate={'time_scale': 0})
+    hd = zurich_hd('hd_sim', device_id='dev0002')['hd_sim']
+    server = ziDAQ().daq.daq
+    hd.reserve_slots(2, awg_index=0)
+    hd.reserve_slots(2, awg_index=1)
+    # cores 0 and 1 are one sequencer with one register 0
+    hd.awg_grouping(1)
+    try:
+        assert hd.reserved_slots == [1, 1, 1, 1]
+        with pytest.raises(ValueError):
+            hd.reserve_slots(2, awg_index=1)
+        waves = [convert_awg_waveform([np.full(300, a), np.zeros(300)])
+                 for a in [0.1, 0.2]]
+        server.setDouble('/dev0002/awgs/0/userregs/0', 0)
+        for k in [0, 1, 1, 0]:
+            hd.send_waveform_native(waves[k], awg_index=0)
+            hd.send_waveform_native(waves[1-k], awg_index=1)
+            assert hd.number_slot[:2] == [1, 1]
+            assert server.getDouble('/dev0002/awgs/0/userregs/0') == 0
+    finally:
+        hd.awg_grouping(0)
+
+
+def test_adc_trig_delay():
+    ziDAQ(simulate={'time_scale': 0})
+    qa = zurich_qa('qa_sim', device_id='dev0001')['qa_sim']
+    server = ziDAQ().daq.daq
+    qa.set_adc_trig_delay(100e-9)
+    assert server.getInt('/dev0001/awgs/0/userregs/4') == int(
+        100e-9*qa.FS/8)
+    t = np.arange(1000)/1.8e9
+    wave = 0.4*np.exp(2j*np.pi*100e6*t)
+    qa.send_waveform_native(convert_awg_waveform([wave.real, wave.imag]))
+    # the QA pulse waits for the register after the trigger
+    program = server.programs[('dev0001', 0)]
+    assert program.index('wait(getUserReg(4))') < program.index('playWave')
+    assert np.isclose(
+        qa.acquisition_time(),
+        qa.result_samples*(qa.waveform_length/qa.FS + qa.demod_start
+                           + qa.relaxation_length + 100e-9))
+    qa.set_adc_trig_delay(0)
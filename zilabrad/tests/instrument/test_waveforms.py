@@ -0,0 +1,122 @@
+import numpy as np
+
+from zilabrad.instrument import waveforms
+from zilabrad.pyle import envelopes
+from zilabrad.pyle.envelopes import NOTHING
+from zilabrad.pyle.util.cache import LRUCache
+
+
+def test_envelope_terms():
+    t = np.arange(0, 1e-6, 1/1.8e9)
+    pulses = [
+        waveforms.cosine(amp=0.5, freq=100e6, phase=0.3,
+                         start=i*40e-9, length=40e-9)
+        for i in range(10)]
+    env = NOTHING
+    for pulse in pulses:
+        env += pulse
+    env = 2*env - pulses[0]/2
+    assert len(env.terms) == 11
+    assert env.start == 0 and np.isclose(env.end, 400e-9)
+    expect = 2*sum(p(t) for p in pulses) - pulses[0](t)/2
+    assert np.allclose(env(t), expect)
+
+    # gaussian of pyle is one term of a function
+    gauss = envelopes.gaussian(10, 4, amp=0.1)
+    both = gauss + waveforms.square(start=0, end=20, amp=1)
+    x = np.arange(0, 30.)
+    assert np.allclose(both(x), gauss(x) + (x < 20))
+    assert (-gauss).terms[0].scale == -1
+
+
+def test_envelope_many_gates():
+    env = NOTHING
+    for i in range(5000):
+        env += waveforms.square(start=i*1e-9, length=1e-9, amp=1.)
+    t = np.arange(0, 5e-6, 0.5e-9) + 0.25e-9
+    assert len(env.terms) == 5000
+    assert np.allclose(env(t), 1.)
+
+
+def test_func2array_windows():
+    waveServer = waveforms.waveServer()
+    env = (waveforms.cosine(amp=0.3, freq=50e6, start=-20e-9, length=60e-9)
+           + waveforms.sine(amp=0.2, freq=80e6, start=100e-9, length=33e-9)
+           - waveforms.square(amp=0.1, start=500e-9, length=1e-6)
+           + envelopes.gaussian(300e-9, 10e-9, amp=0.1, df=0.01e9))
+    t = np.arange(0, 1e-6, 1/1.8e9)
+    wave = waveServer.func2array(env, 0, 1e-6, 1.8e9)
+    assert len(wave) == len(t)
+    assert np.iscomplexobj(wave)
+    assert np.allclose(wave, env(t), atol=1e-6)
+    # outside of every pulse
+    assert len(waveServer.func2array(
+        waveforms.square(start=2e-6), 0, 1e-6, 1.8e9)) == len(t)
+
+
+def test_pulse_cache():
+    waveforms.pulse_cache.clear()
+    fs = 1.8e9
+    t = np.arange(0, 2e-6, 1/fs)
+    env = NOTHING
+    for i in range(20):
+        start = i*90e-9 + (i % 2)*0.3e-9
+        env += waveforms.cosine(amp=0.1*i, phase=0.2*i, freq=120e6,
+                                start=start, length=40e-9)
+        env += waveforms.sine(amp=0.1*i, phase=0.2*i, freq=120e6,
+                              start=start, length=40e-9)
+    wave = env.render(t, fs)
+    assert np.allclose(wave, env(t))
+    # pulses on two offsets to the grid (and the rounding of the grid)
+    info = waveforms.pulse_cache.info()
+    assert info.currsize <= 4 and info.hits >= 36
+
+
+def test_synthesize_parity():
+    fs = 2.4e9
+    t = np.arange(-100e-9, 3e-6, 1/fs)
+    env = waveforms.square(amp=0.2, start=-50e-9, length=3e-6)
+    for i in range(30):
+        start = i*97.3e-9
+        env += waveforms.cosine(amp=0.3, freq=(50+i)*1e6, phase=0.1*i,
+                                start=start, length=40e-9)
+        env -= 0.5*waveforms.sine(amp=0.3, freq=(50+i)*1e6, phase=0.1*i,
+                                  start=start, length=40e-9)
+    # a long pulse, its carrier is cached also by the compiled loop
+    env += waveforms.sine(amp=0.2, freq=30e6, phase=0.3,
+                          start=1.01e-6, length=1e-6)
+    table, rest = waveforms.pulse_table(env.terms, t)
+    assert len(table) == 62 and rest == []
+    out_numpy = np.zeros(len(t), dtype=np.float32)
+    waveforms._synthesize_numpy(table, out_numpy, fs)
+    assert np.allclose(out_numpy, env(t), atol=1e-6)
+    if waveforms.jit is not None:
+        out_jit = np.zeros(len(t), dtype=np.float32)
+        waveforms._synthesize(table, out_jit, fs)
+        assert np.allclose(out_jit, out_numpy, atol=1e-6)
+        # all the carriers computed in the loop
+        out_jit[:] = 0
+        index = np.full(len(table), -1, dtype=np.int64)
+        waveforms._synthesize_jit(
+            table, index, waveforms._no_carriers, out_jit, fs)
+        assert np.allclose(out_jit, out_numpy, atol=1e-6)
+    waveforms.pulse_cache.clear()
+    wave = waveforms.waveServer().func2array(env, t[0], t[-1] + 0.5/fs, fs)
+    assert wave.dtype == np.float32
+    if waveforms.jit is not None:
+        # only the carrier of the long pulse is read from the cache
+        assert waveforms.pulse_cache.info().currsize == 1
+    assert np.allclose(wave, out_numpy, atol=1e-6)
+
+
+def test_lru_cache_bytes():
+    cache = LRUCache(maxsize=None, maxbytes=2000)
+    for i in range(5):
+        cache.get(i, np.zeros, 100)
+    assert cache.info().currsize == 2
+    assert cache.currbytes == 1600
+    cache.get(3, np.zeros, 100)
+    cache.get(5, np.zeros, 100)
+    assert sorted(cache.cache) == [3, 5]
+    cache.evict(3)
+    assert cache.currbytes == 800
@@ -0,0 +1,66 @@
+import numpy as np
+from labrad.units import Unit
+from zilabrad.instrument.QubitContext import WiringPlan
+from zilabrad.instrument.qubitServer import makeSequence_AWG
+from zilabrad.instrument import waveforms
+from zilabrad.pyle.registry import AttrDict
+
+ns = Unit('ns')
+
+
+def make_qubit(channels):
+    q = AttrDict()
+    q['channels'] = channels
+    q['bias_start'] = 10*ns
+    q['bias_end'] = 10*ns
+    q['awgs_pulse_len'] = 20*ns
+    q['readout_len'] = 20*ns
+    return q
+
+
+def test_wiring_plan():
+    q1 = make_qubit([('xy_I', ('hd_1', 1)), ('xy_Q', ('hd_1', 2)),
+                     ('z', ('hd_1', 3))])
+    q2 = make_qubit([('z', ('hd_1', 4)), ('dc', ('hd_2', 1))])
+    plan = WiringPlan([q1, q2])
+    assert plan.awg_keys == [('hd_1', 0), ('hd_1', 1), ('hd_2', 0)]
+    assert plan.slots[(0, 'xy_Q')] == (('hd_1', 0), 1)
+    assert plan.slots[(1, 'z')] == (('hd_1', 1), 1)
+
+    q1.xy = [waveforms.square(start=-10e-9, end=50e-9, amp=0.5),
+             waveforms.square(amp=0)]
+    q1.z = waveforms.square(amp=0.1)
+    waves = makeSequence_AWG(
+        [q1, q2], plan, FS=1e9, sizes={('hd_1', 0): 100})
+    # q2 has no waveforms, dc of hd_2 is not used
+    assert list(waves) == [('hd_1', 0), ('hd_1', 1)]
+    # rendered as long as the sequencer
+    wave = waves[('hd_1', 0)].view(np.int16)
+    assert wave.dtype == np.int16 and len(wave) == 200
+    assert np.max(wave[0::2]) == (2**15 - 1) // 2
+    assert np.all(waves[('hd_1', 1)][1::2] == 0)
+
+    # buffers are reused in turn (depth 3) and cleared
+    for i in range(2):
+        makeSequence_AWG([q1, q2], plan, FS=1e9, sizes={('hd_1', 0): 100})
+    q1.pop('xy')
+    waves2 = makeSequence_AWG(
+        [q1, q2], plan, FS=1e9, sizes={('hd_1', 0): 100})
+    assert list(waves2) == [('hd_1', 1)]
+    assert np.all(wave == 0)
+
+
+def test_wiring_plan_readout():
+    q1 = make_qubit([('z', ('hd_1', 1))])
+    q2 = make_qubit([('z', ('hd_1', 2)), ('readout', 'qa_2')])
+    q3 = make_qubit([('z', ('hd_1', 3))])
+    for q in [q1, q2, q3]:
+        q['do_readout'] = True
+    plan = WiringPlan([q1, q2, q3], qa_master='qa_1')
+    assert plan.qa_names == ['qa_1', 'qa_2']
+    assert plan.readout_qubits([q1, q2, q3], 'qa_1') == [q1, q3]
+    assert plan.readout_order([q1, q2, q3]) == [
+        ('qa_1', 0), ('qa_2', 0), ('qa_1', 1)]
+
+    q1['do_readout'] = False
+    assert plan.readout_order([q1, q2, q3]) == [('qa_2', 0), ('qa_1', 0)]
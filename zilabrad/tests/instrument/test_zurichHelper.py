@@ -0,0 +1,237 @@
+import numpy as np
+import pytest
+from zilabrad.instrument.zurichHelper import nativeBuffer, convert_awg_waveform
+from zilabrad.instrument.zurichHelper import bucket_length, awgModulePool
+from zilabrad.instrument.zurichHelper import acquisition_poll, poll_length
+from zilabrad.instrument.zurichHelper import integration_weights, nodeBatch
+from zilabrad.instrument.zurichHelper import nodeShadow, shadowDAQ
+from zilabrad.instrument.QubitContext import qubitContext
+from zilabrad.tests.instrument.simulated_context import use_simulated_context
+
+
+def test_native_buffer():
+    waves = [np.linspace(-1, 1, 11), np.linspace(0, 0.5, 11)]
+    buffer = nativeBuffer(depth=2)
+    b = buffer.get(16)
+    for i in [0, 1]:
+        nativeBuffer.write(b, i, waves[i])
+    native = nativeBuffer.native(b)
+    assert native.dtype == np.uint16 and len(native) == 32
+    assert np.shares_memory(native, b)
+    assert np.all(native[:22] == convert_awg_waveform(waves))
+    assert np.all(native[22:] == 0)
+    assert native.view(np.int16)[0] == -(2**15 - 1)
+
+
+def test_native_buffer_clip():
+    nativeBuffer.clipped = 0
+    b = nativeBuffer(depth=1).get(8)
+    nativeBuffer.write(b, 0, np.array([0.5, 1.5, -2., -1.], dtype=np.float32))
+    nativeBuffer.write_codes(b, 1, np.array([-1, 40000, -40000, 7]))
+    assert list(b[:4, 0]) == [16383, 32767, -32767, -32767]
+    assert list(b[:4, 1]) == [-1, 32767, -32768, 7]
+    assert nativeBuffer.clipped == 4
+    native = convert_awg_waveform(
+        [np.array([0.1, -0.1]), np.array([-1, 1]).astype(np.uint16)])
+    assert list(native.view(np.int16)) == [3276, -1, -3276, 1]
+
+
+def test_bucket_length():
+    lengths = np.arange(1, 20000, 7)
+    buckets = np.array([bucket_length(n) for n in lengths])
+    assert np.all(buckets >= lengths)
+    assert np.all(buckets % 16 == 0)
+    assert np.all(np.diff(buckets) >= 0)
+    # a few buckets for a growing waveform
+    assert len(set(buckets[lengths > 1000])) < 20
+
+
+class fakeModule(object):
+    def __init__(self):
+        self.nodes = {}
+        self.finished = False
+
+    def set(self, path, value):
+        self.nodes[path] = value
+
+    def execute(self):
+        pass
+
+    def finish(self):
+        self.finished = True
+
+    def clear(self):
+        pass
+
+
+class fakeDAQ(object):
+    def __init__(self):
+        self.modules = []
+
+    def awgModule(self):
+        self.modules.append(fakeModule())
+        return self.modules[-1]
+
+
+def test_awg_module_pool():
+    daq = fakeDAQ()
+    pool = awgModulePool(daq)
+    m0, _ = pool.get('dev1', 0)
+    assert pool.get('dev1', 0)[0] is m0
+    m1, _ = pool.get('dev1', 1)
+    pool.get('dev2', 0)
+    assert len(daq.modules) == 3 and pool.info() == (3, 1, 3)
+    assert m1.nodes['awgModule/index'] == 1
+    pool.release('dev1')
+    assert m0.finished and m1.finished
+    assert pool.info().currsize == 1
+    # a new module is created after release
+    assert pool.get('dev1', 0)[0] is not m0
+    pool.release()
+    assert pool.info().currsize == 0
+
+
+class pollDAQ(object):
+    """returns the chunks of data one poll after another"""
+    def __init__(self, polls):
+        self.polls = list(polls)
+        self.windows = []
+
+    def poll(self, length, timeout, flags, flat):
+        self.windows.append(length)
+        if not self.polls:
+            return {}
+        return {p: [{'vector': v} for v in chunks]
+                for p, chunks in self.polls.pop(0).items()}
+
+
+def test_acquisition_poll():
+    data = np.arange(10) + 1j*np.arange(10)
+    daq = pollDAQ([
+        {'a': [data[:3], data[3:5]], 'b': [data.real[:4]]},
+        {},
+        {'a': [data[5:]], 'b': [data.real[4:]]},
+        ])
+    result = acquisition_poll(daq, {'a': 10, 'b': 10}, expected_time=0.05)
+    assert np.all(result['a'] == data)
+    assert np.all(result['b'] == data.real)
+    assert result['b'].dtype == np.float64
+    assert daq.windows[0] == 0.025
+
+
+def test_poll_length():
+    assert poll_length(10.0) == 0.5
+    assert poll_length(0.1) == 0.05
+    assert poll_length(-1.0) == 0.01
+
+
+def test_integration_weights():
+    w_real, w_imag = integration_weights(100e6, 4096)
+    assert integration_weights(100e6, 4096)[0] is w_real
+    assert len(w_real) == 4096 and not w_real.flags.writeable
+    t = np.arange(4096)/1.8e9
+    assert np.allclose(w_real, np.cos(2*np.pi*100e6*t))
+    assert np.allclose(w_imag, np.sin(2*np.pi*100e6*t))
+    assert integration_weights(100e6, 2048)[0] is not w_real
+
+
+class setDAQ(object):
+    def __init__(self):
+        self.calls = []
+
+    def set(self, nodes):
+        self.calls.append(('set', nodes))
+
+    def getInt(self, path):
+        self.calls.append(('getInt', path))
+        return 0
+
+
+def test_node_batch():
+    daq = setDAQ()
+    batch = nodeBatch(daq)
+    batch.setInt('/dev1/a', 1)
+    batch.setDouble('/dev1/b', 2)
+    batch.setInt('/DEV1/a', 3)
+    assert daq.calls == []
+    batch.getInt('/dev1/c')
+    assert daq.calls == [
+        ('set', [('/dev1/b', 2.0), ('/DEV1/a', 3)]),
+        ('getInt', '/dev1/c')]
+    batch.setComplex('/dev1/d', 1)
+    batch.flush()
+    batch.flush()
+    assert daq.calls[2:] == [('set', [('/dev1/d', 1+0j)])]
+
+
+class nodeDAQ(object):
+    def __init__(self):
+        self.nodes = {}
+        self.writes = []
+
+    def setDouble(self, path, value):
+        self.writes.append(path)
+        self.nodes[path] = value
+
+    setInt = setDouble
+
+    def set(self, nodes):
+        for path, value in nodes:
+            self.setDouble(path, value)
+
+    def getDouble(self, path):
+        return self.nodes[path]
+
+
+def test_node_shadow():
+    raw = nodeDAQ()
+    shadow = nodeShadow()
+    daq = shadowDAQ(raw, {'dev1': shadow})
+    for _ in range(3):
+        daq.setDouble('/dev1/sigouts/0/offset', 0.1)
+        daq.setInt('/dev1/awgs/0/enable', 1)
+        daq.setInt('/dev2/awgs/0/time', 0)
+    assert raw.writes.count('/dev1/sigouts/0/offset') == 1
+    assert raw.writes.count('/dev1/awgs/0/enable') == 3
+    assert raw.writes.count('/dev2/awgs/0/time') == 3
+    daq.set([('/dev1/sigouts/0/offset', 0.1), ('/dev1/sigouts/1/offset', 0)])
+    assert raw.writes[-1] == '/dev1/sigouts/1/offset'
+    # wildcard writes invalidate the matching nodes
+    daq.setDouble('/dev1/sigouts/*/offset', 0)
+    daq.setDouble('/dev1/sigouts/0/offset', 0.1)
+    assert raw.writes.count('/dev1/sigouts/0/offset') == 2
+    # verify mode writes again if the device was changed
+    raw.nodes['/dev1/sigouts/0/offset'] = 0.0
+    daq.setDouble('/dev1/sigouts/0/offset', 0.1)
+    assert raw.writes.count('/dev1/sigouts/0/offset') == 2
+    shadow.verify = True
+    daq.setDouble('/dev1/sigouts/0/offset', 0.1)
+    assert raw.writes.count('/dev1/sigouts/0/offset') == 3
+    shadow.invalidate()
+    assert shadow.info().currsize == 0
+
+
+def test_transaction(tmp_path):
+    # init_setup of the devices is a transaction with valid paths only
+    context = use_simulated_context(str(tmp_path))
+    try:
+        qa = context.servers_qa['qa_1']
+        hd = context.servers_hd['hd_1']
+        server = qa.daq.daq
+        assert server.getInt('/dev2591/sigouts/1/imp50') == 0
+        assert server.getDouble('/dev2591/awgs/0/outputs/1/amplitude') == 1
+        assert server.getInt('/dev8334/awgs/0/dio/strobe/index') == 15
+
+        for dev in [qa, hd]:
+            path = '/{:s}/sigouts/0/offset'.format(dev.id)
+            with pytest.raises(ValueError):
+                with dev.transaction() as batch:
+                    batch.setDouble(path, 0.2)
+                    raise ValueError('failed setting')
+            assert server.getDouble(path) == 0
+            assert not isinstance(dev.daq, nodeBatch)
+            with dev.transaction() as batch:
+                batch.setDouble(path, 0.2)
+            assert server.getDouble(path) == 0.2
+    finally:
+        qubitContext.instance = None
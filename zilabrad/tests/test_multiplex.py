@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+from zilabrad import multiplex
+from zilabrad.instrument.QubitContext import qubitContext
+from zilabrad.instrument.qubitServer import presizeSequencers, reserveSlots
+from zilabrad.instrument.qubitServer import setupDevices
+from zilabrad.tests.instrument.simulated_context import (
+    use_simulated_context, simulated_qubits)
+
+
+@pytest.fixture
+def context(tmp_path):
+    yield use_simulated_context(str(tmp_path))
+    qubitContext.instance = None
+
+
+def test_reservation_not_kept(context):
+    hd = context.servers_hd['hd_1']
+    qa = context.servers_qa['qa_1']
+
+    @multiplex.expfunc_decorator
+    def presized(qubits):
+        presizeSequencers(qubits)
+        return list(hd.reserved_length), qa.reserved_length
+
+    @multiplex.expfunc_decorator
+    def plain(qubits):
+        return list(hd.reserved_length), qa.reserved_length
+
+    hd_length, qa_length = presized(simulated_qubits())
+    assert hd_length[0] > 0 and qa_length > 0
+    assert plain(simulated_qubits()) == ([0, 0, 0, 0], 0)
+
+
+def test_slots_removed(context):
+    hd = context.servers_hd['hd_1']
+    qa = context.servers_qa['qa_1']
+
+    @multiplex.expfunc_decorator
+    def alternating(qubits):
+        reserveSlots(qubits, 3, readout_slots=2)
+        assert hd.reserved_slots[0] == 3 and qa.reserved_slots == 2
+        raise ValueError('failed experiment')
+
+    with pytest.raises(ValueError):
+        alternating(simulated_qubits())
+    assert hd.reserved_slots == [1, 1, 1, 1] and qa.reserved_slots == 1
+
+
+def test_average_mode(context):
+    qa = context.servers_qa['qa_1']
+    server = qa.daq.daq
+    qubits = simulated_qubits(2)
+    for q in qubits:
+        q['experiment_length'] = 100e-9
+    multiplex.set_averageMode(qubits)
+    setupDevices(qubits)
+    assert qa.average == 1024 and qa.result_samples == 1
+    assert server.getInt('/dev2591/qas/0/result/averages') == 1024
+
+    # averaged data can not be discriminated
+    with pytest.raises(ValueError):
+        multiplex.tunneling(qubits, [np.zeros(1), np.zeros(1)])
+
+    # the experiments calling tunneling are single-shot from the start
+    multiplex.set_singleShot(qubits)
+    setupDevices(qubits)
+    assert qa.average == 1 and qa.result_samples == 1024
+    assert server.getInt('/dev2591/qas/0/result/averages') == 1
@@ -0,0 +1,50 @@
+import json
+from zilabrad import timing
+
+
+def test_timing_summary(tmp_path):
+    timing.reset()
+
+    @timing.timed('func')
+    def func(x):
+        return x
+
+    for i in range(10):
+        func(i)
+    with timing.span('block'):
+        pass
+    timing.start_lap()
+    timing.lap('lap')
+
+    summary = timing.summary()
+    assert summary['func']['count'] == 10
+    assert summary['block']['count'] == 1
+    assert summary['lap']['count'] == 1
+    assert summary['func']['p50'] <= summary['func']['p95']
+    assert 'func' in timing.report()
+
+    path = timing.dump_json(str(tmp_path / 'timing.json'), experiment='x')
+    with open(path) as f:
+        data = json.load(f)
+    assert data['experiment'] == 'x'
+    assert data['spans']['func']['count'] == 10
+    timing.reset()
+    assert timing.summary() == {}
+
+
+def test_timing_nested():
+    timing.reset()
+
+    @timing.timed('recursive')
+    def recursive(n):
+        with timing.span('inner'):
+            pass
+        if n > 0:
+            recursive(n - 1)
+
+    recursive(3)
+    recursive(0)
+    summary = timing.summary()
+    assert summary['recursive']['count'] == 2
+    assert summary['inner']['count'] == 5
+    timing.reset()
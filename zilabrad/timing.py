@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+Timing spans for the stages of experiments
+
+Example:
+    with timing.span('setupDevices'):
+        setupDevices(qubits)
+
+    @timing.timed('makeSequence_AWG')
+    def makeSequence_AWG(qubits, FS=2.4e9):
+        ...
+
+The spans are recorded in a global recorder, which is reset at the
+start of every experiment (see multiplex.expfunc_decorator), and
+summarized at the end:
+
+    print(timing.report())
+    timing.dump_json('timing.json')
+
+If timing.json_dir is given, the summary of each experiment is saved
+there as a json file.
+"""
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+import numpy as np
+
+
+# set False to disable all spans
+enabled = True
+# directory for the json summary of experiments, None for no file
+json_dir = None
+
+_lock = threading.Lock()
+_records = {}
+# start of the current lap and the names of the open spans for each
+# thread, see lap and span
+_local = threading.local()
+
+
+def record(name, duration):
+    """add a duration (second) to the span of name
+    """
+    if not enabled:
+        return
+    with _lock:
+        _records.setdefault(name, []).append(duration)
+
+
+def _active():
+    if not hasattr(_local, 'active'):
+        _local.active = set()
+    return _local.active
+
+
+@contextmanager
+def span(name):
+    """time the body of the with-statement as the span of name.
+    A span inside an open span of the same name (in this thread) is
+    not recorded, so that recursive calls are counted only once.
+    """
+    active = _active()
+    if not enabled or name in active:
+        yield
+        return
+    active.add(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        active.discard(name)
+        record(name, time.perf_counter() - start)
+
+
+def timed(name):
+    """decorator, time every call of the function as the span of name,
+    only the outermost call of recursive functions is recorded
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def start_lap():
+    """start a lap in this thread, see lap
+    """
+    _local.lap_start = time.perf_counter()
+
+
+def lap(name):
+    """record the time since the last start_lap/lap in this thread
+    as the span of name, and start the next lap.
+    Nothing is recorded if no lap is started.
+    """
+    now = time.perf_counter()
+    start = getattr(_local, 'lap_start', None)
+    _local.lap_start = now
+    if start is not None:
+        record(name, now - start)
+
+
+def reset():
+    """clear all spans
+    """
+    with _lock:
+        _records.clear()
+
+
+def summary():
+    """
+    Returns:
+        dict {name: {'count', 'total', 'p50', 'p95'}}, times in second
+    """
+    with _lock:
+        records = {k: list(v) for k, v in _records.items()}
+    result = {}
+    for name, durations in records.items():
+        p50, p95 = np.percentile(durations, [50, 95])
+        result[name] = {
+            'count': len(durations),
+            'total': float(np.sum(durations)),
+            'p50': float(p50),
+            'p95': float(p95)}
+    return result
+
+
+def report():
+    """summary table (sorted by total time) as a string, times in ms
+    """
+    lines = ['%-32s %8s %12s %10s %10s' % (
+        'span', 'count', 'total(ms)', 'p50(ms)', 'p95(ms)')]
+    items = sorted(
+        summary().items(), key=lambda item: item[1]['total'], reverse=True)
+    for name, s in items:
+        lines.append('%-32s %8d %12.1f %10.3f %10.3f' % (
+            name, s['count'], s['total']*1e3, s['p50']*1e3, s['p95']*1e3))
+    return '\n'.join(lines)
+
+
+def dump_json(path, **kwargs):
+    """save the summary as json, kwargs are saved together,
+    for example the name of the experiment
+    """
+    data = dict(kwargs)
+    data['spans'] = summary()
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2)
+    return path
+
+
+def finish_experiment(name):
+    """print the summary of an experiment, and save it in json_dir
+    """
+    if not enabled or len(_records) == 0:
+        return
+    print(report())
+    if json_dir is not None:
+        timeNow = time.strftime("%Y%m%d_%H%M%S", time.localtime())
+        path = os.path.join(json_dir, '%s_%s.json' % (name, timeNow))
+        dump_json(path, experiment=name, time=timeNow)
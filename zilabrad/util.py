@@ -53,6 +53,10 @@ def singleton(class_):
 def clear_singletonMany(class_):
     _keys = list(class_.instance.keys())
     for _key in _keys:
+        # free the resources held by the object, e.g. awgModules
+        release = getattr(class_.instance[_key], 'release', None)
+        if release is not None:
+            release()
         del class_(_key)[_key]
     del _keys
     gc.collect()